@@ -1,25 +1,28 @@
-# from fitz.frontend import *
-# import tools
-# import os.path as op
-from pkg_resources import DistributionNotFound, get_distribution
+"""Fitz: Workflow Mangement for neuroimaging data.
+
+Submodules are imported lazily on first attribute access, so that importing
+fitz (e.g. for the command line entry point) doesn't pull in nipype, numpy
+and friends until they are actually needed.
+"""
 import os
-from os.path import dirname, basename, isfile
+import importlib
+from os.path import dirname, basename, isfile, join
 import glob
 
+# VERSION is the single source of the version for setup.py as well, and
+# reading it is far cheaper than asking pkg_resources.
+with open(join(dirname(__file__), 'VERSION')) as version_file:
+    __version__ = version_file.read().strip()
+del version_file
 
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = __name__
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
-    with open(os.path.join(os.path.dirname(__file__), 'VERSION')) as version_file:
-        version = version_file.read().strip()
-    __version__ = version
-    del version
-finally:
-    del get_distribution, DistributionNotFound
+modules = glob.glob(join(dirname(__file__), '*.py'))
+__all__ = [basename(f)[:-3] for f in modules
+           if isfile(f) and not f.endswith('__init__.py')]
+__all__.append('tools')
 
 
-modules = glob.glob(os.path.join(dirname(__file__), '*.py'))
-__all__ = [basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
-from . import *  # noqa
+def __getattr__(name):
+    """Import fitz submodules (e.g. fitz.frontend) when first used."""
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
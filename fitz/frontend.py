@@ -1,38 +1,34 @@
 """Forward facing fitz tools with information about ecosystem."""
 import os
-import re
 import sys
-import imp
+import copy
+import time
+import functools
+import importlib.util
 import os.path as op
-import numpy as np
 import subprocess
 from nipype import config, logging
 from fitz.tools.graphutils import make_subject_source
-
-
-def gather_project_info():
-    """Import project information based on environment settings."""
-    fitz_dir = os.environ["FITZ_DIR"]
-    proj_file = op.join(fitz_dir, "project.py")
-    try:
-        project = sys.modules["project"]
-    except KeyError:
-        project = imp.load_source("project", proj_file)
-
-    project_dict = dict()
-    for dir in ["data", "analysis", "working", "crash"]:
-        path = op.abspath(op.join(fitz_dir, getattr(project, dir + "_dir")))
-        project_dict[dir + "_dir"] = path
-    project_dict["default_exp"] = project.default_exp
-    project_dict["rm_working_dir"] = project.rm_working_dir
-
-    if hasattr(project, "ants_normalization"):
-        use_ants = project.ants_normalization
-        project_dict["normalization"] = "ants" if use_ants else "fsl"
-    else:
-        project_dict["normalization"] = "fsl"
-
-    return project_dict
+# The project file is read by the light subcommands too, so it is resolved
+# outside of this module, which imports nipype
+from fitz.tools.configfiles import cached_config, gather_project_info
+from fitz.tools.sharding import (select_shards, partition_subjects,
+                                 load_subject_costs)
+from fitz.tools.completion import CompletionIndex, parameter_hash
+from fitz.tools.profiling import NodeProfiler, load_node_history
+from fitz.tools.estimate import DryRunEstimate
+from fitz.tools.graphs import GraphRenderer
+from fitz.tools.aioplugin import AsyncSchedulerPlugin
+from fitz.tools.ledger import RunLedger
+from fitz.tools.progress import ProgressMonitor
+from fitz.tools.nodecache import SharedNodeCache
+from fitz.tools.resources import apply_resource_estimates
+from fitz.tools.batch import submit_chunks
+from fitz.tools.stages import StageScheduler, workflow_dependencies
+from fitz.tools.subjects import SubjectCatalog
+from fitz.tools.workdir import (stamp_run, release_run, parse_size,
+                                report_garbage, remove_working_dir,
+                                NodeUseRecorder, shared_dir)
 
 
 def gather_experiment_info(exp_name=None, model=None):
@@ -44,38 +40,28 @@ def gather_experiment_info(exp_name=None, model=None):
         project = gather_project_info()
         exp_name = project["default_exp"]
 
-    # Import the base experiment
-    try:
-        exp = sys.modules[exp_name]
-    except KeyError:
-        exp_file = op.join(fitz_dir, exp_name + ".py")
-        exp = imp.load_source(exp_name, exp_file)
-
-    exp_dict = {}
-
-    def keep(k):
-        return not re.match("__.*__", k)
-
-    exp_dict.update({k: v for k, v in list(exp.__dict__.items()) if keep(k)})
+    config_files = [op.join(fitz_dir, exp_name + ".py")]
 
     # Possibly import the alternate model details
     if model is not None:
         check_modelname(model, exp_name)
-        try:
-            mod = sys.modules[model]
-        except KeyError:
-            model_file = op.join(fitz_dir, "%s-%s.py" % (exp_name, model))
-            mod = imp.load_source(model, model_file)
+        config_files.append(op.join(fitz_dir, "%s-%s.py" % (exp_name, model)))
+
+    return cached_config(config_files, resolve_experiment)
 
-        mod_dict = {k: v for k, v in list(mod.__dict__.items()) if keep(k)}
 
-        # Update the base information with the altmodel info
-        exp_dict.update(mod_dict)
+def resolve_experiment(exp, mod=None):
+    """Merge experiment and model file contents into the experiment dict."""
+    exp_dict = {k: v for k, v in exp.items() if k != "__doc__"}
+
+    # Update the base information with the altmodel info
+    if mod is not None:
+        exp_dict.update({k: v for k, v in mod.items() if k != "__doc__"})
 
     # Save the __doc__ attribute to the dict
-    exp_dict["comments"] = "" if exp.__doc__ is None else exp.__doc__
-    if model is not None:
-        exp_dict["comments"] += "" if mod.__doc__ is None else mod.__doc__
+    exp_dict["comments"] = exp["__doc__"] or ""
+    if mod is not None:
+        exp_dict["comments"] += mod["__doc__"] or ""
 
     do_lyman_tweaks(exp_dict)
 
@@ -101,28 +87,45 @@ def do_lyman_tweaks(exp_dict):
         exp_dict["contrast_names"] = [c[0] for c in exp_dict["contrasts"]]
 
 
-def determine_subjects(subject_arg=None):
-    """Intelligently find a list of subjects in a variety of ways."""
+def determine_subjects(subject_arg=None, exclude=None, data_dir=None):
+    """Intelligently find a list of subjects in a variety of ways.
+
+    Each entry of subject_arg can be a subject id, a file of subject ids
+    (by path or as a name in $FITZ_DIR), or a glob, regex or range pattern
+    over the subject directories of data_dir (see SubjectCatalog). Without
+    any, $FITZ_DIR/subjects.txt is used, or else every subject in data_dir.
+    """
+    if data_dir is None:
+        data_dir = gather_project_info()["data_dir"]
+    catalog = SubjectCatalog(data_dir)
     if subject_arg is None:
         subject_file = op.join(os.environ["FITZ_DIR"], "subjects.txt")
-        subjects = np.loadtxt(subject_file, str, ndmin=1).tolist()
-    elif op.isfile(subject_arg[0]):
-        subjects = np.loadtxt(subject_arg[0], str).tolist()
-    else:
-        try:
-            subject_file = op.join(os.environ["FITZ_DIR"],
-                                   subject_arg[0] + ".txt")
-            subjects = np.loadtxt(subject_file, str).tolist()
-        except IOError:
-            subjects = subject_arg
-    return subjects
+        if op.isfile(subject_file) or not catalog.subjects:
+            subject_arg = [subject_file]
+        else:
+            subject_arg = ["*"]
+    return catalog.select(subject_arg, exclude)
 
 
 def determine_engine(args):
     """Read command line args and return Workflow.run() args."""
     plugin_dict = dict(linear="Linear", multiproc="MultiProc",
                        ipython="IPython", torque="PBS", sge="SGE",
-                       slurm="SLURM")
+                       slurm="SLURM", subjectpool="Linear")
+    async_dict = {"async-slurm": "SLURM", "async-sge": "SGE",
+                  "async-torque": "PBS", "async-local": "Local"}
+
+    if args.plugin in async_dict:
+        scheduler = async_dict[args.plugin]
+        plugin_args = dict(scheduler=scheduler, max_jobs=args.max_jobs)
+        if scheduler == "Local" and args.max_jobs is None:
+            plugin_args["max_jobs"] = args.nprocs
+        if args.queue is not None:
+            if scheduler == "SLURM":
+                plugin_args["sbatch_args"] = "-p %s" % args.queue
+            else:
+                plugin_args["qsub_args"] = "-q %s" % args.queue
+        return "AsyncScheduler", plugin_args
 
     plugin = plugin_dict[args.plugin]
 
@@ -131,6 +134,8 @@ def determine_engine(args):
 
     if plugin == "MultiProc":
         plugin_args['n_procs'] = args.nprocs
+        if args.memory_gb is not None:
+            plugin_args['memory_gb'] = args.memory_gb
     elif plugin in ["SGE", "PBS"]:
         qsub_args += "-V -e /dev/null -o /dev/null "
 
@@ -142,6 +147,17 @@ def determine_engine(args):
     return plugin, plugin_args
 
 
+def load_workflow_module(workflows_dir, wf_name):
+    """Import a workflow module from a pipeline's workflows directory."""
+    wf_file = op.join(workflows_dir, wf_name + ".py")
+    if not op.isfile(wf_file):
+        raise ImportError("No workflow file %s" % wf_file)
+    spec = importlib.util.spec_from_file_location("wf", wf_file)
+    wf_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(wf_module)
+    return wf_module
+
+
 def update_params(wf_module, exp):
     # print sys.path, dir(wf_module), wf_module.__name__, wf_module.__file__
     try:
@@ -180,15 +196,15 @@ def check_modelname(model, exp_name):
         raise IOError('\n- '.join(err))
 
 
-def run(args):
-    """Get and process specific information"""
+def setup_experiment(args):
+    """Load the project and experiment, pointing outputs at this experiment.
+
+    Returns the project and experiment dictionaries, after making the
+    pipeline's workflows importable.
+    """
     project = gather_project_info()
     exp = gather_experiment_info(args.experiment, args.model)
 
-    # Subject is always highest level of parameterization
-    subject_list = determine_subjects(args.subjects)
-    subj_source = make_subject_source(subject_list)
-
     # Get the full correct name for the experiment
     if args.experiment is None:
         exp_name = project["default_exp"]
@@ -199,6 +215,8 @@ def run(args):
     exp['model_name'] = args.model if args.model else ''
 
     # Set roots of output storage
+    project['shared_cache_dir'] = op.join(project["working_dir"],
+                                          shared_dir)
     project['analysis_dir'] = op.join(project["analysis_dir"], exp_name)
     project['working_dir'] = op.join(project["working_dir"], exp_name,
                                      exp['model_name'])
@@ -222,23 +240,436 @@ def run(args):
             raise IOError("Run `fitz install` to set up your pipeline of "
                           "workflows, %s does not exist." % workflows_dir)
     sys.path.insert(0, workflows_dir)
-    for wf_name in args.workflows:
-        try:
-            mod = imp.find_module(wf_name)
-            wf_module = imp.load_module("wf", *mod)
-        except (IOError, ImportError):
-            print("Could not find any workflows matching %s" % wf_name)
-            raise
+    return project, exp
 
-        params = update_params(wf_module, exp)
-        workflow = wf_module.workflow_manager(
-            project, params, args, subj_source)
 
-        # Run the pipeline
+def experiment_label(exp):
+    """Name an experiment/model combination, e.g. for report files."""
+    name = exp['exp_name']
+    if exp['model_name']:
+        name += '-' + exp['model_name']
+    return name
+
+
+def graph_dir(exp):
+    """Directory that workflow graphs of an experiment/model are saved in."""
+    return op.join(os.environ['FITZ_DIR'], 'graphs', experiment_label(exp))
+
+
+def run(args):
+    """Get and process specific information"""
+    project, exp = setup_experiment(args)
+
+    # Subject is always highest level of parameterization
+    subject_list = determine_subjects(args.subjects, args.exclude,
+                                      project["data_dir"])
+
+    # Go back for the subjects whose last run failed, with more memory the
+    # more often they failed
+    if args.retry_failed:
+        failures = RunLedger().failed_subjects(
+            args.workflows, exp['exp_name'], exp['model_name'])
+        if args.subjects is None:
+            subject_list = sorted(failures)
+        subject_list = [s for s in subject_list if s in failures]
+        if not subject_list:
+            print("No subjects failed their last run of %s" %
+                  ", ".join(args.workflows))
+            return
+        n_failed = max(failures[s] for s in subject_list)
+        project['resource_scale'] = args.retry_memory ** n_failed
+        print("Retrying %d subjects that failed up to %d runs in a row" %
+              (len(subject_list), n_failed))
+
+    # Each shard is built and run as its own independent graph. Shards all
+    # sink into the same analysis_dir, keyed by subject, so their outputs
+    # merge without any extra bookkeeping.
+    if args.shard is None:
+        shards = [subject_list]
+    else:
+        shards = select_shards(subject_list, args.shard, args.workflows,
+                               args.balance)
+
+    # Hand whole chunks of subjects to the scheduler as array tasks (a dry
+    # run submits nothing, and estimates the whole run here instead)
+    if args.batch_size and not args.dontrun:
+        subjects = [s for shard in shards for s in shard]
+        n_chunks = -(-len(subjects) // args.batch_size)
+        costs = (load_subject_costs(args.workflows) if args.balance
+                 else None)
+        chunks = partition_subjects(subjects, n_chunks, costs)
         plugin, plugin_args = determine_engine(args)
-        workflow.write_graph(str(workflow) + '.dot', format='svg')
-        if not args.dontrun:
+        submit_chunks(args, plugin_args.get("scheduler", plugin),
+                      [c for c in chunks if c])
+        return
+
+    # Record the run, and (through its callback) every node, in the ledger
+    ledger = None
+    run_marker = None
+    if not args.dontrun:
+        run_marker = stamp_run(project['working_dir'])
+        ledger = RunLedger()
+        project['ledger_run'] = ledger.start_run(
+            args, exp, [s for shard in shards for s in shard],
+            parameter_hash(exp))
+
+    callbacks, profiler = run_callbacks(project, args)
+    estimate = DryRunEstimate(load_node_history()) if args.dontrun else None
+
+    # Progress is followed through the callbacks of this process
+    monitor = None
+    if (args.progress or args.status_port is not None) and not args.dontrun:
+        if args.stream or args.plugin == 'subjectpool':
+            print("Progress is not shown for stage workers "
+                  "(--stream or -p subjectpool)")
+        else:
+            monitor = ProgressMonitor(load_node_history())
+            monitor.start(port=args.status_port, show=args.progress)
+            callbacks.append(monitor)
+
+    # Graphs are rendered in the background while the workflows run
+    renderer = None if args.no_graph else GraphRenderer(graph_dir(exp))
+    status = 'failed'
+    try:
+        failed = run_shards(project, exp, args, shards, callbacks, profiler,
+                            estimate, renderer, monitor)
+        scale = project.get('resource_scale', 1.)
+        for retry in range(1, args.max_retries + 1):
+            if not failed:
+                break
+            print("Retrying %d failed subjects (retry %d of %d)" %
+                  (len(failed), retry, args.max_retries))
+            project['resource_scale'] = scale * args.retry_memory ** retry
+            shards = [[s for s in shard if s in failed] for shard in shards]
+            failed = run_shards(project, exp, args, shards, callbacks,
+                                profiler, monitor=monitor)
+        if failed:
+            raise RuntimeError(
+                "Workflows failed for %d subjects: %s\nSee `fitz crashes`, "
+                "or retry them with `fitz run --retry-failed`" %
+                (len(failed), " ".join(sorted(failed))))
+        status = 'done'
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        if run_marker is not None:
+            release_run(run_marker)
+        if ledger is not None:
+            ledger.finish_run(status)
+        if renderer is not None and renderer.join():
+            print("Saved workflow graphs to %s" % renderer.graph_dir)
+        if profiler is not None and profiler.records:
+            report_profile(profiler, args.profile, exp)
+
+    # Report what would have run instead of cleaning up
+    if args.dontrun:
+        print(estimate.summary())
+        return
+    # A disk budget keeps caches for the next run, so it wins over removal
+    budget = args.gc_budget or project['working_dir_budget']
+    if budget:
+        report_garbage(gather_project_info()['working_dir'],
+                       parse_size(budget))
+    elif args.rm_working_dir:
+        remove_working_dir(project['working_dir'])
+    elif project['rm_working_dir']:
+        # Older project files set this by default, without it ever being
+        # acted on, so it doesn't delete anything by itself
+        print("Keeping the working directory: rm_working_dir in project.py "
+              "is deprecated and ignored; pass --rm-working-dir or set "
+              "working_dir_budget to clean it up")
+
+
+def run_shards(project, exp, args, shards, callbacks=(), profiler=None,
+               estimate=None, renderer=None, monitor=None):
+    """Run the workflows for each shard of subjects in turn.
+
+    Returns the subjects that failed a workflow.
+    """
+    failed = set()
+    for shard_subjects in shards:
+        if not shard_subjects:
+            continue
+        if args.stream and not args.dontrun:
+            failed |= run_streaming(project, exp, args, shard_subjects,
+                                    profiler)
+        elif args.plugin == 'subjectpool' and not args.dontrun:
+            failed |= run_subject_pool(project, exp, args, shard_subjects,
+                                       profiler, renderer)
+        else:
+            failed |= run_workflows(project, exp, args, shard_subjects,
+                                    callbacks, estimate, renderer, monitor)
+    return failed
+
+
+def run_callbacks(project, args):
+    """Set up the callbacks notified of every node start/end in a run."""
+    callbacks = [NodeUseRecorder()]
+    profiler = None
+    if args.shared_cache is not None:
+        config.set("execution", "hash_method", "content")
+        cache_dir = args.shared_cache or project['shared_cache_dir']
+        callbacks.append(SharedNodeCache(cache_dir))
+    if project.get('ledger_run') is not None:
+        callbacks.append(RunLedger(run_id=project['ledger_run']))
+    if args.profile is not None:
+        config.enable_resource_monitor()
+        profiler = NodeProfiler()
+        callbacks.append(profiler)
+    return callbacks, profiler
+
+
+def report_profile(profiler, prefix, exp):
+    """Write and summarize a --profile report and update runtime history."""
+    if not prefix:
+        prefix = op.join(os.environ['FITZ_DIR'], 'profiles', '%s_%s' % (
+            experiment_label(exp), time.strftime('%Y%m%d_%H%M%S')))
+    csv_file, json_file = profiler.write_report(prefix)
+    print(profiler.summary())
+    print("Wrote profile of %d node executions to %s and %s" %
+          (len(profiler.records), csv_file, json_file))
+    profiler.update_history()
+
+
+class StatusCallback(object):
+    """Nipype status_callback that fans out to fitz callbacks.
+
+    MapNodes pickle the plugin arguments along with themselves. Callbacks
+    only make sense in the process running the workflow, so pickled copies
+    notify nobody.
+    """
+    def __init__(self, callbacks, wf_name):
+
+        self.callbacks = callbacks
+        self.wf_name = wf_name
+
+    def __call__(self, node, status):
+
+        for callback in self.callbacks:
+            callback(node, status, self.wf_name)
+
+    def __getstate__(self):
+
+        return dict(callbacks=[], wf_name=self.wf_name)
+
+
+def make_status_callback(callbacks, wf_name):
+    """Return a nipype status_callback that fans out to fitz callbacks."""
+    return StatusCallback(callbacks, wf_name)
+
+
+def run_workflows(project, exp, args, subject_list, callbacks=(),
+                  estimate=None, renderer=None, monitor=None):
+    """Build and run each requested workflow over a list of subjects.
+
+    Returns the subjects that failed a workflow; they are left out of the
+    workflows after it.
+    """
+    failed = set()
+    for wf_name in args.workflows:
+        subjects = [s for s in subject_list if s not in failed]
+        if subjects:
+            failed |= run_workflow(project, exp, args, wf_name, subjects,
+                                   callbacks, estimate, renderer, monitor)
+    return failed
+
+
+def run_workflow(project, exp, args, wf_name, subject_list, callbacks=(),
+                 estimate=None, renderer=None, monitor=None):
+    """Build and run one workflow over a list of subjects.
+
+    With --dontrun, the workflow is only expanded and added to the dry run
+    estimate. With a GraphRenderer, its graph is drawn in the background,
+    and with a ProgressMonitor, its nodes are counted before it runs.
+
+    Returns the subjects with failed nodes, as far as the ledger tells;
+    failures it can't pin on subjects are raised.
+    """
+    workflows_dir = op.join(os.environ['FITZ_DIR'], exp['pipeline'],
+                            'workflows')
+    index = CompletionIndex(project['analysis_dir'])
+    version = exp.get('pipeline_version', '')
+    try:
+        wf_module = load_workflow_module(workflows_dir, wf_name)
+    except (IOError, ImportError):
+        print("Could not find any workflows matching %s" % wf_name)
+        raise
+
+    params = update_params(wf_module, exp)
+
+    # Prune subjects whose outputs are already sunk with these parameters
+    param_hash = parameter_hash(params)
+    if args.force:
+        subjects = subject_list
+    else:
+        subjects = index.pending(subject_list, wf_name, param_hash, version)
+        n_done = len(subject_list) - len(subjects)
+        if n_done:
+            print("Skipping %d subjects that already completed %s" %
+                  (n_done, wf_name))
+    if not subjects:
+        return set()
+
+    subj_source = make_subject_source(subjects)
+    workflow = wf_module.workflow_manager(
+        project, params, args, subj_source)
+
+    # Run the pipeline
+    plugin, plugin_args = determine_engine(args)
+    scale = project.get('resource_scale', 1.)
+    if args.estimate_resources or scale > 1:
+        history = load_node_history()
+        n_estimated, n_scaled = apply_resource_estimates(
+            workflow, plugin_args.get("scheduler", plugin), history, scale)
+        print("Set resource requests for %d nodes of %s from history" %
+              (n_estimated, wf_name))
+        if scale > 1:
+            if n_scaled:
+                print("Requesting x%.2g memory for %d nodes" %
+                      (scale, n_scaled))
+            else:
+                print("No memory request is known for any node of %s, so "
+                      "it is retried without more memory" % wf_name)
+    if callbacks:
+        plugin_args['status_callback'] = make_status_callback(callbacks,
+                                                              wf_name)
+    if renderer is not None:
+        renderer.add(workflow, wf_name)
+    if args.dontrun:
+        if estimate is not None:
+            estimate.add_workflow(workflow, wf_name)
+    else:
+        if monitor is not None:
+            monitor.add_workflow(workflow, wf_name, subjects)
+        if plugin == "AsyncScheduler":
+            plugin = AsyncSchedulerPlugin(plugin_args)
+        ledger = None
+        if project.get('ledger_run') is not None:
+            ledger = RunLedger(run_id=project['ledger_run'])
+            mark = ledger.last_node()
+        try:
             workflow.run(plugin, plugin_args)
+        except Exception:
+            # The plugins keep running the other subjects after a node
+            # failed, so subjects without failed nodes did finish
+            if ledger is None:
+                raise
+            failed = ledger.failed_since(mark, wf_name) & set(subjects)
+            if not failed:
+                raise
+            print("%s failed for %d subjects: %s" % (
+                wf_name, len(failed), " ".join(sorted(failed))))
+            index.mark_complete([s for s in subjects if s not in failed],
+                                wf_name, param_hash, version, failed)
+            return failed
+        index.mark_complete(subjects, wf_name, param_hash, version)
+    return set()
+
+
+def run_streaming(project, exp, args, subject_list, profiler=None):
+    """Stream subjects through the workflows as (subject, workflow) stages.
+
+    Each subject starts a workflow as soon as its own upstream workflows are
+    done, rather than waiting for every subject to finish them. Returns the
+    subjects with stages that failed or were skipped.
+    """
+    workflows_dir = op.join(os.environ['FITZ_DIR'], exp['pipeline'],
+                            'workflows')
+    modules = {wf_name: load_workflow_module(workflows_dir, wf_name)
+               for wf_name in args.workflows}
+    deps = workflow_dependencies(args.workflows, modules)
+
+    # The stage pool provides the local parallelism, so within a stage
+    # nodes run one at a time instead of oversubscribing the machine
+    stage_args = copy.copy(args)
+    if args.plugin in ['multiproc', 'subjectpool']:
+        stage_args.plugin = 'linear'
+
+    scheduler = StageScheduler(subject_list, args.workflows, deps,
+                               args.nprocs)
+    results, failed = scheduler.run(functools.partial(
+        run_stage, project, exp, stage_args))
+
+    if profiler is not None:
+        for records in results.values():
+            profiler.records.extend(records)
+    if failed:
+        print("%d workflow stages failed or were skipped: %s" % (
+            len(failed), ", ".join("%s/%s" % stage for stage in sorted(failed))))
+    return set(subj for subj, _ in failed)
+
+
+def run_subject_pool(project, exp, args, subject_list, profiler=None,
+                     renderer=None):
+    """Run each workflow as one small linear graph per subject.
+
+    Subject graphs run in a pool of --nprocs worker processes, so nipype
+    never has to schedule (and pickle) the nodes of every subject from one
+    central process. Each workflow finishes for every subject before the
+    next one starts, as with the other plugins. Returns the subjects that
+    failed a workflow.
+    """
+    workflows_dir = op.join(os.environ['FITZ_DIR'], exp['pipeline'],
+                            'workflows')
+    failed = {}
+    for wf_name in args.workflows:
+        if renderer is not None:
+            wf_module = load_workflow_module(workflows_dir, wf_name)
+            params = update_params(wf_module, exp)
+            renderer.add(wf_module.workflow_manager(
+                project, params, args, make_subject_source(subject_list)),
+                wf_name)
+
+        scheduler = StageScheduler(subject_list, [wf_name], {wf_name: []},
+                                   args.nprocs)
+        results, wf_failed = scheduler.run(functools.partial(
+            run_stage, project, exp, args))
+        if profiler is not None:
+            for records in results.values():
+                profiler.records.extend(records)
+        failed.update(wf_failed)
+        # Later workflows need the outputs of the subjects that failed
+        subject_list = [s for s in subject_list if (s, wf_name) in results]
+
+    if failed:
+        print("%d subject workflows failed: %s" % (
+            len(failed), ", ".join("%s/%s" % stage for stage in sorted(failed))))
+    return set(subj for subj, _ in failed)
+
+
+def run_stage(project, exp, args, wf_name, subject):
+    """Run one workflow for one subject in a stage worker process."""
+    config.set("execution", "crashdump_dir", project["crash_dir"])
+    workflows_dir = op.join(os.environ['FITZ_DIR'], exp['pipeline'],
+                            'workflows')
+    if workflows_dir not in sys.path:
+        sys.path.insert(0, workflows_dir)
+
+    callbacks, profiler = run_callbacks(project, args)
+    if run_workflow(project, exp, args, wf_name, [subject], callbacks):
+        raise RuntimeError("%s failed for subject %s" % (wf_name, subject))
+    return profiler.records if profiler is not None else []
+
+
+def graph(args):
+    """Render workflow graphs without running the workflows."""
+    project, exp = setup_experiment(args)
+    subject_list = determine_subjects(args.subjects, None,
+                                      project["data_dir"])
+    workflows_dir = op.join(os.environ['FITZ_DIR'], exp['pipeline'],
+                            'workflows')
+
+    renderer = GraphRenderer(args.output or graph_dir(exp), args.format,
+                             args.graph2use)
+    for wf_name in args.workflows:
+        wf_module = load_workflow_module(workflows_dir, wf_name)
+        params = update_params(wf_module, exp)
+        subj_source = make_subject_source(subject_list)
+        workflow = wf_module.workflow_manager(project, params, args,
+                                              subj_source)
+        renderer.add(workflow, wf_name)
+    for out_file in renderer.join():
+        print("Saved %s" % out_file)
 
 
 def install(args):
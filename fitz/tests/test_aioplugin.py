@@ -0,0 +1,47 @@
+import sys
+import time
+import asyncio
+import pytest
+
+pytest.importorskip("nipype")
+from fitz.tools.aioplugin import AsyncSchedulerPlugin  # noqa: E402
+
+
+class Node(object):
+
+    name = fullname = "crash"
+
+    def __init__(self, output_dir):
+        self._output_dir = output_dir
+
+    def output_dir(self):
+        return self._output_dir
+
+
+def submit_and_check(plugin, node, pyscript, log_file):
+
+    async def run():
+        backend = plugin.backend
+        job_id = await backend.submit(pyscript, "crash", log_file)
+        await backend.procs[job_id].wait()
+        assert not await backend.active([job_id])
+        await plugin._check_result(node, job_id, pyscript, log_file)
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("script,error", [
+    ("import os; os._exit(9)", "status 9"),
+    ("raise ImportError('no nipype here')", "no nipype here"),
+])
+def test_dead_local_job_fails_fast(tmp_path, script, error):
+
+    pyscript = tmp_path / "pyscript_crash.py"
+    pyscript.write_text(script + "\n")
+    plugin = AsyncSchedulerPlugin(dict(scheduler="Local",
+                                       python=sys.executable,
+                                       result_timeout=30))
+    start = time.time()
+    with pytest.raises(RuntimeError, match=error):
+        submit_and_check(plugin, Node(str(tmp_path)), str(pyscript),
+                         str(tmp_path / "pyscript_crash.log"))
+    assert time.time() - start < 10
@@ -0,0 +1,49 @@
+import os
+import argparse
+import subprocess
+from fitz.tools.batch import chunk_run_command, task_arg
+
+
+def run_args(**kwargs):
+
+    args = dict(verbose=False, experiment=None, model=None,
+                workflows=["preproc"], nprocs=1, memory_gb=None,
+                gc_budget=None, max_retries=0, retry_failed=False,
+                retry_memory=1.5, force=False, estimate_resources=False,
+                stream=False, progress=False, no_graph=False,
+                rm_working_dir=False, shared_cache=None, profile=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def task_command(args, batch_dir, task_id):
+    """The arguments an array task's shell passes to fitz."""
+    cmd = chunk_run_command(args, batch_dir, "TASK")
+    script = "printf '%s\\n' " + " ".join(task_arg(arg, "TASK")
+                                          for arg in cmd[1:])
+    out = subprocess.check_output(["bash", "-c", script],
+                                  env=dict(os.environ, TASK=str(task_id)))
+    return out.decode().splitlines()
+
+
+def test_task_arguments_are_quoted(tmp_path):
+
+    batch_dir = str(tmp_path / "it's a dir")
+    cmd = task_command(run_args(gc_budget="5G", no_graph=True), batch_dir, 3)
+    assert cmd[cmd.index("-s") + 1] == os.path.join(batch_dir, "chunk_3.txt")
+    assert "--no-graph" in cmd
+    assert cmd[cmd.index("--gc-budget") + 1] == "5G"
+
+
+def test_tasks_write_their_own_profiles(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FITZ_DIR", str(tmp_path))
+    batch_dir = str(tmp_path / "batch" / "20200101_000000")
+    args = run_args(profile="/tmp/my profile")
+    assert task_command(args, batch_dir, 2)[-1] == (
+        "--profile=/tmp/my profile_chunk_2")
+
+    profiles = [task_command(run_args(profile=""), batch_dir, i)[-1]
+                for i in [1, 2]]
+    assert profiles[0] != profiles[1]
+    assert profiles[0].startswith("--profile=%s" % tmp_path)
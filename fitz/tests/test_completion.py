@@ -0,0 +1,15 @@
+from fitz.tools.completion import CompletionIndex
+
+
+def test_failed_subjects_are_no_longer_complete(tmp_path):
+
+    for subj in ["s1", "s2"]:
+        (tmp_path / subj).mkdir()
+    index = CompletionIndex(str(tmp_path))
+    index.mark_complete(["s1", "s2"], "preproc", "abc", 1)
+    assert index.pending(["s1", "s2"], "preproc", "abc", 1) == []
+
+    # A later (e.g. forced) run of s2 failed, so a retry must run it again
+    index.mark_complete(["s1"], "preproc", "abc", 1, failed=["s2"])
+    index = CompletionIndex(str(tmp_path))
+    assert index.pending(["s1", "s2"], "preproc", "abc", 1) == ["s2"]
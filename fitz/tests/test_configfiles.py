@@ -0,0 +1,25 @@
+import os
+from fitz.tools import configfiles
+
+
+def resolve(config):
+    return dict(config, budget=None)
+
+
+def test_resolver_changes_invalidate_disk_cache(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FITZ_DIR", str(tmp_path))
+    config_file = tmp_path / "project.py"
+    config_file.write_text("data_dir = 'data'\n")
+
+    config = configfiles.cached_config([str(config_file)], resolve)
+    assert config["budget"] is None
+    cache_dir = tmp_path / ".fitz" / "config"
+    assert len(os.listdir(str(cache_dir))) == 1
+
+    # A newer resolve function must not be handed the old pickle
+    configfiles._memory_cache.clear()
+    monkeypatch.setattr(configfiles, "config_format",
+                        configfiles.config_format + 1)
+    configfiles.cached_config([str(config_file)], resolve)
+    assert len(os.listdir(str(cache_dir))) == 2
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+from fitz.tools.design import load_design
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def write_partitioned(path, subjects):
+
+    design = pd.DataFrame(dict(subject=subjects, onset=range(len(subjects))))
+    pq.write_to_dataset(pa.Table.from_pandas(design), str(path),
+                        partition_cols=["subject"])
+
+
+def test_numeric_subject_partitions_match_string_ids(tmp_path):
+
+    write_partitioned(tmp_path / "design", ["01", "01", "02", "12"])
+    design = load_design(str(tmp_path / "design"), "01")
+    assert list(design.onset) == [0, 1]
+    assert list(design.subject) == ["01", "01"]
+    assert load_design(str(tmp_path / "design"), "s01").empty
+
+
+def test_string_subject_partitions(tmp_path):
+
+    write_partitioned(tmp_path / "design", ["s1", "s1", "s2"])
+    design = load_design(str(tmp_path / "design"), "s2", columns=["onset"])
+    assert list(design.onset) == [2]
+
+
+def test_integer_subject_column(tmp_path):
+
+    design_file = str(tmp_path / "design.parquet")
+    pd.DataFrame(dict(subject=[1, 2, 12], onset=[0., 1., 2.])).to_parquet(
+        design_file)
+    assert list(load_design(design_file, "12").onset) == [2.]
+    assert load_design(design_file, "s12").empty
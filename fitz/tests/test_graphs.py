@@ -0,0 +1,17 @@
+import os
+import pytest
+
+pytest.importorskip("nipype")
+from fitz.tools.graphs import render_graph  # noqa: E402
+
+
+def test_render_dot_source(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FITZ_DIR", str(tmp_path))
+    dot = "digraph g { a -> b; }\n"
+    for name in ["first.dot", "second.dot"]:
+        out_file = render_graph(dot, str(tmp_path / "graphs" / name),
+                                format="dot")
+        with open(out_file) as f:
+            assert f.read() == dot
+    assert len(os.listdir(str(tmp_path / ".fitz" / "graphs"))) == 1
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("nipype")
+from nipype import Node, MapNode, Workflow  # noqa: E402
+from nipype.interfaces.io import DataSink  # noqa: E402
+from nipype.interfaces.utility import IdentityInterface  # noqa: E402
+from fitz.tools.graphutils import OutputWrapper, run_template_args  # noqa
+
+
+def sink_wrapper():
+    """A workflow with a top level and a nested mapnode, and its sink."""
+    wf = Workflow("outer")
+    inner = Workflow("inner")
+    inner.add_nodes([MapNode(IdentityInterface(["x"]), iterfield=["x"],
+                             name="smooth")])
+    wf.add_nodes([MapNode(IdentityInterface(["x"]), iterfield=["x"],
+                          name="realign"), inner])
+    sink = Node(DataSink(), "sink")
+    return OutputWrapper(wf, None, sink, None), sink
+
+
+def test_mapnode_directories_are_renamed():
+
+    wrapper, sink = sink_wrapper()
+    wrapper.set_mapnode_substitutions(12)
+    assert sink.interface._substitute("a/_realign1/b") == "a/run_2/b"
+    assert sink.interface._substitute("a/_realign10/b") == "a/run_11/b"
+    assert sink.interface._substitute("a/_smooth11/b") == "a/run_12/b"
+
+
+def test_existing_user_substitutions():
+
+    wrapper, sink = sink_wrapper()
+    sink.inputs.substitutions = [("_realign0", "first_run")]
+    sink.inputs.regexp_substitutions = [(r"run_(\d+)", r"run-\1")]
+    wrapper.set_mapnode_substitutions(12)
+    # Plain substitutions still see the original directory names
+    assert sink.interface._substitute("a/_realign0/b") == "a/first_run/b"
+    # and earlier regexp substitutions the renamed ones
+    assert sink.interface._substitute("a/_realign3/b") == "a/run-4/b"
+
+    wrapper.add_regexp_substitutions([("run-12", "last_run")])
+    assert sink.interface._substitute("a/_smooth11/b") == "a/last_run/b"
+
+
+@pytest.mark.parametrize("template_args,expected", [
+    ("r + 1", 4),
+    ("r", 3),
+    ("r+1, r + 1", (4, 4)),
+    ("(r + 1) * 2", 8),
+    ("r // 2 - 1", 0),
+])
+def test_template_args(template_args, expected):
+
+    assert run_template_args(template_args)(3) == expected
+
+
+@pytest.mark.parametrize("template_args", [
+    "__import__('os').getcwd()", "r.real", "run + 1", "r +"])
+def test_template_args_are_not_evaluated(template_args):
+
+    with pytest.raises(ValueError):
+        run_template_args(template_args)
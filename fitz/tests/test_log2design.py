@@ -0,0 +1,90 @@
+import os
+import sys
+import importlib.util
+import pandas as pd
+import pytest
+from fitz.tools.design import load_design
+
+script = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                      "scripts", "log2design.py")
+spec = importlib.util.spec_from_file_location("log2design", script)
+log2design = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(log2design)
+
+
+def run_log2design(monkeypatch, *argv):
+
+    monkeypatch.setattr(sys, "argv", ["log2design.py"] + list(argv))
+    log2design.main(log2design.parse_args())
+
+
+def write_onsets(path):
+
+    path.write_text("onset,condition,subject\n"
+                    "1,a,01\n2,b,01\n3,a,02\n4,b,02\n5,a,12\n")
+    return str(path)
+
+
+def test_rerun_replaces_partitioned_design(tmp_path, monkeypatch):
+
+    pytest.importorskip("pyarrow")
+    onsets = write_onsets(tmp_path / "run1.csv")
+    out = str(tmp_path / "design.parquet")
+    for _ in range(2):
+        run_log2design(monkeypatch, onsets, "-o", out,
+                       "--partition-col", "subject")
+    assert len(load_design(out)) == 5
+
+
+@pytest.mark.parametrize("out", ["design.csv", "design.parquet",
+                                 "design.feather"])
+def test_zero_padded_subjects(tmp_path, monkeypatch, out):
+
+    if not out.endswith(".csv"):
+        pytest.importorskip("pyarrow")
+    onsets = write_onsets(tmp_path / "run1.csv")
+    out = str(tmp_path / out)
+    run_log2design(monkeypatch, onsets, "-o", out)
+    design = load_design(out, "01")
+    assert list(design.onset) == [1, 2]
+    assert list(design.subject) == ["01", "01"]
+    assert load_design(out, "1").empty
+
+
+def test_zero_padded_subject_partitions(tmp_path, monkeypatch):
+
+    pytest.importorskip("pyarrow")
+    onsets = write_onsets(tmp_path / "run1.csv")
+    out = str(tmp_path / "design.parquet")
+    run_log2design(monkeypatch, onsets, "-o", out, "--partition-col",
+                   "subject")
+    assert sorted(os.listdir(out)) == ["subject=01", "subject=02",
+                                       "subject=12"]
+    assert list(load_design(out, "02").onset) == [3, 4]
+
+
+def test_spm_conditions_skip_trials_without_keys():
+
+    nan = float("nan")
+    design = pd.DataFrame(dict(
+        subject=["01", "01", nan, "01", "02"],
+        run=[1, 1, 1, nan, 1],
+        condition=["a", "b", "a", "a", nan],
+        onset=[1., 2., 3., 4., 5.]))
+    conditions = log2design.spm_conditions(design)
+    assert list(conditions) == [("01", 1)]
+    names = [str(n) for n in conditions[("01", 1)]["names"]]
+    assert names == ["a", "b"]
+    onsets = [list(o.ravel()) for o in conditions[("01", 1)]["onsets"]]
+    assert onsets == [[1.], [2.]]
+
+
+def test_spm_dir_keeps_zero_padded_subjects(tmp_path, monkeypatch):
+
+    pytest.importorskip("scipy")
+    onsets = write_onsets(tmp_path / "run1.csv")
+    spm_dir = tmp_path / "spm"
+    run_log2design(monkeypatch, onsets, "-o", str(tmp_path / "design.csv"),
+                   "--spm-dir", str(spm_dir))
+    assert sorted(os.listdir(str(spm_dir))) == ["01", "02", "12"]
+    assert os.listdir(str(spm_dir / "01")) == ["run1.mat"]
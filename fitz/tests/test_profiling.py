@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+from fitz.tools.profiling import node_record
+
+
+class Runtime(object):
+
+    def __init__(self, start, duration):
+        self.startTime = start.isoformat()
+        self.duration = duration
+
+
+class Result(object):
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+
+class Node(object):
+    """Just enough of a nipype node for node_record."""
+    parameterization = ["_subject_id_s1"]
+    fullname = "preproc.realign"
+    interface = object()
+
+    def __init__(self, start, duration=2.):
+        self.result = Result(Runtime(start, duration))
+
+
+def test_cached_nodes_report_no_usage():
+
+    since = datetime.now(timezone.utc)
+    rec = node_record(Node(since + timedelta(seconds=1)), "end", "preproc",
+                      measure_output=False, since=since)
+    assert rec["status"] == "end"
+    assert rec["wall_s"] == 2.
+
+    # nipype hands found cached nodes over with the runtime of an old run
+    rec = node_record(Node(since - timedelta(days=1)), "end", "preproc",
+                      measure_output=False, since=since)
+    assert rec["status"] == "cached"
+    assert rec["wall_s"] is None
+
+
+def test_naive_start_times_are_utc():
+
+    since = datetime.now(timezone.utc)
+    start = (since - timedelta(minutes=5)).replace(tzinfo=None)
+    rec = node_record(Node(start), "end", "preproc", measure_output=False,
+                      since=since)
+    assert rec["status"] == "cached"
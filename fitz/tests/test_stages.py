@@ -0,0 +1,75 @@
+import time
+from fitz.tools.stages import StageScheduler, workflow_dependencies
+
+
+class Module(object):
+
+    def __init__(self, requires=None):
+        if requires is not None:
+            self.requires = requires
+
+
+def record_stage(wf_name, subject):
+    """Stage stand-in returning when it started."""
+    start = time.time()
+    time.sleep(.05)
+    return start
+
+
+def fail_preproc(wf_name, subject):
+    if wf_name == "preproc" and subject == "s2":
+        raise ValueError("bad data")
+    return wf_name
+
+
+def test_dependencies_default_to_previous_workflow():
+
+    modules = dict(preproc=Module(), model=Module(), ffx=Module(["preproc"]))
+    deps = workflow_dependencies(["preproc", "model", "ffx"], modules)
+    assert deps == dict(preproc=[], model=["preproc"], ffx=["preproc"])
+
+
+def test_downstream_stages_run_before_new_subjects():
+
+    subjects = ["s%d" % i for i in range(1, 5)]
+    scheduler = StageScheduler(subjects, ["preproc", "model"],
+                               dict(preproc=[], model=["preproc"]), 1)
+    results, failed = scheduler.run(record_stage)
+    assert not failed
+
+    order = sorted(results, key=results.get)
+    assert order == [(s, wf) for s in subjects for wf in ["preproc", "model"]]
+
+
+def test_models_start_before_all_preprocs_finish():
+
+    subjects = ["s%d" % i for i in range(1, 9)]
+    scheduler = StageScheduler(subjects, ["preproc", "model"],
+                               dict(preproc=[], model=["preproc"]), 2)
+    results, _ = scheduler.run(record_stage)
+
+    first_model = min(results[(s, "model")] for s in subjects)
+    last_preproc = max(results[(s, "preproc")] for s in subjects)
+    assert first_model < last_preproc
+
+
+def test_failed_stage_skips_downstream():
+
+    scheduler = StageScheduler(["s1", "s2"], ["preproc", "model"],
+                               dict(preproc=[], model=["preproc"]), 2)
+    results, failed = scheduler.run(fail_preproc)
+    assert set(results) == {("s1", "preproc"), ("s1", "model")}
+    assert isinstance(failed[("s2", "preproc")], ValueError)
+    assert failed[("s2", "model")] is None
+
+
+def test_failure_skips_stages_with_several_upstreams():
+
+    deps = dict(preproc=[], model=["preproc"], ffx=["preproc", "model"])
+    scheduler = StageScheduler(["s1", "s2"], ["preproc", "model", "ffx"],
+                               deps, 2)
+    results, failed = scheduler.run(fail_preproc)
+    assert set(results) == {("s1", "preproc"), ("s1", "model"),
+                            ("s1", "ffx")}
+    assert failed[("s2", "model")] is None
+    assert failed[("s2", "ffx")] is None
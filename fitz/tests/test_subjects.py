@@ -0,0 +1,53 @@
+import pytest
+from fitz.tools.subjects import SubjectCatalog
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FITZ_DIR", str(tmp_path))
+    data_dir = tmp_path / "data"
+    for subj in ["sub-01", "sub-02", "sub-10"]:
+        (data_dir / subj).mkdir(parents=True)
+    (tmp_path / "pilot.txt").write_text("sub-01  # first\nsub-02\n")
+    return SubjectCatalog(str(data_dir))
+
+
+def test_selectors(catalog):
+
+    assert catalog.select(["pilot", "sub-1*"]) == ["sub-01", "sub-02",
+                                                   "sub-10"]
+    assert catalog.select(["sub-01..sub-10", "~sub-02"]) == ["sub-01",
+                                                             "sub-10"]
+    assert catalog.select(["re:0\\d$"], exclude=["sub-99"]) == ["sub-01",
+                                                               "sub-02"]
+
+
+def test_missing_subject_file_raises(catalog):
+
+    with pytest.raises(IOError):
+        catalog.select(["pilots.txt"])
+    with pytest.raises(IOError):
+        catalog.select(["lists/pilot"])
+
+
+def test_new_subject_ids_are_kept(catalog):
+
+    # e.g. for the workflow that creates their data directory
+    assert catalog.select(["sub-11", "sub-01"]) == ["sub-11", "sub-01"]
+
+
+def test_patterns_matching_nothing_raise(catalog):
+
+    for selector in ["sub-2*", "re:^sub-3", "sub-20..sub-30"]:
+        with pytest.raises(ValueError):
+            catalog.select([selector])
+    assert catalog.select(["sub-0*"], exclude=["sub-2*"]) == ["sub-01",
+                                                             "sub-02"]
+
+
+def test_ids_without_data_tree(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("FITZ_DIR", str(tmp_path))
+    catalog = SubjectCatalog(str(tmp_path / "data"))
+    assert catalog.select(["sub-1", "sub-2"]) == ["sub-1", "sub-2"]
@@ -0,0 +1,46 @@
+import os
+from fitz.tools.workdir import collect_garbage, find_node_dirs, run_stamp
+
+
+def make_node(path, n_bytes):
+
+    os.makedirs(path)
+    with open(os.path.join(path, "result_node.pklz"), "wb") as f:
+        f.write(b"x" * n_bytes)
+
+
+def test_hard_linked_nodes_count_once(tmp_path):
+
+    root = str(tmp_path)
+    cached = os.path.join(root, "shared_cache", "ab", "abcd")
+    make_node(cached, 1000)
+    for model in ["model1", "model2"]:
+        node = os.path.join(root, "exp", model, "wf", "smooth")
+        os.makedirs(node)
+        os.link(os.path.join(cached, "result_node.pklz"),
+                os.path.join(node, "result_node.pklz"))
+    make_node(os.path.join(root, "exp", "model1", "wf", "fit"), 500)
+
+    nodes, _, shared_size = find_node_dirs(root)
+    assert shared_size == 1000
+    assert sorted(n["size"] for n in nodes) == [0, 0, 500]
+    assert not any("shared_cache" in n["path"] for n in nodes)
+
+
+def test_collect_garbage_reports_freed_bytes(tmp_path):
+
+    root = str(tmp_path)
+    cached = os.path.join(root, "shared_cache", "ab", "abcd")
+    make_node(cached, 1000)
+    linked = os.path.join(root, "exp", "wf", "smooth")
+    os.makedirs(linked)
+    os.link(os.path.join(cached, "result_node.pklz"),
+            os.path.join(linked, "result_node.pklz"))
+    make_node(os.path.join(root, "exp", "wf", "fit"), 500)
+    open(os.path.join(root, "exp", run_stamp), "w").close()
+    os.utime(os.path.join(root, "exp", run_stamp), (2e9, 2e9))
+
+    reclaimed, remaining = collect_garbage(root, 0)
+    assert sum(reclaimed.values()) == 500
+    assert remaining == 1000
+    assert os.path.exists(os.path.join(cached, "result_node.pklz"))
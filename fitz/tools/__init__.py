@@ -1,11 +1,34 @@
-# from .commandline import run_parser
-# from .graphutils import *
-# from . import setup_project
+"""Helper modules for building and running fitz workflows.
+
+Submodules, and the most commonly used helpers in them, are imported lazily
+on first attribute access (e.g. fitz.tools.InputWrapper).
+"""
 import os
+import importlib
 from os.path import dirname, basename, isfile
 import glob
 
 
 modules = glob.glob(os.path.join(dirname(__file__), '*.py'))
-__all__ = [basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
-from . import *  # noqa
+__all__ = [basename(f)[:-3] for f in modules
+           if isfile(f) and not f.endswith('__init__.py')]
+
+# Names that can be used directly from fitz.tools, and their home module
+_lazy_names = dict(run_parser='commandline',
+                   new_workflow='builder',
+                   InputWrapper='graphutils',
+                   OutputWrapper='graphutils',
+                   make_subject_source='graphutils',
+                   GraphIndex='graphutils',
+                   find_mapnodes='graphutils',
+                   find_nested_workflows='graphutils')
+
+
+def __getattr__(name):
+    """Import submodules and helpers when they are first used."""
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    if name in _lazy_names:
+        module = importlib.import_module('.' + _lazy_names[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
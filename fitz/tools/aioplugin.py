@@ -0,0 +1,381 @@
+"""Asyncio execution plugin that submits nodes to a cluster scheduler.
+
+Nipype's cluster plugins check on every job with its own `qstat`/`squeue`
+call, sleeping in between, and only look for new work to submit once per
+polling round. This plugin keeps every job in flight on one event loop:
+
+- a node is submitted the moment its last upstream node finished
+- at most `max_submit` submission commands run at once, and at most
+  `max_jobs` jobs are queued or running on the scheduler
+- one status query per poll interval covers all jobs in flight
+
+Nodes that are already cached, or that nipype runs without submitting, run
+in a local thread instead of waiting in the scheduler queue, one at a time
+as node.run changes the working directory.
+"""
+import sys
+import time
+import getpass
+import asyncio
+import functools
+import os.path as op
+import networkx as nx
+from nipype.utils.filemanip import loadpkl
+from nipype.pipeline.plugins.base import PluginBase
+from nipype.pipeline.plugins.tools import (create_pyscript, report_crash,
+                                           report_nodes_not_run)
+from fitz.tools.estimate import node_is_cached
+
+
+def job_name(node):
+    """A scheduler job name for a node, e.g. fitz_preproc.realign."""
+    name = "fitz_%s.%s" % (node._hierarchy, node._id)
+    return "".join(c if c.isalnum() or c in "._-" else "_" for c in name)
+
+
+async def run_command(cmd):
+    """Run a command, returning its stdout; raise if it fails."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    out, err = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError("%s failed (%d): %s" % (
+            cmd[0], proc.returncode, err.decode(errors="replace").strip()))
+    return out.decode(errors="replace")
+
+
+class SchedulerBackend(object):
+    """Submit jobs to and query a cluster scheduler from the command line.
+
+    Subclasses give the submission command for a job and the command and
+    parsing that list all of the user's jobs still queued or running.
+    """
+    args_key = "qsub_args"
+    poll_interval = 5.
+
+    def __init__(self, python=None):
+
+        self.python = python or sys.executable
+        self.user = getpass.getuser()
+
+    def job_script(self, pyscript):
+        """Write a shell script running a node's python script."""
+        script = op.splitext(pyscript)[0] + ".sh"
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\n%s %s\n" % (self.python, pyscript))
+        return script
+
+    def submit_command(self, pyscript, name, log_file, args):
+        raise NotImplementedError
+
+    def status_command(self):
+        raise NotImplementedError
+
+    def parse_job_id(self, output):
+        return output.strip().split()[0]
+
+    def parse_status(self, output):
+        """Job ids in the scheduler's job listing."""
+        return set(line.split()[0] for line in output.splitlines()
+                   if line.strip() and line.split()[0][0].isdigit())
+
+    async def submit(self, pyscript, name, log_file, args=""):
+        """Submit a node's script as a job and return the job id."""
+        cmd = self.submit_command(pyscript, name, log_file, args)
+        return self.parse_job_id(await run_command(cmd))
+
+    async def active(self, job_ids):
+        """Return which of the job ids are still queued or running."""
+        output = await run_command(self.status_command())
+        return self.parse_status(output) & set(job_ids)
+
+    def job_error(self, job_id, log_file):
+        """Why a job that left the queue without results failed, if known.
+
+        Returns None while its results may still be on their way. Jobs
+        store the traceback of nodes that raise with their results, so a
+        traceback in the log means the job failed before it got that far.
+        """
+        if not op.exists(log_file):
+            return None
+        with open(log_file, errors="replace") as f:
+            log = f.read()
+        if "Traceback (most recent call last)" not in log:
+            return None
+        lines = [line.strip() for line in log.splitlines() if line.strip()]
+        return lines[-1]
+
+
+class SlurmBackend(SchedulerBackend):
+    """Submit with sbatch and list jobs with a single squeue call."""
+    args_key = "sbatch_args"
+
+    def submit_command(self, pyscript, name, log_file, args):
+        return (["sbatch", "--parsable", "-J", name, "-o", log_file] +
+                args.split() +
+                ["--wrap", "%s %s" % (self.python, pyscript)])
+
+    def status_command(self):
+        return ["squeue", "-h", "-o", "%i", "-u", self.user]
+
+    def parse_job_id(self, output):
+        # --parsable prints "jobid" or "jobid;cluster"
+        return output.strip().split(";")[0]
+
+
+class SGEBackend(SchedulerBackend):
+    """Submit with qsub and list jobs with a single qstat call."""
+    def submit_command(self, pyscript, name, log_file, args):
+        return (["qsub", "-terse", "-V", "-cwd", "-j", "y", "-N", name,
+                 "-o", log_file] + args.split() +
+                [self.job_script(pyscript)])
+
+    def status_command(self):
+        return ["qstat", "-u", self.user]
+
+
+class PBSBackend(SchedulerBackend):
+    """Submit with qsub and list jobs with a single qstat call."""
+    def submit_command(self, pyscript, name, log_file, args):
+        return (["qsub", "-V", "-j", "oe", "-N", name[:15],
+                 "-o", log_file] + args.split() +
+                [self.job_script(pyscript)])
+
+    def status_command(self):
+        return ["qstat", "-u", self.user]
+
+    def parse_job_id(self, output):
+        # Job ids look like 1234.server, but qstat may cut the server name
+        return output.strip().split(".")[0]
+
+    def parse_status(self, output):
+        return set(job_id.split(".")[0]
+                   for job_id in SchedulerBackend.parse_status(self, output))
+
+
+class LocalBackend(SchedulerBackend):
+    """Stand-in scheduler that runs every job as a local process.
+
+    It behaves like a cluster scheduler as far as the plugin can tell, so
+    the plugin can be tried (and debugged) without a cluster.
+    """
+    poll_interval = .5
+
+    def __init__(self, python=None):
+
+        SchedulerBackend.__init__(self, python)
+        self.procs = {}
+        self.returncodes = {}
+
+    async def submit(self, pyscript, name, log_file, args=""):
+
+        with open(log_file, "w") as log:
+            proc = await asyncio.create_subprocess_exec(
+                self.python, pyscript, stdout=log, stderr=log)
+        job_id = str(proc.pid)
+        self.procs[job_id] = proc
+        return job_id
+
+    async def active(self, job_ids):
+
+        running = set()
+        for job_id in job_ids:
+            if self.procs[job_id].returncode is None:
+                running.add(job_id)
+            else:
+                self.returncodes[job_id] = self.procs.pop(job_id).returncode
+        return running
+
+    def job_error(self, job_id, log_file):
+
+        # Local results can't be late, so a job that exited without them
+        # failed whatever its exit status
+        returncode = self.returncodes.pop(job_id, None)
+        if returncode is None:
+            return None
+        return (SchedulerBackend.job_error(self, job_id, log_file) or
+                "exited with status %d" % returncode)
+
+
+backends = dict(SLURM=SlurmBackend, SGE=SGEBackend, PBS=PBSBackend,
+                Local=LocalBackend)
+
+
+class AsyncSchedulerPlugin(PluginBase):
+    """Run a workflow by submitting its nodes to a scheduler from asyncio.
+
+    Plugin arguments:
+
+    - scheduler: 'SLURM', 'SGE', 'PBS' or 'Local' (the local stand-in)
+    - max_jobs: jobs queued or running on the scheduler at once (1000)
+    - max_submit: submission commands running at once (10)
+    - poll_interval: seconds between status queries (5, or .5 locally)
+    - result_timeout: seconds to wait for the results of a finished job to
+      show up on a shared filesystem (60), unless the job evidently failed
+    - sbatch_args/qsub_args: extra submission arguments; nodes can add their
+      own in node.plugin_args, or replace them with 'overwrite': True
+    - python: python executable for the jobs (this interpreter)
+    - status_callback: as for the nipype plugins
+
+    """
+    def __init__(self, plugin_args=None):
+
+        PluginBase.__init__(self, plugin_args)
+        args = self.plugin_args or {}
+        self.backend = backends[args.get("scheduler", "SLURM")](
+            args.get("python"))
+        self.max_jobs = args.get("max_jobs") or 1000
+        self.max_submit = args.get("max_submit") or 10
+        self.poll_interval = args.get("poll_interval",
+                                      self.backend.poll_interval)
+        self.result_timeout = args.get("result_timeout", 60.)
+
+    def run(self, graph, config, updatehash=False):
+        """Execute the nodes of an expanded workflow graph."""
+        notrun = asyncio.run(self._run(graph, updatehash))
+        if notrun:
+            report_nodes_not_run(notrun)
+            raise RuntimeError("Workflow did not execute cleanly. "
+                               "Check log for details")
+
+    def _callback(self, node, status):
+
+        if self._status_callback:
+            self._status_callback(node, status)
+
+    async def _run(self, graph, updatehash):
+
+        self._submit_slots = asyncio.Semaphore(self.max_submit)
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        self._waiting = {}
+        self._local_lock = asyncio.Lock()
+        poller = asyncio.ensure_future(self._poll())
+
+        n_upstream = {node: graph.in_degree(node) for node in graph}
+        tasks = {}
+        notrun = []
+
+        def launch(node):
+            task = asyncio.ensure_future(self._run_node(node, updatehash))
+            tasks[task] = node
+
+        for node in graph:
+            if not n_upstream[node]:
+                launch(node)
+
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node = tasks.pop(task)
+                    crashfile = task.result()
+                    if crashfile is not None:
+                        # Downstream nodes never get all their inputs
+                        notrun.append(dict(
+                            node=node, crashfile=crashfile,
+                            dependents=list(nx.descendants(graph, node))))
+                        continue
+                    for child in graph.successors(node):
+                        n_upstream[child] -= 1
+                        if not n_upstream[child]:
+                            launch(child)
+        finally:
+            poller.cancel()
+            for task in tasks:
+                task.cancel()
+        return notrun
+
+    async def _run_node(self, node, updatehash):
+        """Run or submit one node; return its crash file if it failed."""
+        loop = asyncio.get_event_loop()
+        self._callback(node, "start")
+        try:
+            local = node.run_without_submitting or (
+                not node.overwrite and
+                not getattr(node.interface, "always_run", False) and
+                await loop.run_in_executor(None, node_is_cached, node))
+            if local:
+                async with self._local_lock:
+                    await loop.run_in_executor(None, functools.partial(
+                        node.run, updatehash=updatehash))
+            else:
+                await self._submit(node, updatehash)
+        except Exception as e:
+            traceback = getattr(e, "traceback", None)
+            crashfile = report_crash(node, traceback=traceback)
+            self._callback(node, "exception")
+            return crashfile
+        self._callback(node, "end")
+        return None
+
+    def _submit_args(self, node):
+
+        key = self.backend.args_key
+        args = (self.plugin_args or {}).get(key, "")
+        node_args = node.plugin_args or {}
+        if key in node_args:
+            if node_args.get("overwrite"):
+                args = node_args[key]
+            else:
+                args = "%s %s" % (args, node_args[key])
+        return args
+
+    async def _submit(self, node, updatehash):
+        """Submit a node as a job, wait for it and check its results."""
+        pyscript = create_pyscript(node, updatehash=updatehash)
+        log_file = op.splitext(pyscript)[0] + ".log"
+        async with self._job_slots:
+            async with self._submit_slots:
+                job_id = await self.backend.submit(
+                    pyscript, job_name(node), log_file,
+                    self._submit_args(node))
+            finished = asyncio.get_event_loop().create_future()
+            self._waiting[job_id] = finished
+            await finished
+        await self._check_result(node, job_id, pyscript, log_file)
+
+    async def _poll(self):
+        """Resolve the jobs that left the scheduler, with one query."""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self._waiting:
+                continue
+            job_ids = list(self._waiting)
+            try:
+                active = await self.backend.active(job_ids)
+            except Exception as e:
+                print("Could not query job status: %s" % e)
+                continue
+            for job_id in job_ids:
+                if job_id not in active:
+                    self._waiting.pop(job_id).set_result(None)
+
+    async def _check_result(self, node, job_id, pyscript, log_file):
+
+        result_file = op.join(node.output_dir(), "result_%s.pklz" % node.name)
+        # Jobs that couldn't even load their node leave a crash dump instead
+        suffix = op.splitext(op.basename(pyscript))[0][len("pyscript_"):]
+        crashdump = op.join(op.dirname(pyscript),
+                            "crashdump_%s.pklz" % suffix)
+        deadline = time.time() + self.result_timeout
+        while not op.exists(result_file):
+            if op.exists(crashdump):
+                result_file = crashdump
+                break
+            error = self.backend.job_error(job_id, log_file)
+            if error is None and time.time() >= deadline:
+                error = "none after %gs" % self.result_timeout
+            if error is not None:
+                raise RuntimeError("Job for node %s left no results (%s); "
+                                   "see %s" % (node.fullname, error, log_file))
+            await asyncio.sleep(1)
+
+        # Jobs that raised store their traceback in place of the result
+        result = loadpkl(result_file)
+        if isinstance(result, dict) and result.get("traceback"):
+            error = RuntimeError("Node %s failed; see %s" %
+                                 (node.fullname, log_file))
+            error.traceback = result["traceback"]
+            raise error
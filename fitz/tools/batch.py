@@ -0,0 +1,135 @@
+"""Submit chunks of subjects as a single scheduler array job.
+
+Rather than letting a nipype cluster plugin submit one job per node per
+subject, each array task runs `fitz run` for a whole chunk of subjects
+locally on its execution host, so scheduler overhead is paid once per
+chunk instead of once per node.
+"""
+import os
+import sys
+import stat
+import time
+import shlex
+import subprocess
+import os.path as op
+from fitz.tools.state import state_path
+from fitz.tools.resources import scheduler_args
+
+# Submission command and array task id variable for each cluster plugin
+array_schedulers = dict(
+    SLURM=(["sbatch", "--parsable", "--array=1-%(n)d",
+            "--output=%(log_dir)s/chunk_%%a.log"], "SLURM_ARRAY_TASK_ID"),
+    SGE=(["qsub", "-V", "-cwd", "-t", "1-%(n)d",
+          "-o", "%(log_dir)s", "-e", "%(log_dir)s"], "SGE_TASK_ID"),
+    PBS=(["qsub", "-V", "-t", "1-%(n)d",
+          "-o", "%(log_dir)s", "-e", "%(log_dir)s"], "PBS_ARRAYID"),
+)
+
+
+def fitz_command():
+    """Return the command line that invokes this fitz installation."""
+    script = op.abspath(sys.argv[0])
+    if op.basename(script) == "fitz":
+        return [sys.executable, script]
+    return ["fitz"]
+
+
+def task_arg(arg, task_var):
+    """Shell-quote an argument, except for the array task id in it."""
+    token = "${%s}" % task_var
+    return token.join(shlex.quote(part) if part else ""
+                      for part in arg.split(token))
+
+
+def chunk_run_command(args, batch_dir, task_var):
+    """Build the `fitz run` command executed by each array task.
+
+    Arguments that differ between tasks refer to the task id as ${task_var}
+    for the task shell to expand.
+    """
+    task_id = "${%s}" % task_var
+    chunk_file = op.join(batch_dir, "chunk_%s.txt" % task_id)
+    cmd = fitz_command()
+    if args.verbose:
+        cmd.append("--verbose")
+    cmd.append("run")
+    if args.experiment:
+        cmd.extend(["-e", args.experiment])
+    if args.model:
+        cmd.extend(["-m", args.model])
+    cmd.extend(["-w"] + list(args.workflows))
+    cmd.extend(["-s", chunk_file])
+    if args.nprocs > 1:
+        cmd.extend(["-p", "multiproc", "-n", str(args.nprocs)])
+    else:
+        cmd.extend(["-p", "linear"])
+    for flag in ["memory_gb", "gc_budget"]:
+        if getattr(args, flag) is not None:
+            cmd.extend(["--" + flag.replace("_", "-"),
+                        str(getattr(args, flag))])
+    if args.max_retries:
+        cmd.extend(["--max-retries", str(args.max_retries)])
+    if args.max_retries or args.retry_failed:
+        cmd.extend(["--retry-memory", str(args.retry_memory)])
+    for flag in ["force", "estimate_resources", "stream", "retry_failed",
+                 "progress", "no_graph", "rm_working_dir"]:
+        if getattr(args, flag):
+            cmd.append("--" + flag.replace("_", "-"))
+    # Optional values are passed with = so they aren't taken as positionals
+    if args.shared_cache is not None:
+        cmd.append("--shared-cache=%s" % args.shared_cache
+                   if args.shared_cache else "--shared-cache")
+    if args.profile is not None:
+        # Every task writes its own report
+        prefix = args.profile or op.join(
+            os.environ["FITZ_DIR"], "profiles",
+            "batch_%s" % op.basename(op.normpath(batch_dir)))
+        cmd.append("--profile=%s_chunk_%s" % (prefix, task_id))
+    return cmd
+
+
+def submit_chunks(args, plugin, chunks):
+    """Write one subject file per chunk and submit them as an array job.
+
+    Returns
+    -------
+    batch_dir : string
+        Directory holding the chunk files, job script and logs.
+    """
+    if plugin not in array_schedulers:
+        raise ValueError("Batched submission needs a cluster plugin "
+                         "(slurm, sge or torque), not %s" % args.plugin)
+    if args.status_port is not None:
+        raise ValueError("--status-port can't be used with --batch-size; "
+                         "every array task would serve on the same port")
+    submit_cmd, task_var = array_schedulers[plugin]
+
+    batch_dir = state_path("batch", time.strftime("%Y%m%d_%H%M%S"), "")
+    for i, chunk in enumerate(chunks):
+        with open(op.join(batch_dir, "chunk_%d.txt" % (i + 1)), "w") as f:
+            f.write("\n".join(chunk) + "\n")
+
+    run_cmd = " ".join(task_arg(arg, task_var)
+                       for arg in chunk_run_command(args, batch_dir, task_var))
+    script = op.join(batch_dir, "run_chunk.sh")
+    with open(script, "w") as f:
+        f.write("#!/bin/bash\n"
+                "export FITZ_DIR=%s\n"
+                "cd %s\n"
+                "%s\n" % (shlex.quote(os.environ["FITZ_DIR"]),
+                           shlex.quote(os.getcwd()), run_cmd))
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+
+    fmt = dict(n=len(chunks), log_dir=batch_dir)
+    cmd = [arg % fmt for arg in submit_cmd]
+    key, resources = scheduler_args(plugin, args.memory_gb, args.nprocs)
+    cmd.extend(resources.split())
+    if args.queue is not None:
+        cmd.extend(["-p" if plugin == "SLURM" else "-q", args.queue])
+    cmd.append(script)
+
+    print(" ".join(cmd))
+    job_id = subprocess.check_output(cmd).decode().strip()
+    print("Submitted %d chunks of subjects as array job %s" %
+          (len(chunks), job_id))
+    return batch_dir
@@ -1,8 +1,36 @@
 import os
+import os.path as op
 from glob import glob
-from nipype.utils.filemanip import split_filename
 from textwrap import dedent
 from argparse import RawDescriptionHelpFormatter
+from fitz.tools.state import state_path, load_json, save_json
+
+
+def available_workflows(fitz_dir):
+    """List workflow names in all pipelines installed in a fitz directory.
+
+    The list is cached under $FITZ_DIR/.fitz and only rebuilt when one of
+    the workflows directories (or the fitz directory itself) has changed.
+    """
+    wf_dirs = sorted(glob(op.join(fitz_dir, '*', 'workflows')))
+    mtimes = {d: os.stat(d).st_mtime for d in [fitz_dir] + wf_dirs}
+
+    try:
+        registry_file = state_path('workflows.json')
+        registry = load_json(registry_file, {})
+    except (IOError, OSError, ValueError):
+        registry_file, registry = None, {}
+    if registry.get('mtimes') == mtimes:
+        return registry['workflows']
+
+    wf_files = [f for d in wf_dirs for f in glob(op.join(d, '*.py'))]
+    workflows = sorted(set(op.splitext(op.basename(f))[0] for f in wf_files))
+    if registry_file is not None:
+        try:
+            save_json(registry_file, dict(mtimes=mtimes, workflows=workflows))
+        except (IOError, OSError):
+            pass
+    return workflows
 
 
 def run_parser(subparsers):
@@ -22,11 +50,22 @@ def run_parser(subparsers):
     to process a single run of data linearly.
 
     Nipype creates a cache directory to save processing time when steps are
-    re-run. If you do not delete your cache directory after running (which is
-    configured in the project file), repeated use of this script will only
+    re-run. If you do not delete your cache directory after running (with
+    --rm-working-dir), repeated use of this script will only
     rerun the nodes that have changes to their inputs. Otherwise, you will
     have to rerun at the level of the workflows.
 
+    With --shared-cache, finished nodes are also stored in a cache shared
+    by every experiment and model, keyed by their interface and a hash of
+    their input contents, and hard linked into place instead of recomputed
+    when another experiment or model needs exactly the same node. This
+    switches nipype to hashing files by content, so existing working
+    directories will be recomputed once.
+
+    Subjects that already finished a workflow with identical parameters and
+    pipeline version are recorded in the experiment's analysis directory and
+    skipped entirely on later runs; use --force to run them again.
+
 
     Examples
     --------
@@ -54,14 +93,91 @@ def run_parser(subparsers):
         $FITZ_DIR/nback.py. Distribute the execution locally with 8 parallel
         processes.
 
+    fitz run -s 'sub-0[0-9]*' --exclude done.txt -w preproc
+
+        Run preprocessing for every subject directory in data_dir matching
+        the pattern, except those listed in done.txt. Patterns always match
+        the subjects currently on disk; the directory listing is cached and
+        refreshed only when data_dir changes. Ranges like sub-001..sub-050
+        and regular expressions like 're:^sub-\\d+$' work the same way.
+
+    fitz run -w preproc model --dontrun
+
+        Build and expand the workflows without running them, and report how
+        many nodes each workflow and subject would run, which would be
+        reused from the working directory cache, and the CPU-hours, peak
+        memory and new disk space they are expected to need based on
+        earlier --profile runs.
+
+    fitz run -w preproc model --profile
+
+        Record wall time, CPU time, peak memory and output size of every node
+        for every subject, print the slowest nodes and subjects, and save the
+        full report under $FITZ_DIR/profiles. Profiled runs also update the
+        runtime history used by --balance and --estimate-resources.
+
+    fitz run -w xnatconvert preproc onset model --stream -n 8
+
+        Stream subjects through the workflows: each subject starts the next
+        workflow as soon as its own previous one is done, with up to 8
+        subject stages running at once. Workflows can declare which other
+        workflows they need with a module-level `requires` list; otherwise
+        each depends on the one listed before it.
+
+    fitz run -w preproc model -p slurm --batch-size 5 -n 4
+
+        Submit a single SLURM array job where each task runs both workflows
+        for five subjects with 4 local processes, instead of submitting a
+        separate job for every node of every subject.
+
+    fitz run -w preproc model -p slurm --retry-failed --max-retries 2
+
+        Rerun only the subjects whose last preproc or model run failed, as
+        recorded in the ledger (see `fitz ledger failures`), in a graph of
+        just those subjects. Memory requests from the --profile history
+        grow 1.5 times for every run in a row a subject failed, and
+        subjects that fail again are retried up to two more times with
+        more memory each time.
+
+    fitz run -w preproc model -p slurm --progress --status-port 8123
+
+        Keep a live view of the run in the terminal: nodes done, running and
+        pending for each workflow, how many subjects finished, nodes per
+        minute, an ETA based on node runtimes from earlier --profile runs,
+        and the nodes that have been running longest. The same numbers,
+        broken down per subject, are served as JSON on
+        http://localhost:8123/ for monitoring from elsewhere.
+
+    fitz run -w preproc model -p async-slurm --max-jobs 200
+
+        Submit every node to SLURM from an asyncio event loop, keeping up
+        to 200 jobs queued at once. Nodes are submitted as soon as their
+        inputs are ready and all jobs are checked with a single squeue
+        call, and cached nodes are loaded locally instead of queued. The
+        async-sge and async-torque plugins do the same with qsub/qstat, and
+        async-local runs the jobs as local processes to try it out.
+
+    fitz run -w preproc model -p subjectpool -n 16
+
+        Run each workflow as a separate small graph per subject, 16
+        subjects at a time in worker processes that execute their nodes
+        one by one. For graphs with tens of thousands of nodes this avoids
+        the overhead of scheduling every node centrally with MultiProc.
+
+    fitz run -w preproc -p slurm --shard 3/10 --balance
+
+        Run preprocessing for only the third of ten subject shards. Launching
+        all ten shards on different nodes splits the study into ten small,
+        independent graphs; --balance uses stored subject runtimes to give
+        each shard a similar amount of work. Use `--shard 10` to run all ten
+        shards one after the other from a single process.
+
     Usage Details
     -------------
 
     """)
     if 'FITZ_DIR' in list(os.environ.keys()):
-        wf_files = glob(os.path.join(
-            os.environ['FITZ_DIR'], '*/workflows/*.py'))
-        workflows = [split_filename(wf)[1] for wf in wf_files]
+        workflows = available_workflows(os.environ['FITZ_DIR'])
     else:
         workflows = []
     parser = subparsers.add_parser('run', help='run')
@@ -74,15 +190,252 @@ def run_parser(subparsers):
     parser.add_argument("--subjects", "-s", nargs="*", dest="subjects",
                         help=("list of subject ids, name of file in lyman "
                               "directory, or full path to text file with "
-                              "subject ids"))
+                              "subject ids; glob ('sub-0*'), regex "
+                              "('re:...') and range ('sub-01..sub-20') "
+                              "patterns select from data_dir, and a '~' "
+                              "prefix removes subjects again"))
+    parser.add_argument("--exclude", "-x", nargs="*", metavar="SUBJECTS",
+                        help="subjects to leave out, in any form accepted "
+                             "by --subjects")
     parser.add_argument("--plugin", "-p", default="multiproc",
                         choices=["linear", "multiproc", "ipython",
-                                 "torque", "sge", "slurm"],
+                                 "torque", "sge", "slurm", "async-slurm",
+                                 "async-sge", "async-torque", "async-local",
+                                 "subjectpool"],
                         help="worklow execution plugin")
     parser.add_argument("--nprocs", "-n", default=4, type=int,
-                        help="number of MultiProc processes to use")
+                        help="number of MultiProc (or subjectpool) "
+                             "processes to use")
+    parser.add_argument("--max-jobs", type=int,
+                        help="jobs the async plugins keep queued or running "
+                             "at once (default 1000, or --nprocs for "
+                             "async-local)")
     parser.add_argument("--queue", "-q", help="which queue for "
                                               "scheduler execution")
+    parser.add_argument("--memory-gb", type=float,
+                        help="memory budget for MultiProc execution")
+    parser.add_argument("--estimate-resources", action="store_true",
+                        help="request per-node memory and threads based on "
+                             "usage recorded by --profile runs")
+    parser.add_argument("--shared-cache", nargs="?", const="", metavar="DIR",
+                        help="reuse identical node results across "
+                             "experiments and models from a content-addressed "
+                             "cache (default working_dir/shared_cache)")
+    parser.add_argument("--stream", action="store_true",
+                        help="start each subject's next workflow as soon as "
+                             "its previous one finishes, running --nprocs "
+                             "subject stages at once")
+    parser.add_argument("--batch-size", type=int,
+                        help="submit chunks of this many subjects as tasks "
+                             "of one scheduler array job")
+    parser.add_argument("--gc-budget", metavar="SIZE",
+                        help="after running, evict old node caches until the "
+                             "working directory fits in SIZE (e.g. 500G); "
+                             "defaults to working_dir_budget in project.py")
+    parser.add_argument("--rm-working-dir", action="store_true",
+                        help="remove the working directory after a "
+                             "successful run, unless other runs use it or "
+                             "there is a --gc-budget")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="only run the subjects (of --subjects, if "
+                             "given) whose last run of the workflows failed")
+    parser.add_argument("--max-retries", type=int, default=0, metavar="N",
+                        help="rerun subjects that failed up to N more times")
+    parser.add_argument("--retry-memory", type=float, default=1.5,
+                        metavar="FACTOR",
+                        help="multiply recorded (or declared) memory "
+                             "requests by FACTOR for every time a subject "
+                             "failed (default 1.5)")
+    parser.add_argument("--progress", action="store_true",
+                        help="show nodes done, running and pending per "
+                             "workflow, throughput and ETA while running")
+    parser.add_argument("--status-port", type=int, metavar="PORT",
+                        help="serve the run progress as JSON on "
+                             "http://localhost:PORT/")
+    parser.add_argument("--no-graph", action="store_true",
+                        help="don't draw the workflow graphs (otherwise "
+                             "saved to $FITZ_DIR/graphs in the background)")
     parser.add_argument("--dontrun", action="store_true",
-                        help="don't actually execute the workflows")
+                        help="don't actually execute the workflows; report "
+                             "which nodes would run and their estimated cost")
+    parser.add_argument("--shard", help="only run shard i of N subject "
+                                        "shards (i/N), or run all N shards "
+                                        "as separate graphs (N)")
+    parser.add_argument("--balance", action="store_true",
+                        help="balance shards by stored subject runtimes")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun subjects that already completed a "
+                             "workflow with the same parameters")
+    parser.add_argument("--profile", nargs="?", const="", metavar="PREFIX",
+                        help="record per-node runtime and memory usage and "
+                             "write a report to PREFIX.csv/.json (default "
+                             "$FITZ_DIR/profiles/)")
+    return parser
+
+
+def graph_parser(subparsers):
+    help = dedent("""
+    Draw the graphs of fitz workflows without running them.
+
+    `fitz run` also draws the graph of every workflow it runs, in the
+    background while the workflow runs (skip this with --no-graph).
+    Graphs are saved to $FITZ_DIR/graphs/<experiment>[-<model>]/ and
+    renderings are cached by the contents of the graph, so graphviz only
+    runs again when a workflow changed.
+
+    Examples
+    --------
+
+    fitz graph -w preproc model
+
+        Draw the preproc and model workflows of the default experiment as
+        $FITZ_DIR/graphs/<experiment>/preproc.svg and model.svg.
+
+    fitz graph -w model -e nback -m glm --graph2use colored -f png -o .
+
+        Draw the model workflow of the nback-glm model, with nested
+        workflows in color, as model.png in the current directory.
+    """)
+    if 'FITZ_DIR' in list(os.environ.keys()):
+        workflows = available_workflows(os.environ['FITZ_DIR'])
+    else:
+        workflows = []
+    parser = subparsers.add_parser('graph', help='draw workflow graphs')
+    parser.description = help
+    parser.formatter_class = RawDescriptionHelpFormatter
+    parser.add_argument("--experiment", "-e", help="experimental paradigm")
+    parser.add_argument("--model", "-m", help="model to fit")
+    parser.add_argument("--workflows", "-w", nargs="*",
+                        choices=workflows, help="which workflows to draw")
+    parser.add_argument("--subjects", "-s", nargs="*", dest="subjects",
+                        help="subjects to build the workflows for, as in "
+                             "`fitz run`")
+    parser.add_argument("--format", "-f", default="svg",
+                        choices=["svg", "png", "pdf", "dot"],
+                        help="image format")
+    parser.add_argument("--graph2use", default="hierarchical",
+                        choices=["orig", "flat", "hierarchical", "colored",
+                                 "exec"],
+                        help="which nipype graph to draw")
+    parser.add_argument("--output", "-o", metavar="DIR",
+                        help="directory to save the graphs in")
+    return parser
+
+
+def ledger_parser(subparsers):
+    help = dedent("""
+    Query the ledger of past fitz runs.
+
+    Every `fitz run` is recorded in $FITZ_DIR/.fitz/ledger.db (SQLite),
+    together with its subjects and every node it ran or failed: workflow,
+    subject, status, wall and CPU time, peak memory and working directory.
+
+    Examples
+    --------
+
+    fitz ledger runs -n 5
+
+        Show the last five runs, their plugin, workflows and outcome.
+
+    fitz ledger failures -w preproc --since 7d
+
+        List the subjects with failed preproc nodes in the last week, with
+        the failed nodes and the run they failed in.
+
+    fitz ledger runtimes -w model --group-by '^(\\w+?)_'
+
+        Median and total model runtime per site, taking the site from the
+        subject id prefix (e.g. harvard_s01).
+
+    fitz ledger sql "SELECT node, AVG(wall_s) FROM nodes GROUP BY node"
+
+        Run any query on the runs, run_subjects and nodes tables.
+    """)
+    parser = subparsers.add_parser('ledger', help='query past runs')
+    parser.description = help
+    parser.formatter_class = RawDescriptionHelpFormatter
+    parser.add_argument("query", choices=["runs", "failures", "runtimes",
+                                          "sql"],
+                        help="what to show")
+    parser.add_argument("sql", nargs="?", help="query for `fitz ledger sql`")
+    parser.add_argument("--workflow", "-w", help="only this workflow")
+    parser.add_argument("--since", help="only nodes finished since then, "
+                                        "e.g. 7d, 12h, 2w or 2015-06-01")
+    parser.add_argument("--group-by", metavar="REGEX",
+                        help="group runtimes by the first group of this "
+                             "regular expression on subject ids")
+    parser.add_argument("-n", type=int, default=20,
+                        help="number of runs to show")
+    return parser
+
+
+def crashes_parser(subparsers):
+    help = dedent("""
+    Summarize the nipype crash files of failed nodes.
+
+    Crash files in the project's crash_dir are indexed once, in parallel,
+    and their summaries cached in $FITZ_DIR/.fitz/crashes.json, so later
+    calls only read new crash files. Crashes are grouped by node and error,
+    with paths, numbers and subject ids in the error message ignored, and
+    listed per subject.
+
+    Examples
+    --------
+
+    fitz crashes --since 12h
+
+        Show what failed in the last 12 hours: how often each node failed
+        with each kind of error, for how many subjects, and which nodes
+        failed for each subject.
+
+    fitz crashes -w preproc --rerun failed.txt
+
+        Summarize preproc crashes and write the subjects that crashed to
+        failed.txt, to rerun them with `fitz run -s failed.txt -w preproc`.
+    """)
+    parser = subparsers.add_parser('crashes', help='summarize crash files')
+    parser.description = help
+    parser.formatter_class = RawDescriptionHelpFormatter
+    parser.add_argument("--workflow", "-w", help="only this workflow")
+    parser.add_argument("--since", help="only crashes since then, "
+                                        "e.g. 7d, 12h, 2w or 2015-06-01")
+    parser.add_argument("--rerun", metavar="FILE",
+                        help="write the subjects with crashes to FILE")
+    parser.add_argument("--crash-dir", help="crash directory to read "
+                                            "(default crash_dir in "
+                                            "project.py)")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="processes to read new crash files with "
+                             "(default one per CPU)")
+    parser.add_argument("-n", type=int, default=20,
+                        help="number of failure kinds to show")
+    return parser
+
+
+def gc_parser(subparsers):
+    help = dedent("""
+    Shrink the project working directory to fit a disk budget.
+
+    Nipype node caches are evicted least recently used first. Caches used
+    by the latest run of each experiment/model are always kept, so the next
+    incremental rerun of that experiment/model doesn't start from scratch.
+    The same pass runs automatically after `fitz run` when a budget is set
+    with --gc-budget or working_dir_budget in project.py.
+
+    Examples
+    --------
+
+    fitz gc --budget 2T --dry-run
+
+        Report how much would be removed from each experiment/model to fit
+        the working directory in 2 terabytes, without deleting anything.
+    """)
+    parser = subparsers.add_parser('gc', help='clean working directory')
+    parser.description = help
+    parser.formatter_class = RawDescriptionHelpFormatter
+    parser.add_argument("--budget", metavar="SIZE",
+                        help="disk budget for node caches (e.g. 500G); "
+                             "defaults to working_dir_budget in project.py")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report what would be removed")
     return parser
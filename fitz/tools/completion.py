@@ -0,0 +1,68 @@
+"""Persistent index of subjects whose workflow outputs are already sunk."""
+import json
+import time
+import fcntl
+import hashlib
+import os.path as op
+from fitz.tools.state import load_json, save_json
+
+
+def parameter_hash(params):
+    """Return a stable hash of a workflow parameter dictionary.
+
+    Values that can't be represented as json are hashed by their repr, so
+    objects with unstable reprs simply never match a completed entry.
+    """
+    blob = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+class CompletionIndex(object):
+    """Track (subject, workflow, parameters, version) runs that finished.
+
+    The index lives next to the outputs it describes, in the experiment's
+    analysis directory, so it moves and is deleted along with them.
+    """
+    index_name = ".fitz_completed.json"
+
+    def __init__(self, analysis_dir):
+
+        self.analysis_dir = analysis_dir
+        self.path = op.join(analysis_dir, self.index_name)
+        self.entries = load_json(self.path, {})
+
+    @staticmethod
+    def key(subject, wf_name, param_hash, version):
+        return "|".join([wf_name, str(subject), param_hash, str(version)])
+
+    def is_complete(self, subject, wf_name, param_hash, version):
+        """Check the index, and that the subject's outputs still exist."""
+        key = self.key(subject, wf_name, param_hash, version)
+        return (key in self.entries and
+                op.isdir(op.join(self.analysis_dir, str(subject))))
+
+    def pending(self, subjects, wf_name, param_hash, version):
+        """Return the subjects that still need to be run."""
+        return [s for s in subjects
+                if not self.is_complete(s, wf_name, param_hash, version)]
+
+    def mark_complete(self, subjects, wf_name, param_hash, version,
+                      failed=()):
+        """Add subjects to the index and save it.
+
+        Subjects that failed are removed, so an entry from an earlier run
+        doesn't keep them from being run again.
+        """
+        # Lock and re-read before writing to keep entries from concurrent
+        # shards and stages
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.entries = load_json(self.path, {})
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+            for subj in subjects:
+                key = self.key(subj, wf_name, param_hash, version)
+                self.entries[key] = stamp
+            for subj in failed:
+                key = self.key(subj, wf_name, param_hash, version)
+                self.entries.pop(key, None)
+            save_json(self.path, self.entries)
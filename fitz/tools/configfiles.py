@@ -0,0 +1,130 @@
+"""Load python configuration files once and cache the resolved values.
+
+Project, experiment and model files are plain python modules. Executing
+them is cheap but not free, and fitz used to do it several times per
+invocation. Resolved dictionaries are cached in memory keyed on file
+modification times, and on disk (under $FITZ_DIR/.fitz/config) keyed on
+file contents, the resolve function and the fitz version, so later
+invocations and worker processes can reuse them without running any
+configuration code.
+"""
+import os
+import re
+import copy
+import types
+import runpy
+import pickle
+import hashlib
+import os.path as op
+import fitz
+from fitz.tools.state import state_path
+
+# Bump when what the resolve functions return changes, so configurations
+# cached on disk by an older fitz aren't reused
+config_format = 2
+
+_memory_cache = {}
+
+
+def read_config_file(path):
+    """Execute a configuration file and return its public names as a dict.
+
+    Dunder names and imported modules are not part of the configuration.
+    """
+    namespace = runpy.run_path(path)
+    config = {k: v for k, v in namespace.items()
+              if not re.match("__.*__", k) and
+              not isinstance(v, types.ModuleType)}
+    config["__doc__"] = namespace.get("__doc__")
+    return config
+
+
+def _stat_key(paths):
+    key = []
+    for path in paths:
+        stat = os.stat(path)
+        key.append((op.abspath(path), stat.st_mtime, stat.st_size))
+    return tuple(key)
+
+
+def _resolver_name(resolve):
+    return "%s.%s" % (resolve.__module__, resolve.__qualname__)
+
+
+def _content_hash(name, paths):
+    version = "%s:%s:%d" % (name, fitz.__version__, config_format)
+    digest = hashlib.sha1(version.encode("utf-8"))
+    for path in paths:
+        digest.update(op.abspath(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cached_config(paths, resolve):
+    """Return resolve(*configs) for some configuration files, with caching.
+
+    Parameters
+    ----------
+    paths : list of strings
+        Configuration files to read, in the order passed to resolve.
+    resolve : function
+        Takes the dict of each file and returns the final configuration.
+
+    Returns
+    -------
+    config : dict
+        A private copy of the resolved configuration, safe to modify.
+    """
+    paths = list(paths)
+    for path in paths:
+        if not op.exists(path):
+            raise IOError("Configuration file %s does not exist." % path)
+
+    name = _resolver_name(resolve)
+    mem_key = (name, _stat_key(paths))
+    if mem_key not in _memory_cache:
+        disk_file = state_path("config", "%s.pkl" %
+                               _content_hash(name, paths))
+        try:
+            with open(disk_file, "rb") as f:
+                config = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            config = resolve(*[read_config_file(p) for p in paths])
+            try:
+                with open(disk_file, "wb") as f:
+                    pickle.dump(config, f, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # Configs that define functions or classes can only be
+                # cached in memory
+                os.remove(disk_file)
+        _memory_cache[mem_key] = config
+
+    return copy.deepcopy(_memory_cache[mem_key])
+
+
+def gather_project_info():
+    """Import project information based on environment settings."""
+    fitz_dir = os.environ["FITZ_DIR"]
+    proj_file = op.join(fitz_dir, "project.py")
+    return cached_config([proj_file], resolve_project)
+
+
+def resolve_project(project):
+    """Turn the contents of a project file into the project dictionary."""
+    fitz_dir = os.environ["FITZ_DIR"]
+    project_dict = dict()
+    for dir in ["data", "analysis", "working", "crash"]:
+        path = op.abspath(op.join(fitz_dir, project[dir + "_dir"]))
+        project_dict[dir + "_dir"] = path
+    project_dict["default_exp"] = project["default_exp"]
+    project_dict["rm_working_dir"] = project["rm_working_dir"]
+    project_dict["working_dir_budget"] = project.get("working_dir_budget")
+
+    if "ants_normalization" in project:
+        use_ants = project["ants_normalization"]
+        project_dict["normalization"] = "ants" if use_ants else "fsl"
+    else:
+        project_dict["normalization"] = "fsl"
+
+    return project_dict
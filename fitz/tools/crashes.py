@@ -0,0 +1,222 @@
+"""Index and summarize the nipype crash files of a project."""
+import os
+import re
+import sys
+import glob
+import time
+import os.path as op
+from concurrent.futures import ProcessPoolExecutor
+from fitz.tools.state import state_path, load_json, save_json
+from fitz.tools.profiling import node_subject
+from fitz.tools.configfiles import gather_project_info
+from fitz.tools.ledger import format_table, parse_since
+
+crash_name = re.compile(r"^crash-(\d{8})-(\d{6})-[^-]*-(.+?)-[0-9a-f-]{36}\.")
+
+
+def error_line(traceback):
+    """The last line of a traceback, i.e. the exception and its message."""
+    lines = [line.strip() for line in "".join(traceback).splitlines()]
+    lines = [line for line in lines if line]
+    return lines[-1] if lines else ""
+
+
+def error_signature(error, subject=None):
+    """Reduce an error message to what failures of the same kind share.
+
+    Paths, the subject id and numbers differ between subjects failing for
+    the same reason, so they are replaced by placeholders.
+    """
+    if subject:
+        error = error.replace(subject, "<subject>")
+    error = re.sub(r"(?<![\w.])(/[^\s'\":,]+)", "<path>", error)
+    error = re.sub(r"\b0x[0-9a-fA-F]+\b", "<addr>", error)
+    error = re.sub(r"\d+(\.\d+)?", "N", error)
+    return error[:200]
+
+
+def parse_crash_file(crash_file):
+    """Summarize one crash file as a dict (picklable, for worker processes).
+
+    Pickled crash files are unpickled with their node, which needs the
+    node's interface to be importable; text crash files are parsed.
+    """
+    match = crash_name.match(op.basename(crash_file))
+    summary = dict(file=crash_file, node=None, workflow=None, subject=None,
+                   error="", signature="", time=None)
+    if match is not None:
+        day, hms, node_id = match.groups()
+        summary["time"] = "%s-%s-%s %s:%s:%s" % (
+            day[:4], day[4:6], day[6:], hms[:2], hms[2:4], hms[4:])
+        summary["node"] = node_id
+
+    try:
+        if crash_file.endswith(".txt"):
+            with open(crash_file) as f:
+                text = f.read()
+            node = re.search(r"^Node: (\S+)", text, re.M)
+            if node is not None:
+                summary["node"] = node.group(1)
+            subject = re.search(r"_subject_id_([^/\s]+)", text)
+            if subject is not None:
+                summary["subject"] = subject.group(1)
+            traceback = [text.split("\n\n")[-1]]
+        else:
+            from nipype.utils.filemanip import loadcrash
+            crash = loadcrash(crash_file)
+            node = crash["node"]
+            summary["node"] = node.fullname
+            summary["subject"] = node_subject(node)
+            traceback = crash["traceback"]
+    except Exception as e:
+        summary["error"] = "Unreadable crash file (%s: %s)" % (
+            e.__class__.__name__, e)
+        summary["signature"] = error_signature(summary["error"])
+        return summary
+
+    if summary["node"] and "." in summary["node"]:
+        summary["workflow"] = summary["node"].split(".", 1)[0]
+    summary["error"] = error_line(traceback)
+    summary["signature"] = error_signature(summary["error"],
+                                           summary["subject"])
+    return summary
+
+
+class CrashIndex(object):
+    """Summaries of the crash files in a crash_dir, cached between calls.
+
+    Crash files are only parsed once; the summaries are kept in
+    $FITZ_DIR/.fitz/crashes.json and refreshed for files whose size or
+    mtime changed. New files are parsed in parallel.
+    """
+    def __init__(self, crash_dir):
+
+        self.crash_dir = crash_dir
+        self.index_file = state_path("crashes.json")
+
+    def update(self, n_jobs=None):
+        """Index new crash files and return all current summaries."""
+        index = load_json(self.index_file, {})
+        entries = index.get(self.crash_dir, {})
+
+        current, stale = {}, []
+        if op.isdir(self.crash_dir):
+            for entry in os.scandir(self.crash_dir):
+                if not entry.name.startswith("crash-"):
+                    continue
+                stat = entry.stat()
+                key = [stat.st_size, stat.st_mtime]
+                cached = entries.get(entry.path)
+                if cached is not None and cached["stat"] == key:
+                    current[entry.path] = cached
+                else:
+                    current[entry.path] = dict(stat=key)
+                    stale.append(entry.path)
+
+        if stale:
+            if len(stale) > 1 and n_jobs != 1:
+                with ProcessPoolExecutor(n_jobs) as pool:
+                    summaries = list(pool.map(parse_crash_file, stale,
+                                              chunksize=16))
+            else:
+                summaries = [parse_crash_file(f) for f in stale]
+            for crash_file, summary in zip(stale, summaries):
+                current[crash_file]["summary"] = summary
+
+        if stale or len(current) != len(entries):
+            index[self.crash_dir] = current
+            save_json(self.index_file, index)
+        return [entry["summary"] for entry in current.values()]
+
+
+def select_crashes(summaries, workflow=None, since=None):
+    """Crash summaries of a workflow and/or at or after a ledger time."""
+    selected = []
+    for summary in summaries:
+        if workflow is not None and summary["workflow"] != workflow:
+            continue
+        if since is not None and (summary["time"] or "") < since:
+            continue
+        selected.append(summary)
+    return selected
+
+
+def group_crashes(summaries):
+    """Group crashes by node and error signature, most frequent first.
+
+    Returns the columns and rows of a table of groups, with the number of
+    crashes and subjects, an example error and the latest crash file.
+    """
+    groups = {}
+    for summary in summaries:
+        key = (summary["node"] or "?", summary["signature"])
+        groups.setdefault(key, []).append(summary)
+
+    columns = ["node", "crashes", "subjects", "last", "error"]
+    rows = []
+    for (node, _), members in groups.items():
+        members.sort(key=lambda s: s["time"] or "")
+        subjects = set(s["subject"] for s in members if s["subject"])
+        rows.append((node, len(members), len(subjects),
+                     members[-1]["time"], members[-1]["error"][:100]))
+    rows.sort(key=lambda row: (-row[1], row[0]))
+    return columns, rows
+
+
+def crash_subjects(summaries):
+    """Crash counts per subject, most crashes first."""
+    counts = {}
+    for summary in summaries:
+        if summary["subject"]:
+            nodes = counts.setdefault(summary["subject"], set())
+            nodes.add(summary["node"])
+    return sorted(counts.items(), key=lambda kv: (-len(kv[1]), kv[0]))
+
+
+def write_rerun_list(subjects, fname):
+    """Write subject ids, one per line, as `fitz run -s` reads them."""
+    with open(fname, "w") as f:
+        f.write("# Subjects with crashes, %s\n" % time.strftime("%Y-%m-%d"))
+        for subj in subjects:
+            f.write(subj + "\n")
+
+
+def main(args):
+    """Summarize the crash files in the project"s crash_dir."""
+    project = gather_project_info()
+    crash_dir = args.crash_dir or project["crash_dir"]
+
+    # Pickled crash files hold their node, so pipeline interfaces must import
+    for workflows_dir in glob.glob(op.join(os.environ["FITZ_DIR"], "*",
+                                           "workflows")):
+        if workflows_dir not in sys.path:
+            sys.path.insert(0, workflows_dir)
+
+    summaries = CrashIndex(crash_dir).update(args.jobs)
+    since = parse_since(args.since) if args.since else None
+    summaries = select_crashes(summaries, args.workflow, since)
+    if not summaries:
+        print("No crash files in %s" % crash_dir)
+        return
+
+    subjects = crash_subjects(summaries)
+    columns, rows = group_crashes(summaries)
+    print("%d crash files in %s, %d kinds of failure, %d subjects" % (
+        len(summaries), crash_dir, len(rows), len(subjects)))
+    print("")
+    print(format_table(columns, rows[:args.n]))
+    if len(rows) > args.n:
+        print("... and %d more" % (len(rows) - args.n))
+    print("")
+    print(format_table(["subject", "failed nodes"],
+                       [(subj, ", ".join(sorted(nodes)))
+                        for subj, nodes in subjects]))
+
+    if args.rerun:
+        write_rerun_list([subj for subj, _ in subjects], args.rerun)
+        workflows = sorted(set(s["workflow"] for s in summaries
+                               if s["workflow"]))
+        print("")
+        print("Wrote %d subjects to %s; rerun them with:" %
+              (len(subjects), args.rerun))
+        print("    fitz run -s %s -w %s" % (args.rerun, " ".join(workflows)))
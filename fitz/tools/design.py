@@ -0,0 +1,99 @@
+"""Read long design files written by log2design.py."""
+import os
+import os.path as op
+import pandas as pd
+
+
+def design_format(design_file):
+    """Guess a design file format from its extension.
+
+    Directories are taken to be partitioned parquet datasets.
+    """
+    if op.isdir(design_file):
+        return "parquet"
+    ext = op.splitext(design_file)[1].lower()
+    if ext in [".parquet", ".pq"]:
+        return "parquet"
+    if ext in [".feather", ".arrow"]:
+        return "feather"
+    return "csv"
+
+
+def load_design(design_file, subject=None, columns=None,
+                subject_col="subject"):
+    """Load (part of) a long design file as a DataFrame.
+
+    Parameters
+    ----------
+    design_file : string
+        A csv, parquet or feather design file, or a parquet dataset
+        directory partitioned by subject (log2design.py --partition-col).
+    subject : string, optional
+        Only return the trials for this subject, if the design has a
+        subject column (or is partitioned by it).
+    columns : list of strings, optional
+        Only return these columns (e.g. ["run", "condition", "onset"]).
+        Columnar formats never read the data of the other columns, and
+        skip partitions and row groups of other subjects.
+    subject_col : string
+        Name of the column holding subject ids.
+
+    Returns
+    -------
+    design : DataFrame
+
+    """
+    fmt = design_format(design_file)
+    if fmt == "csv":
+        header = pd.read_csv(design_file, nrows=0).columns
+        names = list(header)
+        if columns is not None:
+            wanted = set(columns) | {subject_col}
+            names = [c for c in header if c in wanted]
+        design = pd.read_csv(design_file, usecols=names,
+                             dtype={subject_col: str})
+        if subject is not None and subject_col in design.columns:
+            keep = design[subject_col].astype(str) == str(subject)
+            design = design[keep].reset_index(drop=True)
+        if columns is not None:
+            design = design[[c for c in columns if c in design.columns]]
+        return design
+
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise ImportError("Reading %s designs requires pyarrow "
+                          "(pip install pyarrow)." % fmt)
+
+    if fmt == "feather":
+        # Uncompressed feather files are memory-mapped rather than read
+        dataset = ds.dataset(design_file, format="ipc")
+    else:
+        # Subject ids are strings even where they look like numbers (and
+        # "01" shouldn't become 1), so their partitions aren't inferred
+        if op.isdir(design_file) and any(
+                name.startswith(subject_col + "=")
+                for name in os.listdir(design_file)):
+            partitioning = ds.partitioning(
+                pa.schema([(subject_col, pa.string())]), flavor="hive")
+        else:
+            partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+        dataset = ds.dataset(design_file, format="parquet",
+                             partitioning=partitioning)
+    names = dataset.schema.names
+
+    row_filter = None
+    if subject is not None and subject_col in names:
+        subj_type = dataset.schema.field(subject_col).type
+        if pa.types.is_dictionary(subj_type):
+            subj_type = subj_type.value_type
+        row_filter = ds.field(subject_col)
+        if pa.types.is_integer(subj_type) and str(subject).isdigit():
+            row_filter = row_filter == int(subject)
+        else:
+            row_filter = row_filter.cast(pa.string()) == str(subject)
+
+    if columns is not None:
+        names = [c for c in columns if c in names]
+    return dataset.to_table(columns=names, filter=row_filter).to_pandas()
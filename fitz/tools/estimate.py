@@ -0,0 +1,145 @@
+"""Estimate what a fitz run would compute, without running anything."""
+from copy import deepcopy
+import networkx as nx
+from nipype import config
+from nipype.pipeline.engine.utils import generate_expanded_graph, merge_dict
+from fitz.tools.profiling import node_subject
+from fitz.tools.workdir import format_size
+
+
+def expand_workflow(workflow):
+    """Return the flat execution graph that Workflow.run would execute.
+
+    Iterables (e.g. subjects) are expanded into separate nodes, and every
+    node knows its working directory and the result files its inputs come
+    from, just as in a real run.
+    """
+    flatgraph = workflow._create_flat_graph()
+    wf_config = merge_dict(deepcopy(config._sections), workflow.config)
+    workflow._set_needed_outputs(flatgraph)
+    execgraph = generate_expanded_graph(flatgraph)
+    for index, node in enumerate(execgraph.nodes()):
+        node.config = merge_dict(deepcopy(wf_config), node.config)
+        node.base_dir = workflow.base_dir
+        node.index = index
+    workflow._configure_exec_nodes(execgraph)
+    return execgraph
+
+
+def node_is_cached(node):
+    """True if the node's working dir has results for its current inputs."""
+    try:
+        node._get_inputs()
+        if hasattr(node, "is_cached"):
+            # Results whose inputs changed are there, but outdated
+            cached, updated = node.is_cached()
+            return cached and updated
+        return node.hash_exists()[0]
+    except Exception:
+        return False
+
+
+def cost_order(item):
+    """Sort key putting the (name, totals) with most work to do first."""
+    name, total = item
+    return -total["cpu_s"], total["cached"] - total["nodes"], str(name)
+
+
+class DryRunEstimate(object):
+    """Collect what each workflow of a --dontrun run would execute.
+
+    Nodes are costed with the averages recorded by earlier --profile runs
+    (see load_node_history); nodes without history count as unknown.
+    """
+    def __init__(self, history):
+
+        self.history = history
+        self.records = []
+
+    def add_workflow(self, workflow, wf_name):
+        """Expand a workflow and record every node it would run."""
+        execgraph = expand_workflow(workflow)
+        recomputed = set()
+        for node in nx.topological_sort(execgraph):
+            # Nodes downstream of a recomputed node get new inputs, so they
+            # can't be trusted to hit the cache either. Nodes that always
+            # run (e.g. data grabbers) usually reproduce their old outputs,
+            # so they don't invalidate what comes after them.
+            upstream = set(execgraph.predecessors(node))
+            if upstream & recomputed or not node_is_cached(node):
+                recomputed.add(node)
+            always_run = (node.overwrite or
+                          getattr(node.interface, "always_run", False))
+            cached = node not in recomputed and not always_run
+
+            estimate = self.history.get(node.fullname, {})
+            self.records.append(dict(
+                workflow=wf_name, subject=node_subject(node),
+                node=node.fullname, cached=cached,
+                wall_s=estimate.get("wall_s"),
+                cpu_s=estimate.get("cpu_s"),
+                peak_rss_gb=estimate.get("max_rss_gb"),
+                output_bytes=estimate.get("output_bytes")))
+
+    def totals(self, key):
+        """Sum the records grouped by a record field (e.g. "workflow")."""
+        totals = {}
+        for rec in self.records:
+            total = totals.setdefault(rec[key], dict(
+                nodes=0, cached=0, cpu_s=0., wall_s=0.,
+                peak_rss_gb=0., output_bytes=0, new_bytes=0))
+            total["nodes"] += 1
+            total["output_bytes"] += rec["output_bytes"] or 0
+            if rec["cached"]:
+                total["cached"] += 1
+                continue
+            total["wall_s"] += rec["wall_s"] or 0.
+            total["cpu_s"] += rec["cpu_s"] or rec["wall_s"] or 0.
+            total["peak_rss_gb"] = max(total["peak_rss_gb"],
+                                       rec["peak_rss_gb"] or 0.)
+            total["new_bytes"] += rec["output_bytes"] or 0
+        return totals
+
+    def summary(self, n_top=10):
+        """Return a text report of nodes, cache hits and estimated cost."""
+        header = "%-30s %7s %7s %7s %9s %9s %8s %10s" % (
+            "", "nodes", "cached", "run", "CPU-h", "wall-h", "peak GB",
+            "new disk")
+
+        def line(name, total):
+            return "%-30s %7d %7d %7d %9.2f %9.2f %8.2f %10s" % (
+                name[:30], total["nodes"], total["cached"],
+                total["nodes"] - total["cached"], total["cpu_s"] / 3600.,
+                total["wall_s"] / 3600., total["peak_rss_gb"],
+                format_size(total["new_bytes"]))
+
+        lines = ["Dry run estimate", header]
+        workflows = self.totals("workflow")
+        for wf_name in sorted(workflows):
+            lines.append(line(wf_name, workflows[wf_name]))
+
+        subjects = self.totals("subject")
+        top = sorted(subjects.items(), key=cost_order)
+        lines.extend(["", "Most expensive subjects", header])
+        for subj, total in top[:n_top]:
+            lines.append(line(str(subj), total))
+
+        nodes = self.totals("node")
+        rerun = [kv for kv in nodes.items() if kv[1]["nodes"] > kv[1]["cached"]]
+        rerun.sort(key=cost_order)
+        lines.extend(["", "Nodes to recompute (%d)" % len(rerun), header])
+        for name, total in rerun[:n_top]:
+            lines.append(line(name.split(".", 1)[-1], total))
+
+        n_nodes = len(self.records)
+        n_cached = sum(rec["cached"] for rec in self.records)
+        n_unknown = sum(1 for rec in self.records
+                        if not rec["cached"] and rec["wall_s"] is None)
+        lines.append("")
+        lines.append("%d of %d nodes would be reused from the cache, %d "
+                     "recomputed." % (n_cached, n_nodes, n_nodes - n_cached))
+        if n_unknown:
+            lines.append("%d nodes to recompute have no recorded history; "
+                         "profile a run with --profile to cost them." %
+                         n_unknown)
+        return "\n".join(lines)
@@ -0,0 +1,103 @@
+"""Render workflow graphs in the background, cached by their contents."""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import os.path as op
+from nipype.pipeline.engine.utils import format_dot
+from fitz.tools.state import state_path
+
+
+def workflow_dot(workflow, graph2use="hierarchical"):
+    """Return the graphviz dot source of a workflow graph.
+
+    Building the dot source is quick; it's running graphviz on it that can
+    take minutes for workflows iterated over many subjects.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dot_file = workflow.write_graph(op.join(tmp_dir, "graph.dot"),
+                                        graph2use=graph2use, format="dot")
+        with open(dot_file) as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def render_graph(dot, out_file, format="svg"):
+    """Render dot source to out_file with graphviz.
+
+    Renderings are cached in $FITZ_DIR/.fitz/graphs by a hash of the dot
+    source, so a graph that didn't change is only copied into place.
+    """
+    digest = hashlib.sha1(dot.encode("utf-8")).hexdigest()
+    cached = state_path("graphs", "%s.%s" % (digest, format))
+    if not op.exists(cached):
+        # Render under a private name and move it into place, so concurrent
+        # renderings of the same graph never see a half-written file
+        tmp_base = state_path("graphs", "%s.%d.%d" % (
+            digest, os.getpid(), threading.current_thread().ident))
+        with open(tmp_base + ".dot", "w") as f:
+            f.write(dot)
+        try:
+            if format == "dot":
+                # The source is its own rendering (format_dot returns it)
+                rendered = tmp_base + ".dot"
+            else:
+                rendered = format_dot(tmp_base + ".dot", format)
+            os.rename(rendered, cached)
+        finally:
+            if op.exists(tmp_base + ".dot"):
+                os.remove(tmp_base + ".dot")
+
+    parent = op.dirname(out_file)
+    if parent and not op.isdir(parent):
+        os.makedirs(parent)
+    shutil.copyfile(cached, out_file)
+    return out_file
+
+
+class GraphRenderer(object):
+    """Render workflow graphs in background threads while workflows run.
+
+    The dot source is taken from the workflow right away, so later changes
+    to the workflow (or running it) don't affect the picture.
+    """
+    def __init__(self, graph_dir, format="svg", graph2use="hierarchical"):
+
+        self.graph_dir = graph_dir
+        self.format = format
+        self.graph2use = graph2use
+        self.threads = []
+        self.out_files = []
+        self.errors = []
+
+    def add(self, workflow, name=None):
+        """Start rendering a workflow graph to <graph_dir>/<name>.<format>."""
+        dot = workflow_dot(workflow, self.graph2use)
+        out_file = op.join(self.graph_dir,
+                           "%s.%s" % (name or workflow.name, self.format))
+        thread = threading.Thread(target=self._render, args=(dot, out_file))
+        thread.start()
+        self.threads.append(thread)
+        self.out_files.append(out_file)
+        return out_file
+
+    def _render(self, dot, out_file):
+
+        try:
+            render_graph(dot, out_file, self.format)
+        except Exception as e:
+            self.errors.append((out_file, e))
+
+    def join(self):
+        """Wait for all renderings and return the files written."""
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        failed = set()
+        for out_file, error in self.errors:
+            print("Could not render workflow graph %s: %s" % (out_file, error))
+            failed.add(out_file)
+        return [f for f in self.out_files if f not in failed]
@@ -1,5 +1,8 @@
+import re
+import ast
+import weakref
+import operator
 import os.path as op
-import networkx as nx
 from nipype import Workflow, MapNode, Node, IdentityInterface
 from nipype.interfaces.base import (  # BaseInterfaceInputSpec,
                                     TraitedSpec,
@@ -26,12 +29,12 @@ class InputWrapper(object):
                             self.in_node, "subject_id")
 
         # Connect the datagrabber outputs to the workflow inputs
-        grabbed = self.grab_node.outputs.get()
-        inputs = self.in_node.inputs.get()
-        for field in grabbed:
-            if field in inputs:
-                self.wf.connect(self.grab_node, field,
-                                self.in_node, field)
+        inputs = set(io_fields(self.in_node, "inputs"))
+        fields = [f for f in io_fields(self.grab_node, "outputs")
+                  if f in inputs]
+        if fields:
+            self.wf.connect([(self.grab_node, self.in_node,
+                              [(field, field) for field in fields])])
 
 
 class OutputWrapper(object):
@@ -45,30 +48,40 @@ class OutputWrapper(object):
 
     def set_mapnode_substitutions(self, n_runs, template_pattern="run_%d",
                                   template_args="r + 1"):
-        """Find mapnode names and add datasink substitutions to sort by run."""
-
-        # First determine top-level mapnode names
-        mapnode_names = find_mapnodes(self.wf)
-
-        # Then determine mapnode names for each nested workflow
-        # Note that this currently only works for one level of nesting
-        nested_workflows = find_nested_workflows(self.wf)
-        for wf in nested_workflows:
-            mapnode_names.extend(find_mapnodes(wf))
-
-        # Build a list of substitution tuples
-        substitutions = []
-        for r in reversed(list(range(n_runs))):
-            templ_args = eval('(%s)' % template_args)
-            for name in mapnode_names:
-                substitutions.append(("_%s%d" % (name, r),
-                                      template_pattern % templ_args))
-
-        # Set the substitutions attribute on the DataSink node
-        if isdefined(self.sink_node.inputs.substitutions):
-            self.sink_node.inputs.substitutions.extend(substitutions)
-        else:
-            self.sink_node.inputs.substitutions = substitutions
+        """Find mapnode names and add datasink substitutions to sort by run.
+
+        template_args maps the 0-based mapnode index r to the arguments of
+        template_pattern, either as a function of r or as a string like
+        "r + 1" or "r, r + 1" (see run_template_args).
+
+        The run directories are renamed by regexp_substitutions that go
+        ahead of any others. DataSink applies all plain substitutions
+        before any regexp_substitutions, so plain substitutions see the
+        original _<mapnode><r> directories, whenever they were added, and
+        regexp_substitutions see the renamed ones. To match the run_N
+        names, use add_regexp_substitutions.
+
+        """
+        if not callable(template_args):
+            template_args = run_template_args(template_args)
+
+        # Mapnode names of the workflow and all of its nested workflows
+        mapnode_names = sorted(set(find_mapnodes(self.wf, nested=True)))
+        if not mapnode_names:
+            return
+
+        # One regular expression per run matches the mapnode directories
+        # of every mapnode at once; the lookahead keeps _name1 from matching
+        # _name10 so the runs don't need to be substituted in reverse order
+        names = "|".join(re.escape(name) for name in mapnode_names)
+        substitutions = [("_(?:%s)%d(?![0-9])" % (names, r),
+                          template_pattern % template_args(r))
+                         for r in range(n_runs)]
+
+        # Rename the run directories before any other regexp substitutions
+        if isdefined(self.sink_node.inputs.regexp_substitutions):
+            substitutions.extend(self.sink_node.inputs.regexp_substitutions)
+        self.sink_node.inputs.regexp_substitutions = substitutions
 
     def add_regexp_substitutions(self, sub_list):
         """Safely set subsitutions implemented with regular expressions."""
@@ -95,33 +108,160 @@ class OutputWrapper(object):
 
     def sink_outputs(self, dir_name=None):
         """Connect the outputs of a workflow to a datasink."""
-        outputs = self.out_node.outputs.get()
+        outputs = io_fields(self.out_node, "outputs")
         prefix = "@" if dir_name is None else dir_name + ".@"
-        for field in outputs:
-            self.wf.connect(self.out_node, field,
-                            self.sink_node, prefix + field)
-
-
-def find_mapnodes(workflow):
-    """Given a workflow, return a list of MapNode names."""
-    mapnode_names = []
-    wf_nodes = nx.nodes(workflow._graph)
-    for node in wf_nodes:
-        if isinstance(node, MapNode):
-            mapnode_names.append(node.name)
-
-    return mapnode_names
-
-
-def find_nested_workflows(workflow):
-    """Given a workflow, find nested workflow objects."""
-    nested_workflows = []
-    wf_nodes = nx.nodes(workflow._graph)
-    for node in wf_nodes:
-        if isinstance(node, Workflow):
-            nested_workflows.append(node)
-
-    return nested_workflows
+        if outputs:
+            self.wf.connect([(self.out_node, self.sink_node,
+                              [(field, prefix + field) for field in outputs])])
+
+
+class GraphIndex(object):
+    """Catalog of every node of a workflow and its nested workflows.
+
+    The graph is walked once, recursively, recording each node's dotted
+    fullname (as in nipype's hierarchy, e.g. preproc.realign), nesting
+    depth and type. Use GraphIndex.of(workflow) to get the cached index of
+    a workflow, which is only rebuilt after nodes or connections change.
+    """
+    _cache = weakref.WeakKeyDictionary()
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.entries = []
+        self._graphs = []
+        self._walk(workflow, workflow.name, 0)
+        self._signature = self._graph_signature()
+
+    @classmethod
+    def of(cls, workflow):
+        """Return the (cached) index of a workflow."""
+        index = cls._cache.get(workflow)
+        if index is None or not index.is_current():
+            index = cls._cache[workflow] = cls(workflow)
+        return index
+
+    def _walk(self, workflow, prefix, depth):
+        self._graphs.append(workflow._graph)
+        for node in workflow._graph.nodes():
+            fullname = "%s.%s" % (prefix, node.name)
+            self.entries.append((fullname, node, depth))
+            if isinstance(node, Workflow):
+                self._walk(node, fullname, depth + 1)
+
+    def _graph_signature(self):
+        return [(len(graph), graph.number_of_edges())
+                for graph in self._graphs]
+
+    def is_current(self):
+        """True unless a node or connection was added since indexing."""
+        return self._graph_signature() == self._signature
+
+    def find(self, kind=None, max_depth=None):
+        """Return indexed nodes of a type, down to a nesting depth.
+
+        Depth 0 is the workflow itself; max_depth=None includes every
+        nested workflow.
+        """
+        return [node for _, node, depth in self.entries
+                if (kind is None or isinstance(node, kind)) and
+                (max_depth is None or depth <= max_depth)]
+
+    def mapnode_names(self, max_depth=None):
+        """Names of the MapNodes down to a nesting depth."""
+        return [node.name for node in self.find(MapNode, max_depth)]
+
+    def nested_workflows(self, max_depth=None):
+        """Workflows nested down to a nesting depth."""
+        return self.find(Workflow, max_depth)
+
+    def iter_nodes(self):
+        """Yield (fullname, node) for every node that isn't a workflow."""
+        for fullname, node, _ in self.entries:
+            if not isinstance(node, Workflow):
+                yield fullname, node
+
+    def with_field(self, field, kind="inputs"):
+        """Return the nodes (not workflows) having an input/output field."""
+        return [node for _, node in self.iter_nodes()
+                if field in io_fields(node, kind)]
+
+
+_field_cache = weakref.WeakKeyDictionary()
+
+
+def io_fields(node, kind="inputs"):
+    """Return the input or output field names of a node, in order.
+
+    Field names are fixed when a node is created, so they are looked up
+    once per node instead of copying the trait values on every query.
+    """
+    fields = _field_cache.get(node)
+    if fields is None:
+        fields = _field_cache[node] = dict(
+            inputs=tuple(node.inputs.copyable_trait_names()),
+            outputs=tuple(node.outputs.copyable_trait_names()
+                          if node.outputs is not None else ()))
+    return fields[kind]
+
+
+def find_mapnodes(workflow, nested=False):
+    """Given a workflow, return a list of MapNode names.
+
+    With nested=True, MapNodes of nested workflows (at any depth) are
+    included as well.
+    """
+    return GraphIndex.of(workflow).mapnode_names(None if nested else 0)
+
+
+# Operations allowed in template_args expressions
+_template_ops = {ast.Add: operator.add, ast.Sub: operator.sub,
+                 ast.Mult: operator.mul, ast.FloorDiv: operator.floordiv,
+                 ast.Mod: operator.mod, ast.USub: operator.neg,
+                 ast.UAdd: operator.pos}
+
+
+def _template_value(node, r):
+    """Evaluate a parsed template_args expression for the run index r."""
+    if isinstance(node, ast.Expression):
+        return _template_value(node.body, r)
+    if isinstance(node, ast.Tuple):
+        return tuple(_template_value(elt, r) for elt in node.elts)
+    if isinstance(node, ast.BinOp) and type(node.op) in _template_ops:
+        return _template_ops[type(node.op)](_template_value(node.left, r),
+                                            _template_value(node.right, r))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _template_ops:
+        return _template_ops[type(node.op)](_template_value(node.operand, r))
+    if isinstance(node, ast.Name) and node.id == "r":
+        return r
+    if (isinstance(node, ast.Constant) and isinstance(node.value, int) and
+            not isinstance(node.value, bool)):
+        return node.value
+    raise ValueError
+
+
+def run_template_args(template_args):
+    """Turn a string like "r + 1" into a function of the run index r.
+
+    The string is an integer expression of r, or a comma separated tuple
+    of them, as the template_args that used to be evaluated. It is parsed
+    rather than evaluated, so only +, -, *, // and % are understood.
+    """
+    error = ValueError("Can't understand mapnode template args %r; "
+                       "pass a function of r instead." % template_args)
+    try:
+        expression = ast.parse("(%s)" % template_args, mode="eval")
+        _template_value(expression, 0)
+    except (SyntaxError, ValueError, ZeroDivisionError):
+        raise error
+    return lambda r: _template_value(expression, r)
+
+
+def find_nested_workflows(workflow, nested=False):
+    """Given a workflow, find nested workflow objects.
+
+    With nested=True, workflows nested at any depth are included.
+    """
+    return GraphIndex.of(workflow).nested_workflows(None if nested else 0)
 
 
 def make_subject_source(subject_list):
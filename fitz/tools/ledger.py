@@ -0,0 +1,315 @@
+"""SQLite ledger of every `fitz run` and the nodes it executed."""
+import os
+import re
+import sys
+import time
+import socket
+import sqlite3
+import getpass
+from datetime import datetime, timezone
+from fitz.tools.state import state_path
+from fitz.tools.profiling import node_record, is_map_subnode, map_parent
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT,
+    finished TEXT,
+    status TEXT,
+    command TEXT,
+    experiment TEXT,
+    model TEXT,
+    exp_hash TEXT,
+    plugin TEXT,
+    workflows TEXT,
+    n_subjects INTEGER,
+    user TEXT,
+    host TEXT
+);
+CREATE TABLE IF NOT EXISTS run_subjects (
+    run_id INTEGER REFERENCES runs(id),
+    subject TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    run_id INTEGER REFERENCES runs(id),
+    workflow TEXT,
+    subject TEXT,
+    node TEXT,
+    interface TEXT,
+    status TEXT,
+    finished TEXT,
+    wall_s REAL,
+    cpu_s REAL,
+    peak_rss_gb REAL,
+    output_dir TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_run ON nodes (run_id);
+CREATE INDEX IF NOT EXISTS nodes_subject ON nodes (workflow, subject);
+CREATE INDEX IF NOT EXISTS run_subjects_run ON run_subjects (run_id);
+"""
+
+time_format = "%Y-%m-%d %H:%M:%S"
+since_units = dict(m=60, h=3600, d=86400, w=7 * 86400)
+
+
+def now():
+    return time.strftime(time_format)
+
+
+def parse_since(since):
+    """Turn '7d', '12h', '2w', '30m' or a date into a ledger timestamp."""
+    match = re.match(r"^(\d+(?:\.\d+)?)([mhdw])$", since)
+    if match is None:
+        # Dates and times in the ledger's own format compare as strings
+        return since
+    seconds = float(match.group(1)) * since_units[match.group(2)]
+    return time.strftime(time_format, time.localtime(time.time() - seconds))
+
+
+class RunLedger(object):
+    """Append-only record of fitz runs, kept in $FITZ_DIR/.fitz/ledger.db.
+
+    Used as a status callback, a ledger records every node that finished or
+    failed in its current run; nodes found cached are recorded as such,
+    without the usage of the run that produced them. Each process opens its
+    own connection, so a ledger can be handed to stage workers; SQLite
+    serializes the writers.
+    """
+    def __init__(self, path=None, run_id=None):
+
+        self.path = path or state_path("ledger.db")
+        self.run_id = run_id
+        self.since = datetime.now(timezone.utc)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=60)
+            # $FITZ_DIR is often on NFS, where WAL's shared memory index
+            # doesn't work, so keep the default rollback journal (and turn
+            # WAL off again in ledgers created while it was used)
+            mode, = self._db.execute("PRAGMA journal_mode").fetchone()
+            if mode == "wal":
+                try:
+                    self._db.execute("PRAGMA journal_mode=DELETE")
+                except sqlite3.OperationalError:
+                    pass
+            self._db.executescript(schema)
+        return self._db
+
+    def __getstate__(self):
+
+        return dict(path=self.path, run_id=self.run_id, since=self.since,
+                    _db=None)
+
+    def start_run(self, args, exp, subjects, exp_hash=None):
+        """Record the start of a run and make it the current run."""
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (started, status, command, experiment, "
+                "model, exp_hash, plugin, workflows, n_subjects, user, host) "
+                "VALUES (?, 'running', ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now(), " ".join(sys.argv), exp["exp_name"],
+                 exp["model_name"], exp_hash, args.plugin,
+                 ",".join(args.workflows), len(subjects), getpass.getuser(),
+                 socket.gethostname()))
+            self.run_id = cursor.lastrowid
+            self.db.executemany(
+                "INSERT INTO run_subjects (run_id, subject) VALUES (?, ?)",
+                [(self.run_id, subj) for subj in subjects])
+        return self.run_id
+
+    def finish_run(self, status):
+        """Record how the current run ended ('done' or 'failed')."""
+        with self.db:
+            self.db.execute("UPDATE runs SET finished = ?, status = ? "
+                            "WHERE id = ?", (now(), status, self.run_id))
+
+    def __call__(self, node, status, wf_name):
+
+        if status not in ("end", "exception"):
+            return
+        # MapNodes are recorded when they end, but under MultiProc they
+        # fail in their subnodes, so failures are charged to the MapNode
+        is_subnode = is_map_subnode(node)
+        if is_subnode and status == "end":
+            return
+        rec = node_record(node, status, wf_name, measure_output=False,
+                          since=self.since)
+        if is_subnode:
+            rec["node"], rec["subject"] = map_parent(node, wf_name)
+        try:
+            output_dir = node.output_dir()
+            if is_subnode:
+                output_dir = os.path.dirname(node.base_dir)
+        except Exception:
+            output_dir = None
+        with self.db:
+            self.db.execute(
+                "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, wf_name, rec["subject"], rec["node"],
+                 rec["interface"], "failed" if status == "exception" else
+                 "cached" if rec["status"] == "cached" else "done", now(),
+                 rec["wall_s"], rec["cpu_s"],
+                 rec["peak_rss_gb"], output_dir))
+
+    def query(self, sql, params=()):
+        """Run a query, returning the column names and rows."""
+        cursor = self.db.execute(sql, params)
+        columns = [d[0] for d in cursor.description or []]
+        return columns, cursor.fetchall()
+
+    def recent_runs(self, n=20):
+        """The last n runs, newest first."""
+        return self.query(
+            "SELECT id, started, finished, status, experiment, model, "
+            "plugin, workflows, n_subjects FROM runs "
+            "ORDER BY id DESC LIMIT ?", (n,))
+
+    def failures(self, workflow=None, since=None):
+        """Subjects with failed nodes, per workflow, newest failure first."""
+        sql = ("SELECT nodes.workflow, nodes.subject, "
+               "COUNT(*) AS failed_nodes, "
+               "GROUP_CONCAT(DISTINCT nodes.node) AS nodes, "
+               "MAX(nodes.finished) AS last_failure, "
+               "MAX(nodes.run_id) AS run_id "
+               "FROM nodes WHERE status = 'failed'")
+        params = []
+        if workflow is not None:
+            sql += " AND workflow = ?"
+            params.append(workflow)
+        if since is not None:
+            sql += " AND finished >= ?"
+            params.append(parse_since(since))
+        sql += (" GROUP BY nodes.workflow, nodes.subject "
+                "ORDER BY last_failure DESC")
+        return self.query(sql, params)
+
+    def last_node(self):
+        """Row id of the latest node record, to find records added later."""
+        _, rows = self.query("SELECT MAX(rowid) FROM nodes")
+        return rows[0][0] or 0
+
+    def failed_since(self, mark, workflow=None):
+        """Subjects with nodes of the current run that failed after a mark."""
+        sql = ("SELECT DISTINCT subject FROM nodes WHERE run_id = ? AND "
+               "rowid > ? AND status = 'failed' AND subject IS NOT NULL")
+        params = [self.run_id, mark]
+        if workflow is not None:
+            sql += " AND workflow = ?"
+            params.append(workflow)
+        _, rows = self.query(sql, params)
+        return set(row[0] for row in rows)
+
+    def failed_subjects(self, workflows=None, experiment=None, model=None):
+        """Subjects whose latest run of a workflow failed.
+
+        Only runs of the experiment and model are considered, if given.
+        Returns a dict mapping each subject to the number of runs in a row
+        it failed in (the most for any of the workflows).
+        """
+        sql = ("SELECT workflow, subject, run_id, "
+               "SUM(nodes.status = 'failed') "
+               "FROM nodes JOIN runs ON runs.id = nodes.run_id "
+               "WHERE subject IS NOT NULL")
+        params = []
+        if experiment is not None:
+            sql += " AND experiment = ?"
+            params.append(experiment)
+        if model is not None:
+            sql += " AND model = ?"
+            params.append(model)
+        if workflows:
+            sql += " AND workflow IN (%s)" % ", ".join("?" * len(workflows))
+            params.extend(workflows)
+        sql += " GROUP BY workflow, subject, run_id ORDER BY run_id DESC"
+        _, rows = self.query(sql, params)
+
+        streaks, finished = {}, set()
+        for wf_name, subject, _, n_failed in rows:
+            if (wf_name, subject) in finished:
+                continue
+            if not n_failed:
+                finished.add((wf_name, subject))
+                continue
+            streaks[(wf_name, subject)] = streaks.get((wf_name, subject),
+                                                      0) + 1
+
+        failures = {}
+        for (_, subject), n_runs in streaks.items():
+            failures[subject] = max(n_runs, failures.get(subject, 0))
+        return failures
+
+    def runtimes(self, workflow=None, since=None, group_by=None):
+        """Median and total wall time of successful subject workflows.
+
+        Runs that found some of a subject's nodes cached didn't take the
+        full time, and are left out.
+
+        Subjects are grouped by the first group (or the whole match) of the
+        group_by regular expression, e.g. '^(\\w+?)_' for a site prefix;
+        subjects it doesn't match are grouped under ''.
+        """
+        import numpy as np
+        sql = ("SELECT workflow, subject, run_id, SUM(wall_s), "
+               "SUM(status != 'done') FROM nodes WHERE subject IS NOT NULL")
+        params = []
+        if workflow is not None:
+            sql += " AND workflow = ?"
+            params.append(workflow)
+        if since is not None:
+            sql += " AND finished >= ?"
+            params.append(parse_since(since))
+        sql += " GROUP BY workflow, subject, run_id"
+        _, rows = self.query(sql, params)
+
+        pattern = re.compile(group_by) if group_by else None
+        groups = {}
+        for wf_name, subject, _, wall_s, n_other in rows:
+            if n_other or wall_s is None:
+                continue
+            key = ""
+            if pattern is not None:
+                match = pattern.search(subject)
+                if match is not None:
+                    key = match.group(1) if match.groups() else match.group()
+            groups.setdefault((wf_name, key), []).append(wall_s)
+
+        columns = ["workflow", "group", "n", "median_s", "total_h"]
+        rows = [(wf_name, key, len(walls), float(np.median(walls)),
+                 sum(walls) / 3600.)
+                for (wf_name, key), walls in sorted(groups.items())]
+        return columns, rows
+
+
+def format_table(columns, rows):
+    """Return query results as a plain text table."""
+    def fmt(value):
+        if isinstance(value, float):
+            return "%.1f" % value
+        return "" if value is None else str(value)
+
+    cells = [[fmt(v) for v in row] for row in rows]
+    widths = [max([len(c)] + [len(row[i]) for row in cells])
+              for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths)),
+             "  ".join("-" * w for w in widths)]
+    lines.extend("  ".join(v.ljust(w) for v, w in zip(row, widths))
+                 for row in cells)
+    return "\n".join(line.rstrip() for line in lines)
+
+
+def main(args):
+    """Query the ledger of past fitz runs."""
+    ledger = RunLedger()
+    if args.query == "runs":
+        columns, rows = ledger.recent_runs(args.n)
+    elif args.query == "failures":
+        columns, rows = ledger.failures(args.workflow, args.since)
+    elif args.query == "runtimes":
+        columns, rows = ledger.runtimes(args.workflow, args.since,
+                                        args.group_by)
+    else:
+        columns, rows = ledger.query(args.sql)
+    print(format_table(columns, rows))
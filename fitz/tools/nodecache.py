@@ -0,0 +1,107 @@
+"""Content-addressed node cache shared by all experiments and models.
+
+Nipype only reuses a node's results if they sit in that node's own working
+directory, so two models of an experiment (which run in separate working
+trees) recompute identical nodes. The shared cache stores finished node
+directories keyed by interface, node name and nipype's input hash, and
+links them into place before a node with the same key would run. Nipype
+then finds its results already cached.
+
+Keys are only content addressed when nipype hashes input files by content,
+so enabling the cache switches the execution hash_method to "content".
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import os.path as op
+
+# Interfaces that are cheap or whose effects live outside the node directory
+uncached_interfaces = ["IdentityInterface", "DataSink", "DataGrabber",
+                       "SelectFiles"]
+
+
+def link_tree(src, dst):
+    """Recreate a directory tree with hard links, copying across devices."""
+    for root, dirs, files in os.walk(src):
+        dest_root = op.join(dst, op.relpath(root, src))
+        if not op.isdir(dest_root):
+            os.makedirs(dest_root)
+        for fname in files:
+            src_file = op.join(root, fname)
+            dest_file = op.join(dest_root, fname)
+            try:
+                os.link(src_file, dest_file)
+            except OSError:
+                shutil.copy2(src_file, dest_file)
+
+
+class SharedNodeCache(object):
+    """Status callback that restores and publishes node results."""
+    def __init__(self, root):
+
+        self.root = root
+        self.hits = 0
+        self.published = 0
+
+    def key(self, node):
+        """Return the cache key for a node, or None if it isn't cached."""
+        interface = node.interface.__class__
+        if (interface.__name__ in uncached_interfaces or node.overwrite or
+                node.run_without_submitting):
+            return None
+        _, hashvalue = node._get_hashval()
+        ident = "%s.%s:%s:%s" % (interface.__module__, interface.__name__,
+                                 node.name, hashvalue)
+        return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+    def entry(self, key):
+        return op.join(self.root, key[:2], key)
+
+    def __call__(self, node, status, wf_name):
+
+        try:
+            if status == "start":
+                self.restore(node)
+            elif status == "end":
+                self.publish(node)
+        except Exception as err:
+            # The cache is an optimization; never let it break a run
+            print("Shared cache skipped %s: %s" % (node.fullname, err))
+
+    def restore(self, node):
+        """Link a cached result into the node's directory if there is one."""
+        key = self.key(node)
+        if key is None or not op.isdir(self.entry(key)):
+            return
+        cached, updated = node.is_cached()
+        if cached and updated:
+            return
+        outdir = node.output_dir()
+        if op.exists(outdir):
+            shutil.rmtree(outdir)
+        link_tree(self.entry(key), outdir)
+        self.hits += 1
+
+    def publish(self, node):
+        """Store a finished node's directory in the cache."""
+        key = self.key(node)
+        if key is None or op.isdir(self.entry(key)):
+            return
+        outdir = node.output_dir()
+        if not op.exists(op.join(outdir, "result_%s.pklz" % node.name)):
+            return
+
+        # Build the entry beside its final location and move it in whole,
+        # so readers never see a partial entry
+        parent = op.dirname(self.entry(key))
+        if not op.isdir(parent):
+            os.makedirs(parent)
+        tmp_dir = tempfile.mkdtemp(dir=parent)
+        link_tree(outdir, tmp_dir)
+        try:
+            os.rename(tmp_dir, self.entry(key))
+            self.published += 1
+        except OSError:
+            # Another process published the same entry first
+            shutil.rmtree(tmp_dir)
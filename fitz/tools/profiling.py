@@ -0,0 +1,253 @@
+"""Collect per-node runtime and memory usage from fitz runs."""
+import os
+import csv
+import json
+import fcntl
+import os.path as op
+from datetime import datetime, timezone
+from fitz.tools.state import state_path, load_json, save_json
+
+profile_fields = ["workflow", "subject", "node", "interface", "status",
+                  "start", "wall_s", "cpu_s", "threads", "peak_rss_gb",
+                  "output_bytes"]
+
+
+def node_subject(node):
+    """Return the subject a node in an expanded graph was iterated over."""
+    for param in node.parameterization:
+        param = str(param)
+        if param.startswith("_subject_id_"):
+            return param[len("_subject_id_"):]
+    return None
+
+
+def is_map_subnode(node):
+    """True for the per-item subnodes plugins like MultiProc run a MapNode as.
+
+    Their usage is already included in the record of the MapNode itself.
+    """
+    return op.basename(node.base_dir or "") == "mapflow"
+
+
+def map_parent(node, wf_name):
+    """Return (fullname, subject) of the MapNode a subnode belongs to.
+
+    Subnodes only know their directory, <mapnode dir>/mapflow, so both are
+    read off the path; the fullname starts from the wf_name directory.
+    """
+    parent_dir = op.dirname(node.base_dir)
+    parts = parent_dir.split(os.sep)
+    subject = None
+    for part in parts:
+        if part.startswith("_subject_id_"):
+            subject = part[len("_subject_id_"):]
+    if wf_name in parts:
+        start = len(parts) - 1 - parts[::-1].index(wf_name)
+        names = [p for p in parts[start:] if not p.startswith("_")]
+    else:
+        names = [parts[-1]]
+    return ".".join(names), subject
+
+
+def dir_size(path, seen=None):
+    """Total size in bytes of all files below a directory.
+
+    With a set of seen (device, inode) pairs, hard linked files that were
+    already counted are skipped, and the others are added to it.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            try:
+                stat = os.lstat(op.join(root, fname))
+            except OSError:
+                continue
+            if seen is not None:
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
+
+
+def started_before(runtimes, since):
+    """True if all nipype runtimes started before the datetime since."""
+    for rt in runtimes:
+        try:
+            start = datetime.fromisoformat(getattr(rt, "startTime", None))
+        except (TypeError, ValueError):
+            return False
+        # nipype stamps runtimes in UTC, without a timezone in older versions
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        if start >= since:
+            return False
+    return bool(runtimes)
+
+
+def node_record(node, status, wf_name, measure_output=True, since=None):
+    """Summarize resource usage of one finished node as a dict.
+
+    Wall time, CPU usage and peak RSS come from the interface runtime
+    recorded by nipype (CPU and memory need the nipype resource monitor);
+    MapNode usage is aggregated over its subnodes. I/O is measured as the
+    bytes the node left in its working directory, unless measure_output is
+    False.
+
+    nipype also reports the end of nodes it found cached, with the runtime
+    of the run that produced the result. Given since (when this run
+    started), such nodes get the status "cached" and no usage.
+    """
+    record = dict(workflow=wf_name, subject=node_subject(node),
+                  node=node.fullname, status=status,
+                  interface=node.interface.__class__.__name__,
+                  start=None, wall_s=None, cpu_s=None, threads=None,
+                  peak_rss_gb=None, output_bytes=None)
+    try:
+        runtime = node.result.runtime
+    except Exception:
+        return record
+
+    runtimes = runtime if isinstance(runtime, list) else [runtime]
+    record["start"] = getattr(runtimes[0], "startTime", None)
+    if (since is not None and status == "end" and
+            started_before(runtimes, since)):
+        record["status"] = "cached"
+        return record
+
+    walls, cpus, threads, rss = [], [], [], []
+    for rt in runtimes:
+        duration = getattr(rt, "duration", None)
+        cpu_percent = getattr(rt, "cpu_percent", None)
+        mem_peak = getattr(rt, "mem_peak_gb", None)
+        if duration is not None:
+            walls.append(duration)
+            if cpu_percent is not None:
+                cpus.append(duration * cpu_percent / 100.)
+        if cpu_percent is not None:
+            threads.append(cpu_percent / 100.)
+        if mem_peak is not None:
+            rss.append(mem_peak)
+
+    record["wall_s"] = sum(walls) if walls else None
+    record["cpu_s"] = sum(cpus) if cpus else None
+    record["threads"] = max(threads) if threads else None
+    record["peak_rss_gb"] = max(rss) if rss else None
+    if measure_output:
+        record["output_bytes"] = dir_size(node.output_dir())
+    return record
+
+
+class NodeProfiler(object):
+    """Status callback that records every node execution in a run."""
+    def __init__(self):
+
+        self.records = []
+        self.since = datetime.now(timezone.utc)
+
+    def __call__(self, node, status, wf_name):
+
+        if status in ("end", "exception") and not is_map_subnode(node):
+            self.records.append(node_record(node, status, wf_name,
+                                            since=self.since))
+
+    def write_report(self, prefix):
+        """Write records to <prefix>.csv and <prefix>.json."""
+        parent = op.dirname(prefix)
+        if parent and not op.isdir(parent):
+            os.makedirs(parent)
+        with open(prefix + ".csv", "w") as f:
+            writer = csv.DictWriter(f, profile_fields)
+            writer.writeheader()
+            writer.writerows(self.records)
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.records, f, indent=1)
+        return prefix + ".csv", prefix + ".json"
+
+    def summary(self, n_top=10):
+        """Return a text table of the slowest nodes and subjects."""
+        nodes, subjects = {}, {}
+        for rec in self.records:
+            if rec["status"] == "cached":
+                continue
+            wall = rec["wall_s"] or 0.
+            key = (rec["workflow"], rec["node"])
+            count, total, rss = nodes.get(key, (0, 0., 0.))
+            nodes[key] = (count + 1, total + wall,
+                          max(rss, rec["peak_rss_gb"] or 0.))
+            if rec["subject"] is not None:
+                subjects[rec["subject"]] = subjects.get(rec["subject"],
+                                                        0.) + wall
+
+        lines = ["Slowest nodes",
+                 "%-50s %6s %12s %12s %10s" % ("node", "runs", "total (s)",
+                                               "mean (s)", "peak GB")]
+        top = sorted(nodes.items(), key=lambda kv: -kv[1][1])[:n_top]
+        for (wf_name, name), (count, total, rss) in top:
+            lines.append("%-50s %6d %12.1f %12.1f %10.2f" %
+                         (name, count, total, total / count, rss))
+
+        lines.extend(["", "Slowest subjects",
+                      "%-50s %12s" % ("subject", "total (s)")])
+        top = sorted(subjects.items(), key=lambda kv: -kv[1])[:n_top]
+        for subj, total in top:
+            lines.append("%-50s %12.1f" % (subj, total))
+        return "\n".join(lines)
+
+    def update_history(self):
+        """Fold this run into the stored node and subject runtime history.
+
+        Node history is keyed by node fullname and feeds resource estimates;
+        per-subject totals feed shard balancing.
+        """
+        history_file = state_path("node_history.json")
+        costs_file = state_path("subject_costs.json")
+        # Lock and re-read before writing to keep the records of concurrent
+        # shards and array tasks
+        with open(history_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            history = load_json(history_file, {})
+            costs = load_json(costs_file, {})
+            self._fold_history(history, costs)
+            save_json(history_file, history)
+            save_json(costs_file, costs)
+
+    def _fold_history(self, history, costs):
+
+        subject_totals = {}
+        for rec in self.records:
+            if rec["status"] != "end" or rec["wall_s"] is None:
+                continue
+            entry = history.setdefault(rec["node"], dict(
+                n=0, wall_s=0., cpu_s=0., output_bytes=0,
+                max_rss_gb=0., max_threads=0.))
+            entry["n"] += 1
+            entry["wall_s"] += rec["wall_s"]
+            entry["cpu_s"] += rec["cpu_s"] or 0.
+            entry["output_bytes"] += rec["output_bytes"] or 0
+            entry["max_rss_gb"] = max(entry["max_rss_gb"],
+                                      rec["peak_rss_gb"] or 0.)
+            entry["max_threads"] = max(entry["max_threads"],
+                                       rec["threads"] or 0.)
+            if rec["subject"] is not None:
+                key = (rec["workflow"], rec["subject"])
+                subject_totals[key] = (subject_totals.get(key, 0.) +
+                                       rec["wall_s"])
+
+        for (wf_name, subj), total in subject_totals.items():
+            costs.setdefault(wf_name, {})[subj] = total
+
+
+def load_node_history():
+    """Return stored per-node averages keyed by node fullname."""
+    history = load_json(state_path("node_history.json"), {})
+    averages = {}
+    for name, entry in history.items():
+        n = float(entry["n"])
+        averages[name] = dict(n=entry["n"],
+                              wall_s=entry["wall_s"] / n,
+                              cpu_s=entry["cpu_s"] / n,
+                              output_bytes=entry["output_bytes"] / n,
+                              max_rss_gb=entry["max_rss_gb"],
+                              max_threads=entry["max_threads"])
+    return averages
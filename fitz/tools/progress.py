@@ -0,0 +1,291 @@
+"""Live progress of a running fitz pipeline, in the terminal or over HTTP."""
+import sys
+import json
+import time
+import threading
+import networkx as nx
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from nipype.pipeline.engine import JoinNode
+from nipype.interfaces.utility import IdentityInterface
+from fitz.tools.profiling import node_subject, is_map_subnode
+
+
+def iterable_fields(node):
+    """The (field, values) pairs a node iterates over."""
+    iterables = node.iterables or []
+    if isinstance(iterables, tuple):
+        iterables = [iterables]
+    elif isinstance(iterables, dict):
+        iterables = list(iterables.items())
+    return iterables
+
+
+def n_iterations(node):
+    """How many copies of its downstream graph a node's iterables make."""
+    sizes = [len(values) for _, values in iterable_fields(node)
+             if not callable(values)]
+    if not sizes:
+        return 1
+    if getattr(node, "synchronize", False):
+        return max(sizes)
+    n = 1
+    for size in sizes:
+        n *= size
+    return n
+
+
+def expected_runs(workflow):
+    """Count how often each node of a workflow will run.
+
+    Returns a dict mapping node fullnames to (runs, per_subject), where
+    runs is the number of executions per subject for nodes downstream of
+    the subject iterable, and in total for the others. Only the flat graph
+    is built; iterables are accounted for without expanding them.
+    """
+    flatgraph = workflow._create_flat_graph()
+    expected = {}
+    for node in flatgraph:
+        # Nipype drops identity nodes from the graph it executes
+        if (isinstance(node.interface, IdentityInterface) and
+                not isinstance(node, JoinNode)):
+            continue
+        sources = nx.ancestors(flatgraph, node) | {node}
+        if isinstance(node, JoinNode):
+            sources = set(s for s in sources if s.name != node.joinsource and
+                          not s.fullname.endswith("." + node.joinsource))
+        runs, per_subject = 1, False
+        for source in sources:
+            fields = [f for f, _ in iterable_fields(source)]
+            if "subject_id" in fields and len(fields) == 1:
+                per_subject = True
+            else:
+                runs *= n_iterations(source)
+        expected[node.fullname] = (runs, per_subject)
+    return expected
+
+
+def format_duration(seconds):
+    """Format seconds as e.g. 1h05m, 4m12s or 9s."""
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class ProgressMonitor(object):
+    """Status callback keeping count of the nodes of a running pipeline.
+
+    Workflows are registered with add_workflow before they run, so nodes
+    that haven't started yet can be counted as pending. Historical node
+    durations (see load_node_history) weight the work done and remaining
+    for the ETA; nodes without history count as the average node, and
+    running nodes count as done as far as they are expected to be.
+
+    The monitor only sees nodes whose status callbacks run in this process,
+    i.e. not those run by --stream or subjectpool stage workers.
+    """
+    def __init__(self, history=None, n_slowest=5):
+
+        self.history = history or {}
+        self.n_slowest = n_slowest
+        self.started = time.time()
+        self.expected = {}
+        self.subjects = {}
+        self.running = {}
+        self.counts = {}
+        self.work_done = 0.
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._server = None
+        self._lines = 0
+
+        known = [h["wall_s"] for h in self.history.values()
+                 if h.get("wall_s")]
+        self.default_s = sum(known) / len(known) if known else 1.
+
+    def expected_s(self, name):
+        """Expected wall time of one execution of a node."""
+        return self.history.get(name, {}).get("wall_s") or self.default_s
+
+    def add_workflow(self, workflow, wf_name, subjects):
+        """Register the nodes a workflow is about to run for subjects."""
+        expected = expected_runs(workflow)
+        with self.lock:
+            self.expected[wf_name] = expected
+            self.subjects[wf_name] = list(subjects)
+
+    def __call__(self, node, status, wf_name):
+
+        if is_map_subnode(node):
+            return
+        key = (wf_name, node._hierarchy, node._id)
+        subject = node_subject(node)
+        with self.lock:
+            if status == "start":
+                self.running[key] = (wf_name, subject, node.fullname,
+                                     time.time())
+                return
+            self.running.pop(key, None)
+            counts = self.counts.setdefault((wf_name, subject),
+                                            dict(done=0, failed=0))
+            counts["failed" if status == "exception" else "done"] += 1
+            self.work_done += self.expected_s(node.fullname)
+
+    def _totals(self, wf_name):
+        """Expected node and work totals per subject (None: not per subject)."""
+        subjects = self.subjects.get(wf_name, [])
+        totals = {}
+        for name, (runs, per_subject) in self.expected[wf_name].items():
+            for subj in subjects if per_subject else [None]:
+                total = totals.setdefault(subj, [0, 0.])
+                total[0] += runs
+                total[1] += runs * self.expected_s(name)
+        return totals
+
+    def snapshot(self):
+        """Return the current state of the run as a JSON-able dict."""
+        now = time.time()
+        with self.lock:
+            running = list(self.running.values())
+            counts = dict((k, dict(v)) for k, v in self.counts.items())
+            work_done = self.work_done
+            wf_names = list(self.expected)
+            totals = dict((wf, self._totals(wf)) for wf in wf_names)
+
+        n_running = {}
+        for wf_name, subj, _, _ in running:
+            n_running[(wf_name, subj)] = n_running.get((wf_name, subj), 0) + 1
+
+        workflows, subjects = {}, {}
+        work_total = 0.
+        n_done = 0
+        for wf_name in wf_names:
+            wf_total = dict(total=0, done=0, failed=0, running=0, pending=0)
+            subjects[wf_name] = {}
+            for subj, (n_nodes, work) in totals[wf_name].items():
+                count = counts.get((wf_name, subj), dict(done=0, failed=0))
+                n_run = n_running.get((wf_name, subj), 0)
+                entry = dict(total=n_nodes, done=count["done"],
+                             failed=count["failed"], running=n_run,
+                             pending=max(n_nodes - count["done"] -
+                                         count["failed"] - n_run, 0))
+                if subj is not None:
+                    subjects[wf_name][subj] = entry
+                for field in wf_total:
+                    wf_total[field] += entry[field]
+                work_total += work
+            workflows[wf_name] = wf_total
+            n_done += wf_total["done"] + wf_total["failed"]
+
+        elapsed = now - self.started
+        work_done += sum(min(now - start, self.expected_s(name))
+                         for _, _, name, start in running)
+        rate = work_done / elapsed if elapsed > 0 else 0.
+        eta = (max(work_total - work_done, 0.) / rate) if rate else None
+
+        slowest = sorted(running, key=lambda r: r[3])[:self.n_slowest]
+        slowest = [dict(workflow=wf_name, subject=subj, node=name,
+                        running_s=now - start,
+                        expected_s=self.history.get(name, {}).get("wall_s"))
+                   for wf_name, subj, name, start in slowest]
+
+        return dict(elapsed_s=elapsed, nodes_per_min=60. * n_done / elapsed
+                    if elapsed > 0 else 0., eta_s=eta, workflows=workflows,
+                    subjects=subjects, slowest=slowest)
+
+    def render(self, snapshot=None):
+        """Return a text summary of a snapshot."""
+        snap = snapshot or self.snapshot()
+        lines = ["%-20s %7s %7s %7s %7s %7s  %s" % (
+            "workflow", "done", "failed", "running", "pending", "total",
+            "subjects done/running/failed")]
+        for wf_name, total in snap["workflows"].items():
+            subjects = snap["subjects"][wf_name].values()
+            n_subj_done = sum(1 for s in subjects if s["done"] == s["total"])
+            n_subj_running = sum(1 for s in subjects
+                                 if s["running"] and not s["failed"])
+            n_subj_failed = sum(1 for s in subjects if s["failed"])
+            lines.append("%-20s %7d %7d %7d %7d %7d  %d/%d/%d of %d" % (
+                wf_name[:20], total["done"], total["failed"],
+                total["running"], total["pending"], total["total"],
+                n_subj_done, n_subj_running, n_subj_failed, len(subjects)))
+        lines.append("elapsed %s, %.1f nodes/min, ETA %s" % (
+            format_duration(snap["elapsed_s"]), snap["nodes_per_min"],
+            format_duration(snap["eta_s"])))
+        for entry in snap["slowest"]:
+            lines.append("  running %8s (expected %s)  %s %s" % (
+                format_duration(entry["running_s"]),
+                format_duration(entry["expected_s"]),
+                entry["node"], entry["subject"] or ""))
+        return "\n".join(lines)
+
+    def show(self, stream=sys.stderr):
+        """Print the progress, redrawing it in place on a terminal."""
+        text = self.render()
+        if stream.isatty():
+            if self._lines:
+                stream.write("\x1b[%dA\x1b[J" % self._lines)
+            self._lines = text.count("\n") + 1
+        stream.write(text + "\n")
+        stream.flush()
+
+    def start(self, interval=None, port=None, show=True):
+        """Show progress every interval seconds and/or serve it over HTTP.
+
+        The interval defaults to 2s on a terminal and 60s otherwise. With a
+        port, GET http://localhost:<port>/ returns the snapshot as JSON.
+        """
+        if show:
+            if interval is None:
+                interval = 2. if sys.stderr.isatty() else 60.
+            thread = threading.Thread(target=self._show_loop,
+                                      args=(interval,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if port is not None:
+            self._server = ThreadingHTTPServer(("127.0.0.1", port),
+                                               StatusHandler)
+            self._server.monitor = self
+            thread = threading.Thread(target=self._server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            print("Serving run status on http://127.0.0.1:%d/" %
+                  self._server.server_address[1])
+
+    def _show_loop(self, interval):
+
+        while not self._stop.wait(interval):
+            self.show()
+
+    def stop(self):
+        """Stop updating, showing the final progress."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self._threads:
+            self.show()
+        self._threads = []
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Serve a ProgressMonitor snapshot as JSON."""
+    def do_GET(self):
+
+        body = json.dumps(self.server.monitor.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
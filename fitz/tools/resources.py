@@ -0,0 +1,102 @@
+"""Size per-node scheduler requests from recorded resource usage."""
+import math
+from fitz.tools.graphutils import GraphIndex
+
+
+def iter_nodes(workflow):
+    """Yield (fullname, node) for every node below a workflow.
+
+    Fullnames follow nipype's dotted hierarchy (e.g. preproc.realign), which
+    is also how nodes are keyed in the stored node history.
+    """
+    return GraphIndex.of(workflow).iter_nodes()
+
+
+# Nipype's mem_gb for nodes that don't declare one
+default_mem_gb = .2
+
+
+def node_request(estimate, margin=1.2, scale=1., declared_mem_gb=None):
+    """Turn a history entry into (memory in GB, number of threads).
+
+    Without a recorded peak, memory is only requested when it is scaled up,
+    from the memory the node declared.
+    """
+    mem_gb = None
+    if estimate.get("max_rss_gb"):
+        mem_gb = max(estimate["max_rss_gb"] * margin * scale, .1)
+    elif declared_mem_gb and scale != 1:
+        mem_gb = declared_mem_gb * scale
+    n_procs = max(1, int(math.ceil(estimate.get("max_threads") or 1)))
+    return mem_gb, n_procs
+
+
+def scheduler_args(plugin, mem_gb, n_procs):
+    """Format a memory/thread request for a cluster plugin's node args."""
+    mem_mb = int(math.ceil(mem_gb * 1024)) if mem_gb else None
+    if plugin == "SLURM":
+        key, args = "sbatch_args", ["--cpus-per-task=%d" % n_procs]
+        if mem_mb:
+            args.append("--mem=%dM" % mem_mb)
+    elif plugin == "SGE":
+        key, args = "qsub_args", []
+        if mem_mb:
+            args.append("-l h_vmem=%dM" % int(math.ceil(mem_mb / n_procs)))
+        if n_procs > 1:
+            args.append("-pe smp %d" % n_procs)
+    elif plugin == "PBS":
+        key, args = "qsub_args", ["-l nodes=1:ppn=%d" % n_procs]
+        if mem_mb:
+            args.append("-l mem=%dmb" % mem_mb)
+    else:
+        return None, None
+    return key, " ".join(args)
+
+
+def apply_resource_estimates(workflow, plugin, history, scale=1.):
+    """Set per-node memory and thread requests from node history.
+
+    For MultiProc this fills the node mem_gb/n_procs estimates that its
+    memory and processor budgeting uses; for cluster plugins it adds
+    per-node resource requests to each job. Cluster arguments a workflow
+    already set explicitly are left alone.
+
+    Memory requests are multiplied by scale (e.g. when retrying jobs). Nodes
+    without history then have the memory they declared scaled instead; on
+    a cluster, where nipype's default isn't a request, only if they
+    declared one.
+
+    Returns
+    -------
+    n_estimated : int
+        Number of nodes whose requests were set from history.
+    n_scaled : int
+        Number of nodes whose memory request was scaled.
+    """
+    n_estimated = n_scaled = 0
+    multiproc = plugin in ["MultiProc", "LegacyMultiProc"]
+    for fullname, node in iter_nodes(workflow):
+        estimate = history.get(fullname) or {}
+        declared = node.mem_gb
+        if not multiproc and declared == default_mem_gb:
+            declared = None
+        if not estimate and (scale == 1 or not declared):
+            continue
+        mem_gb, n_procs = node_request(estimate, scale=scale,
+                                       declared_mem_gb=declared)
+
+        if multiproc:
+            if mem_gb:
+                node._mem_gb = mem_gb
+            # Only touch the private estimate so interface inputs (and
+            # therefore node hashes) are unchanged
+            node._n_procs = max(n_procs, node.n_procs)
+        else:
+            key, args = scheduler_args(plugin, mem_gb, n_procs)
+            if key is None or key in node.plugin_args:
+                continue
+            node.plugin_args = dict(node.plugin_args, **{key: args})
+        n_estimated += bool(estimate)
+        n_scaled += bool(mem_gb) and scale != 1
+
+    return n_estimated, n_scaled
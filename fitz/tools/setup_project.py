@@ -133,8 +133,13 @@ working_dir = '%(working_dir)s'
 # Crash directory is where debugging info will be written if things go wrong
 crash_dir = '%(crash_dir)s'
 
-# Set this to True to remove the working directory after each excecution
-rm_working_dir = %(rm_work_dir)s
+# Deprecated and ignored: the working directory is only removed after a run
+# with `fitz run --rm-working-dir`
+rm_working_dir = False
+
+# Keep the working directory within a disk budget (e.g. '500G') by evicting
+# the least recently used node caches after each execution
+working_dir_budget = None
 
 """
 
@@ -278,9 +283,6 @@ Please use relative paths.
     do_prompt(d, "crash_dir", "Crashdump path",
               op.join("../analysis", crash_stem))
 
-    do_prompt(d, "rm_work_dir", "Remove working directory after execution? (Y/n)",
-              "y", boolean)
-
     # Record the time this happened
     d['now'] = time.asctime()
 
@@ -0,0 +1,82 @@
+"""Split subject lists into independent shards for distributed runs."""
+from fitz.tools.state import state_path, load_json
+
+
+def parse_shard(spec):
+    """Parse a --shard argument.
+
+    "i/N" selects the i-th (1-based) of N shards, while a bare "N" means
+    every shard should be run, one after another, as independent graphs.
+
+    Returns
+    -------
+    index : int or None
+    n_shards : int
+    """
+    try:
+        if "/" in spec:
+            index, n_shards = [int(s) for s in spec.split("/")]
+        else:
+            index, n_shards = None, int(spec)
+    except ValueError:
+        raise ValueError("Shards must be specified as i/N or N, not %s" %
+                         spec)
+    if n_shards < 1 or (index is not None and not 1 <= index <= n_shards):
+        raise ValueError("Shard %s is out of range" % spec)
+    return index, n_shards
+
+
+def partition_subjects(subjects, n_shards, costs=None):
+    """Deterministically split subjects into n_shards lists.
+
+    Without costs subjects are dealt out round-robin, so shard sizes never
+    differ by more than one. With a dict of per-subject costs (e.g. stored
+    runtimes) the most expensive subjects are placed first, each on the
+    currently lightest shard. Subjects without a recorded cost are assumed
+    to cost the median of the known ones. Each shard keeps the original
+    subject order.
+    """
+    if not costs:
+        return [subjects[i::n_shards] for i in range(n_shards)]
+
+    known = sorted(costs[s] for s in subjects if s in costs)
+    default = known[len(known) // 2] if known else 1.
+    order = sorted(range(len(subjects)),
+                   key=lambda i: (-costs.get(subjects[i], default), i))
+
+    loads = [0.] * n_shards
+    members = [[] for _ in range(n_shards)]
+    for i in order:
+        shard = loads.index(min(loads))
+        loads[shard] += costs.get(subjects[i], default)
+        members[shard].append(i)
+
+    return [[subjects[i] for i in sorted(m)] for m in members]
+
+
+def load_subject_costs(workflows, cost_file=None):
+    """Sum stored per-subject runtimes (in seconds) over some workflows.
+
+    The cost file maps workflow name to a {subject: seconds} dict.
+    """
+    if cost_file is None:
+        cost_file = state_path("subject_costs.json")
+    stored = load_json(cost_file, {})
+
+    costs = {}
+    for wf_name in workflows:
+        for subj, seconds in stored.get(wf_name, {}).items():
+            costs[subj] = costs.get(subj, 0.) + seconds
+    return costs
+
+
+def select_shards(subjects, spec, workflows=None, balance=False):
+    """Return the subject lists to run for a --shard argument."""
+    index, n_shards = parse_shard(spec)
+    costs = load_subject_costs(workflows or []) if balance else None
+    if balance and not costs:
+        print("No stored subject runtimes found; sharding round-robin.")
+    shards = partition_subjects(subjects, n_shards, costs)
+    if index is not None:
+        shards = [shards[index - 1]]
+    return shards
@@ -0,0 +1,139 @@
+"""Stream subjects through a sequence of dependent workflow stages.
+
+Instead of running each workflow for every subject before starting the
+next one, every (subject, workflow) pair is a stage that is dispatched to
+a worker process as soon as the same subject's upstream stages finish.
+"""
+import heapq
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def workflow_dependencies(wf_names, wf_modules):
+    """Determine which requested workflows each workflow must wait for.
+
+    A workflow module may declare the workflows it consumes outputs from in
+    a module-level ``requires`` list. Without a declaration, workflows are
+    assumed to depend on the workflow before them on the command line.
+    Dependencies that weren't requested in this run are ignored.
+    """
+    deps = {}
+    for i, name in enumerate(wf_names):
+        declared = getattr(wf_modules[name], "requires", None)
+        if declared is None:
+            deps[name] = wf_names[:i][-1:]
+        else:
+            deps[name] = [d for d in declared if d in wf_names]
+
+    # Make sure the declared dependencies can actually be satisfied
+    resolved = set()
+    while len(resolved) < len(wf_names):
+        ready = [n for n in wf_names
+                 if n not in resolved and set(deps[n]) <= resolved]
+        if not ready:
+            raise ValueError("Circular workflow requirements among %s" %
+                             ", ".join(sorted(set(wf_names) - resolved)))
+        resolved.update(ready)
+    return deps
+
+
+class StageScheduler(object):
+    """Run per-subject workflow stages in a pool of worker processes."""
+    def __init__(self, subjects, wf_names, dependencies, n_workers):
+
+        self.subjects = list(subjects)
+        self.wf_names = list(wf_names)
+        self.deps = dependencies
+        self.n_workers = n_workers
+        self.position = dict((s, i) for i, s in enumerate(self.subjects))
+
+        # Workflows waiting on each workflow, within the same subject
+        self.downstream = dict((wf, []) for wf in self.wf_names)
+        for wf in self.wf_names:
+            for dep in set(self.deps[wf]):
+                self.downstream[dep].append(wf)
+
+        # How far down the chain of workflows each workflow is
+        self.depth = {}
+        for wf in self.wf_names:
+            self._depth(wf)
+
+    def _depth(self, wf):
+
+        if wf not in self.depth:
+            self.depth[wf] = 1 + max([self._depth(d) for d in self.deps[wf]],
+                                     default=-1)
+        return self.depth[wf]
+
+    def priority(self, stage):
+        """Sort key running downstream stages, then earlier subjects, first.
+
+        Finishing the subjects already under way before starting new ones
+        is what lets results stream out while other subjects still run.
+        """
+        subj, wf = stage
+        return -self.depth[wf], self.position[subj]
+
+    def run(self, run_stage):
+        """Execute run_stage(wf_name, subject) for every stage.
+
+        run_stage must be picklable. A stage only starts once the subject's
+        upstream stages succeeded; stages downstream of a failure are
+        skipped. No more stages than there are workers are handed to the
+        pool at once, so every free worker takes the most urgent stage that
+        is ready at that moment.
+
+        Returns
+        -------
+        results : dict
+            Return value of each successful stage, keyed by (subject, wf).
+        failed : dict
+            Exception (or None, if skipped) for each stage that didn't run
+            successfully, keyed by (subject, wf).
+        """
+        # Count the upstream stages each stage still waits for; a finished
+        # stage only touches the counts of its own subject's stages
+        waiting = dict(((s, wf), len(set(self.deps[wf])))
+                       for s in self.subjects for wf in self.wf_names)
+        ready = [(self.priority(stage), stage)
+                 for stage, n in waiting.items() if not n]
+        heapq.heapify(ready)
+        results, failed, running = {}, {}, {}
+
+        with ProcessPoolExecutor(self.n_workers) as pool:
+            while ready or running:
+                while ready and len(running) < self.n_workers:
+                    _, (subj, wf) = heapq.heappop(ready)
+                    future = pool.submit(run_stage, wf, subj)
+                    running[future] = (subj, wf)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        results[stage] = future.result()
+                        self._release(stage, waiting, failed, ready)
+                    else:
+                        print("Stage %s for subject %s failed: %s" %
+                              (stage[1], stage[0], error))
+                        failed[stage] = error
+                        self._skip(stage, failed)
+
+        return results, failed
+
+    def _release(self, stage, waiting, failed, ready):
+        """Queue the subject's stages that only waited for stage."""
+        subj, wf = stage
+        for down in self.downstream[wf]:
+            waiting[(subj, down)] -= 1
+            if not waiting[(subj, down)] and (subj, down) not in failed:
+                heapq.heappush(ready, (self.priority((subj, down)),
+                                       (subj, down)))
+
+    def _skip(self, stage, failed):
+        """Mark every stage downstream of a failed stage as skipped."""
+        subj, wf = stage
+        for down in self.downstream[wf]:
+            if (subj, down) not in failed:
+                failed[(subj, down)] = None
+                self._skip((subj, down), failed)
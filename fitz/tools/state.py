@@ -0,0 +1,32 @@
+"""Persistent bookkeeping files kept alongside a fitz project."""
+import os
+import json
+import tempfile
+import os.path as op
+
+
+def state_path(*parts):
+    """Return a path inside the hidden $FITZ_DIR/.fitz state directory."""
+    state_dir = op.join(os.environ["FITZ_DIR"], ".fitz")
+    path = op.join(state_dir, *parts)
+    parent = op.dirname(path)
+    if not op.isdir(parent):
+        os.makedirs(parent)
+    return path
+
+
+def load_json(path, default=None):
+    """Read a json state file, returning default if it doesn't exist."""
+    if not op.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, obj):
+    """Atomically write a json state file so readers never see half of it."""
+    fd, tmp = tempfile.mkstemp(dir=op.dirname(op.abspath(path)),
+                               suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
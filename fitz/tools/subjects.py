@@ -0,0 +1,158 @@
+"""Resolve subject selectors against an index of the project data tree."""
+import os
+import re
+import fnmatch
+import os.path as op
+from fitz.tools.state import state_path, load_json, save_json
+
+
+glob_chars = set("*?[")
+range_sep = ".."
+
+
+def read_subject_file(fname):
+    """Read whitespace separated subject ids, ignoring # comments."""
+    subjects = []
+    with open(fname) as f:
+        for line in f:
+            subjects.extend(line.split("#", 1)[0].split())
+    return subjects
+
+
+def _split_id(subj):
+    """Split a subject id into its prefix and trailing number."""
+    match = re.match(r"^(.*?)(\d+)$", subj)
+    if match is None:
+        raise ValueError("Subject range ends must end in a number: %s" % subj)
+    return match.group(1), match.group(2)
+
+
+class SubjectCatalog(object):
+    """Index of the subject directories in a project's data_dir.
+
+    Listing a data tree of thousands of subjects is only done when the
+    data_dir itself changed (its mtime changes whenever a subject directory
+    is added, removed or renamed); otherwise the index is read back from
+    $FITZ_DIR/.fitz/subjects.json.
+
+    Selectors, as given to `fitz run -s`, can be:
+
+    - a subject id (kept even if it isn't in the data tree, e.g. for the
+      workflow that creates its data)
+    - a text file of subject ids, by path or as $FITZ_DIR/<name>.txt
+    - a glob pattern matched against the data tree, e.g. 'sub-0[0-9]*'
+    - a regular expression prefixed with 're:', e.g. 're:sub-\\d{3}$'
+    - an inclusive range, e.g. 'sub-001..sub-050'
+    - any of the above prefixed with '~' to remove those subjects again
+
+    Subject files that don't exist and patterns or ranges that match no
+    subject of a data tree raise errors, as they are most likely typos;
+    excluded selectors are not checked.
+
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._subjects = None
+
+    @property
+    def subjects(self):
+        """Sorted subject directory names in the data tree."""
+        if self._subjects is None:
+            self._subjects = self._load_index()
+        return self._subjects
+
+    def _load_index(self):
+        if not op.isdir(self.data_dir):
+            return []
+        mtime = os.stat(self.data_dir).st_mtime
+        index_file = state_path("subjects.json")
+        index = load_json(index_file, {})
+        entry = index.get(self.data_dir)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry["subjects"]
+
+        subjects = sorted(entry.name for entry in os.scandir(self.data_dir)
+                          if entry.is_dir() and not entry.name.startswith("."))
+        index[self.data_dir] = dict(mtime=mtime, subjects=subjects)
+        save_json(index_file, index)
+        return subjects
+
+    def select(self, selectors, exclude=None):
+        """Return the subjects matching a list of selectors, in order.
+
+        Subjects matching any of the exclude selectors are left out.
+        """
+        subjects = []
+        for selector in selectors:
+            if selector.startswith("~"):
+                dropped = set(self.expand(selector[1:], check=False))
+                subjects = [s for s in subjects if s not in dropped]
+            else:
+                subjects.extend(self.expand(selector))
+
+        dropped = set()
+        for selector in exclude or []:
+            dropped.update(self.expand(selector, check=False))
+
+        selected, seen = [], set()
+        for subj in subjects:
+            if subj not in seen and subj not in dropped:
+                selected.append(subj)
+                seen.add(subj)
+        return selected
+
+    def expand(self, selector, check=True):
+        """Return the list of subjects a single selector refers to.
+
+        With check, raise if the selector looks like a subject file that
+        doesn't exist, or is a pattern or range that matches no subject of
+        the data tree.
+        """
+        fitz_file = op.join(os.environ["FITZ_DIR"], selector + ".txt")
+        if op.isfile(selector):
+            return read_subject_file(selector)
+        elif op.isfile(fitz_file):
+            return read_subject_file(fitz_file)
+        elif selector.startswith("re:"):
+            pattern = re.compile(selector[3:])
+            subjects = [s for s in self.subjects if pattern.search(s)]
+        elif selector.endswith(".txt") or os.sep in selector:
+            if check:
+                raise IOError("Subject file %s does not exist." % selector)
+            return []
+        elif glob_chars & set(selector):
+            subjects = fnmatch.filter(self.subjects, selector)
+        elif range_sep in selector:
+            subjects = self.subject_range(*selector.split(range_sep, 1))
+        else:
+            return [selector]
+
+        if check and self.subjects and not subjects:
+            raise ValueError("%s matches no subject in %s." %
+                             (selector, self.data_dir))
+        return subjects
+
+    def subject_range(self, first, last):
+        """Subjects from first to last (inclusive) with the same prefix.
+
+        Ranges select the subjects present in the data tree; without one,
+        every id in the range is generated with the width of first.
+        """
+        prefix, start = _split_id(first)
+        last_prefix, stop = _split_id(last)
+        if last_prefix != prefix:
+            raise ValueError("Subject range %s..%s mixes prefixes" %
+                             (first, last))
+        width, start, stop = len(start), int(start), int(stop)
+
+        if not self.subjects:
+            return ["%s%0*d" % (prefix, width, i)
+                    for i in range(start, stop + 1)]
+
+        pattern = re.compile(r"^%s(\d+)$" % re.escape(prefix))
+        subjects = []
+        for subj in self.subjects:
+            match = pattern.match(subj)
+            if match is not None and start <= int(match.group(1)) <= stop:
+                subjects.append(subj)
+        return subjects
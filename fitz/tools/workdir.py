@@ -0,0 +1,229 @@
+"""Keep nipype working directories within a disk budget."""
+import os
+import re
+import time
+import errno
+import shutil
+import socket
+import os.path as op
+from fitz.tools.profiling import dir_size, is_map_subnode
+from fitz.tools.configfiles import gather_project_info
+
+# Marks the root of one experiment/model working tree and when it last ran
+run_stamp = ".fitz_last_run"
+
+# Holds a file for every fitz process running in a working tree
+live_dir = ".fitz_running"
+
+# Written into each node directory whenever a run uses the node
+use_stamp = ".fitz_used"
+
+# Default shared node cache (see nodecache) at the top of the working root;
+# its entries are linked into node directories, so it isn't evicted itself
+shared_dir = "shared_cache"
+
+# Markers of runs on other hosts, which can't be checked, expire after this
+live_expiry = 7 * 86400
+
+size_units = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+
+def parse_size(size):
+    """Convert a size like 500G, 1.5T or 1024 (bytes) into bytes."""
+    match = re.match(r"^\s*([\d.]+)\s*([KMGT]?)B?\s*$", str(size).upper())
+    if match is None:
+        raise ValueError("Could not understand disk size %s" % size)
+    number, unit = match.groups()
+    return int(float(number) * size_units.get(unit, 1))
+
+
+def format_size(n_bytes):
+    for unit in ["T", "G", "M", "K"]:
+        if n_bytes >= size_units[unit]:
+            return "%.1f%sB" % (n_bytes / float(size_units[unit]), unit)
+    return "%dB" % n_bytes
+
+
+def stamp_run(working_dir):
+    """Record that a run of this working tree is starting now.
+
+    Returns the marker that shows the run is live until release_run.
+    """
+    marker_dir = op.join(working_dir, live_dir)
+    if not op.isdir(marker_dir):
+        os.makedirs(marker_dir)
+    with open(op.join(working_dir, run_stamp), "w") as f:
+        f.write(time.strftime("%Y-%m-%d %H:%M:%S\n"))
+    marker = op.join(marker_dir, "%s.%d" % (socket.gethostname(),
+                                            os.getpid()))
+    with open(marker, "w") as f:
+        f.write(time.strftime("%Y-%m-%d %H:%M:%S\n"))
+    return marker
+
+
+def release_run(marker):
+    """Mark a run started by stamp_run as finished."""
+    try:
+        os.remove(marker)
+    except OSError:
+        pass
+
+
+def marker_is_live(marker):
+    """True unless a run marker belongs to a process that's gone."""
+    host, pid = op.basename(marker).rsplit(".", 1)
+    if host != socket.gethostname():
+        return time.time() - os.stat(marker).st_mtime < live_expiry
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def live_runs(working_dir, own_marker=None):
+    """Markers of the other fitz processes still running in a tree."""
+    marker_dir = op.join(working_dir, live_dir)
+    if not op.isdir(marker_dir):
+        return []
+    markers = [op.join(marker_dir, f) for f in os.listdir(marker_dir)]
+    return [m for m in markers if m != own_marker and marker_is_live(m)]
+
+
+class NodeUseRecorder(object):
+    """Status callback stamping the directory of every node a run used.
+
+    Nodes found cached don't have their files read or written, so the
+    stamp is the only trace that the run still needed them.
+    """
+    def __call__(self, node, status, wf_name):
+
+        if status != "end" or is_map_subnode(node):
+            return
+        try:
+            with open(op.join(node.output_dir(), use_stamp), "w") as f:
+                f.write(time.strftime("%Y-%m-%d %H:%M:%S\n"))
+        except (IOError, OSError):
+            pass
+
+
+def find_node_dirs(working_root):
+    """Find nipype node directories and their experiment/model trees.
+
+    Files hard linked into several places are counted once: node
+    directories linked from the shared cache only count the files that
+    removing them would free.
+
+    Returns
+    -------
+    nodes : list of dicts
+        path, size in bytes, last use time, and the working tree (the
+        nearest parent stamped by a fitz run) of each node directory.
+    trees : dict
+        Time of the last run of each working tree.
+    shared_size : int
+        Bytes in the shared node cache, which is never evicted.
+    """
+    nodes, trees = [], {}
+    seen = set()
+    shared_size = dir_size(op.join(working_root, shared_dir), seen)
+    for root, dirs, files in os.walk(working_root):
+        if root == working_root and shared_dir in dirs:
+            dirs.remove(shared_dir)
+        if run_stamp in files:
+            trees[root] = os.stat(op.join(root, run_stamp)).st_mtime
+        results = [f for f in files if re.match(r"result_.*\.pklz$", f)]
+        if not results:
+            continue
+        # Don't descend into node directories (e.g. MapNode subnodes)
+        dirs[:] = []
+        # Runs stamp the nodes they used; unstamped nodes are from before
+        # fitz recorded node use, so fall back to when they were written
+        if use_stamp in files:
+            last_used = os.stat(op.join(root, use_stamp)).st_mtime
+        else:
+            last_used = os.stat(op.join(root, results[0])).st_mtime
+        tree = root
+        while tree != working_root and tree not in trees:
+            tree = op.dirname(tree)
+        nodes.append(dict(path=root, size=dir_size(root, seen), tree=tree,
+                          last_used=last_used))
+    return nodes, trees, shared_size
+
+
+def collect_garbage(working_root, budget, dry_run=False):
+    """Evict least recently used node caches until under budget.
+
+    Nodes used during the latest run of their experiment/model working
+    tree are kept, since they are what the next incremental rerun of that
+    tree will look for. Trees that other fitz processes are still running
+    in aren't touched at all.
+
+    Returns
+    -------
+    reclaimed : dict
+        Bytes removed (or that would be removed) per working tree.
+    remaining : int
+        Bytes left in node caches (and the shared cache) afterwards.
+    """
+    nodes, trees, shared_size = find_node_dirs(working_root)
+    total = shared_size + sum(n["size"] for n in nodes)
+    reclaimed = {}
+
+    busy = set(tree for tree in trees if live_runs(tree))
+    evictable = [n for n in nodes if n["tree"] not in busy and
+                 (n["tree"] not in trees or
+                  n["last_used"] < trees[n["tree"]])]
+    for node in sorted(evictable, key=lambda n: n["last_used"]):
+        if total <= budget:
+            break
+        if not dry_run:
+            shutil.rmtree(node["path"], ignore_errors=True)
+        total -= node["size"]
+        reclaimed[node["tree"]] = reclaimed.get(node["tree"], 0) + node["size"]
+
+    return reclaimed, total
+
+
+def report_garbage(working_root, budget, dry_run=False):
+    """Collect garbage and print what was reclaimed from each tree."""
+    reclaimed, remaining = collect_garbage(working_root, budget, dry_run)
+    verb = "Would reclaim" if dry_run else "Reclaimed"
+    for tree, n_bytes in sorted(reclaimed.items()):
+        print("%s %s from %s" % (verb, format_size(n_bytes),
+                                 op.relpath(tree, working_root)))
+    print("%s %s in total; %s of node caches remain (budget %s)" % (
+        verb, format_size(sum(reclaimed.values())), format_size(remaining),
+        format_size(budget)))
+    if remaining > budget:
+        print("Still over budget: the remaining caches were all used by the "
+              "latest run of their experiment/model, or are in the shared "
+              "cache.")
+    return reclaimed
+
+
+def remove_working_dir(working_dir, own_marker=None):
+    """Remove a finished working tree (the project's rm_working_dir).
+
+    Trees that other fitz processes (e.g. other shards or array tasks) are
+    still running in are left alone; returns whether the tree was removed.
+    """
+    if not op.isdir(working_dir):
+        return False
+    others = live_runs(working_dir, own_marker)
+    if others:
+        print("Not removing %s: %d other fitz runs are still using it" %
+              (working_dir, len(others)))
+        return False
+    shutil.rmtree(working_dir)
+    return True
+
+
+def main(args):
+    """Shrink the project working directory to fit a disk budget."""
+    project = gather_project_info()
+    budget = args.budget or project["working_dir_budget"]
+    if not budget:
+        raise ValueError("Give a --budget or set working_dir_budget in "
+                         "project.py")
+    report_garbage(project["working_dir"], parse_size(budget), args.dry_run)
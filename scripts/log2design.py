@@ -1,60 +1,220 @@
 #!/usr/bin/env python
 # Create Lyman/Fitz style long flat Design Files from plain-text onset files
 # EKK / June 2015
-# Python 2/3 compatibile, depends on Pandas and Numpy/Scipy
+# Requires Python 3.7+, depends on Pandas and Numpy/Scipy
 
 from __future__ import print_function
-from pandas import concat, read_csv
-from argparse import ArgumentParser, FileType
-from numpy import empty
+import os
+import shutil
+from multiprocessing import Pool
+from pandas import read_csv
+from argparse import ArgumentParser
+from numpy import empty, flatnonzero, diff, split, isnan
+
+# Subject ids like 01 are names, not numbers, and keep their zero padding
+str_cols = {'subject': str}
 
 
 def main(args):
-    runs_df = load_onsets(args.onsets_files, args)
-    print("Saving designfile (%d rows) to %s" % (runs_df.shape[0], args.out))
-    runs_df.to_csv(args.out, index=False)
+    fmt = args.format or design_format(args.out)
+    if args.partition_col and fmt != 'parquet':
+        raise ValueError('Only parquet designs can be partitioned.')
+    # Non-csv designs are streamed to csv first, then converted in one go
+    # so that each column gets one consistent type across all runs
+    csv_out = args.out if fmt == 'csv' else args.out + '.csv.tmp'
+    try:
+        n_rows = write_design(args.onsets_files, csv_out, args,
+                              args.chunksize, args.jobs)
+        if fmt != 'csv':
+            convert_design(csv_out, args.out, fmt, args.partition_col)
+        print("Saved designfile (%d rows) to %s" % (n_rows, args.out))
+        if args.spm_dir:
+            design = read_csv(csv_out, dtype=str_cols)
+            written = write_spm_conditions(design, args.spm_dir,
+                                           args.pmod_name, args.jobs)
+            print("Saved %d SPM conditions files to %s" % (len(written),
+                                                           args.spm_dir))
+    finally:
+        if csv_out != args.out and os.path.exists(csv_out):
+            os.remove(csv_out)
+
+
+def design_format(fname):
+    """Guess a design file format from its extension."""
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ['.parquet', '.pq']:
+        return 'parquet'
+    if ext in ['.feather', '.arrow']:
+        return 'feather'
+    return 'csv'
+
+
+def convert_design(csv_file, out, fmt, partition_col=None):
+    """Convert a csv design file to a typed columnar format.
+
+    Parquet designs can be partitioned into one directory per value of
+    partition_col (e.g. subject) so readers only touch their own part.
+    Feather files are written uncompressed so they can be memory-mapped.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+        import pyarrow.parquet as pq
+        import pyarrow.feather as feather
+    except ImportError:
+        raise ImportError('Writing %s designs requires pyarrow '
+                          '(pip install pyarrow).' % fmt)
+    options = pa_csv.ConvertOptions(
+        column_types={c: pa.string() for c in str_cols})
+    table = pa_csv.read_csv(csv_file, convert_options=options)
+    if fmt == 'feather':
+        feather.write_feather(table, out, compression='uncompressed')
+    elif partition_col:
+        # write_to_dataset adds files next to any already there, so the
+        # dataset is written aside and replaces an earlier one in one go
+        tmp = out + '.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        pq.write_to_dataset(table, tmp, partition_cols=[partition_col])
+        if os.path.isdir(out):
+            shutil.rmtree(out)
+        os.rename(tmp, out)
+    else:
+        pq.write_table(table, out)
 
 
 def load_onsets(onsets_files, args):
     """Read onsets file and add metadata from their filenames.
     Return one concatenated pandas dataframe with all trials as rows."""
-    runs = []
+    from pandas import concat
+    columns = design_columns(onsets_files, args)
+    runs = [chunk.reindex(columns=columns)
+            for chunk in iter_runs(onsets_files, args)]
+    design = concat(runs, ignore_index=True)
+    return design.dropna(axis=1, how='all')
+
+
+def renaming(args):
+    """True if column arguments ask for a lyman-like design with explicitly
+    named columns. Else, runs are just concatenated with 'run' added."""
+    return bool(args.onset_col or args.duration_col or args.condition_col or
+                args.pmods_col)
+
+
+def design_columns(onsets_files, args, pool=None):
+    """Determine the columns of the long design file up front, in the order
+    they would appear when concatenating the runs, from just the headers."""
+    if renaming(args):
+        cols = ['run', 'onset', 'duration', 'condition']
+        cols.extend(['pmod-' + pmod for pmod in args.pmods_col])
+        # Subject ids are kept if present (empty columns are dropped later)
+        return cols + ['subject', 'filename']
+
+    paths = [_path(fid) for fid in onsets_files]
+    headers = pool.imap(_read_header, paths) if pool else map(_read_header,
+                                                              paths)
+    columns = []
+    for header in headers:
+        columns.extend(c for c in header if c not in columns)
+    return columns
+
+
+def _read_header(fname):
+    header = list(read_csv(fname, nrows=0).columns)
+    header.append('filename')
+    if 'run' not in header:
+        header.append('run')
+    return header
+
+
+def iter_runs(onsets_files, args, chunksize=None, pool=None):
+    """Yield cleaned chunks of trials from each onsets file, in order.
+
+    With a process pool, whole files are read and cleaned in parallel
+    (ignoring chunksize) and yielded in the original run order."""
+    if pool is not None:
+        tasks = [(i, _path(fid), args) for i, fid in enumerate(onsets_files)]
+        for run in pool.imap(_load_run, tasks):
+            yield run
+        return
+
     for i, fid in enumerate(onsets_files):
-        run = read_csv(fid)
+        chunks = read_csv(_path(fid), chunksize=chunksize, dtype=str_cols)
+        if chunksize is None:
+            chunks = [chunks]
+        for run in chunks:
+            yield clean_run(run, i, _path(fid), args)
+
+
+def _load_run(task):
+    """Read and clean a whole onsets file in a worker process."""
+    i, fname, args = task
+    return clean_run(read_csv(fname, dtype=str_cols), i, fname, args)
+
 
-        # If any column arguments were given, convert to a lyman-like design
-        # with explicitly named columns. Else, just concatenate and add 'run'.
-        if (args.onset_col or args.duration_col or args.condition_col or
-                args.pmods_col):
-            run = rename_columns(args, run)
-            condition_col = 'condition'
-            # Remove blanks
-            run = run[run[condition_col].notnull()]
+def clean_run(run, i, fname, args):
+    """Rename and filter one run (or chunk of a run) of trials."""
+    if renaming(args):
+        run = rename_columns(args, run)
+        condition_col = 'condition'
+        # Remove blanks
+        run = run[run[condition_col].notnull()].copy()
 
-        # Add fn and run to designfile
-        run['filename'] = fid.name
-        if 'run' not in run.columns:
-            run['run'] = i + 1
+    # Add fn and run to designfile
+    run['filename'] = fname
+    if 'run' not in run.columns:
+        run['run'] = i + 1
+    return run
 
-        # Drop any columns thar are entirely empty (for vanity)
-        for col_name, col in run.iteritems():
-            if col.isnull().all():
-                del(run[col_name])
 
-        runs.append(run)
+def write_design(onsets_files, out, args, chunksize=10000, jobs=1):
+    """Stream all runs into a long design file, one chunk at a time.
 
-    return concat(runs, ignore_index=True)
+    Columns that turn out to be entirely empty are dropped (for vanity)
+    with a second streaming pass, so memory use doesn't grow with the
+    number or size of the onsets files. With jobs > 1, onsets files are
+    parsed in a pool of that many processes.
+
+    Returns the number of trials written.
+    """
+    pool = Pool(jobs) if jobs > 1 else None
+    try:
+        columns = design_columns(onsets_files, args, pool)
+        filled = set()
+        n_rows = 0
+        with open(out, 'w') as f:
+            for i, chunk in enumerate(iter_runs(onsets_files, args,
+                                                chunksize, pool)):
+                chunk = chunk.reindex(columns=columns)
+                filled.update(chunk.columns[chunk.notnull().any()])
+                chunk.to_csv(f, index=False, header=(i == 0))
+                n_rows += chunk.shape[0]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    empty_cols = [c for c in columns if c not in filled]
+    if empty_cols and n_rows:
+        tmp = out + '.tmp'
+        keep = [c for c in columns if c in filled]
+        with open(tmp, 'w') as f:
+            for i, chunk in enumerate(read_csv(out, usecols=keep,
+                                               chunksize=chunksize,
+                                               dtype=str_cols)):
+                chunk[keep].to_csv(f, index=False, header=(i == 0))
+        os.rename(tmp, out)
+    return n_rows
+
+
+def _path(fid):
+    """Onsets files may be given as open files or as filenames."""
+    return getattr(fid, 'name', fid)
 
 
 def rename_columns(args, run):
     cols = ['run', 'onset', 'duration', 'condition']
 
-    # Cleanup any columns that might exist if we don't want them
-    if args.drop_cols:
-        for col in cols:
-            if col in run.columns:
-                run.drop(col, axis=1, inplace=True)
-
     columns = {}
 
     columns[args.onset_col] = 'onset'
@@ -63,6 +223,12 @@ def rename_columns(args, run):
     if args.run_col:
         columns[args.run_col] = 'run'
 
+    # Cleanup any columns that might exist if we don't want them
+    if args.drop_cols:
+        for col in cols:
+            if col in run.columns and col not in columns:
+                run.drop(col, axis=1, inplace=True)
+
     if args.duration_col:
         columns[args.duration_col] = 'duration'
     else:
@@ -74,11 +240,14 @@ def rename_columns(args, run):
             cols.append('pmod-' + pmod)
 
     run.rename(columns=columns, inplace=True)
+    if 'subject' in run.columns:
+        cols.append('subject')
 
-    return run[cols]
+    # Without a run column, the run number is added from the file order
+    return run[[c for c in cols if c in run.columns]]
 
 
-def onsets_for(cond, run_df):
+def onsets_for(cond, run_df, pmod_name='pmod'):
     """
     Inputs:
       * Condition Label to grab onsets, durations & amplitudes for.
@@ -88,9 +257,33 @@ def onsets_for(cond, run_df):
       * Returns a dictionary of extracted values for onsets, durations, etc.
       * Returns None if there are no onsets.
     """
-    condinfo = {}
     cond_df = run_df[run_df['condition'] == cond]
+    return _condinfo(cond, cond_df, pmod_name)
+
+
+def run_conditions(design_df, pmod_name='pmod'):
+    """
+    Group a long design by run and condition in a single pass.
+
+    Inputs:
+      * Pandas Dataframe with run, condition, onset (and optionally duration
+        and amplitude) columns for any number of runs.
+
+    Outputs:
+      * Returns an ordered dict mapping each run to the list of condition
+        dictionaries (as from onsets_for) with onsets in that run.
+    """
+    from collections import OrderedDict
+    runs = OrderedDict()
+    for (run, cond), cond_df in design_df.groupby(['run', 'condition'],
+                                                  sort=False):
+        condinfo = _condinfo(cond, cond_df, pmod_name)
+        if condinfo is not None:
+            runs.setdefault(run, []).append(condinfo)
+    return runs
 
+
+def _condinfo(cond, cond_df, pmod_name):
     if cond_df['onset'].notnull().any():  # Onsets Present
         if cond_df['duration'].notnull().any():
             durations = cond_df['duration'].tolist()
@@ -106,7 +299,7 @@ def onsets_for(cond, run_df):
         if ('amplitude' in cond_df.columns and
                 cond_df['amplitude'].notnull().any()):
             pmods = [dict(
-                name=args.pmod_name,
+                name=pmod_name,
                 poly=1,
                 param=cond_df['amplitude'].tolist(),
             )]
@@ -116,6 +309,124 @@ def onsets_for(cond, run_df):
     return condinfo
 
 
+def spm_conditions(design_df, group_cols=('subject', 'run'),
+                   pmod_name='pmod'):
+    """
+    Build the SPM multiple conditions of every subject x run in one pass.
+
+    Inputs:
+      * Long design Dataframe with condition and onset (and optionally
+        duration, amplitude and pmod-<name>) columns.
+      * Columns identifying one conditions file; those missing from the
+        design are ignored (e.g. designs without a subject column).
+        Trials without an onset, condition or any of these are skipped.
+
+    Outputs:
+      * Returns an ordered dict mapping each (subject, run) key to a dict
+        of scipy arrays (as from _lists_to_scipy) for scipy.io.savemat.
+    """
+    from collections import OrderedDict
+    missing = [c for c in ['condition', 'onset'] if c not in design_df.columns]
+    if missing:
+        raise ValueError('Design has no %s column(s); use --condition-col '
+                         'and --onset-col.' % ', '.join(missing))
+    keys = [c for c in group_cols if c in design_df.columns]
+    required = keys + ['condition', 'onset']
+    design_df = design_df[design_df[required].notnull().all(axis=1)]
+    if not len(design_df):
+        return OrderedDict()
+    pmod_cols = [(c, pmod_name) for c in ['amplitude']
+                 if c in design_df.columns]
+    pmod_cols.extend((c, c[len('pmod-'):]) for c in design_df.columns
+                     if c.startswith('pmod-'))
+
+    # Sort trials once so each key x condition is a contiguous block of
+    # rows (keeping the order of appearance), then split every column at
+    # the block boundaries instead of filtering the frame per condition.
+    codes = design_df.groupby(keys + ['condition'], sort=False).ngroup()
+    order = codes.values.argsort(kind='mergesort')
+    bounds = flatnonzero(diff(codes.values[order])) + 1
+    starts = [0] + bounds.tolist()
+    labels = design_df[keys + ['condition']].values[order][starts]
+
+    def blocks(col):
+        return split(design_df[col].values[order].astype(float), bounds)
+
+    onsets = blocks('onset')
+    if 'duration' in design_df.columns:
+        durations = blocks('duration')
+    else:
+        durations = [[0]] * len(starts)
+    pmods = [(name, blocks(col)) for col, name in pmod_cols]
+
+    conditions = OrderedDict()
+    for i, label in enumerate(labels):
+        dur = durations[i]
+        condinfo = dict(
+            name=label[-1],
+            onsets=onsets[i],
+            durations=[0] if isnan(dur).all() else dur,
+        )
+        cond_pmods = [dict(name=name, poly=1, param=params[i])
+                      for name, params in pmods
+                      if not isnan(params[i]).all()]
+        if cond_pmods:
+            condinfo['pmod'] = cond_pmods
+        conditions.setdefault(tuple(label[:-1]), []).append(condinfo)
+
+    return OrderedDict((key, _lists_to_scipy(conds))
+                       for key, conds in conditions.items())
+
+
+def write_spm_conditions(design_df, out_dir, pmod_name='pmod', jobs=1,
+                         group_cols=('subject', 'run')):
+    """
+    Write one SPM multiple conditions .mat file per subject x run.
+
+    Files are named <out_dir>/<subject>/run<run>.mat (or <out_dir>/run<run>.mat
+    for designs without a subject column). With jobs > 1, files are written
+    by a pool of that many processes.
+
+    Returns the list of files written.
+    """
+    tasks = []
+    for key, mdict in spm_conditions(design_df, group_cols,
+                                     pmod_name).items():
+        fname = os.path.join(out_dir, *[str(k) for k in key[:-1]])
+        fname = os.path.join(fname, 'run%s.mat' % key[-1])
+        tasks.append((fname, mdict))
+
+    for dirname in set(os.path.dirname(fname) for fname, _ in tasks):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        try:
+            pool.map(_savemat, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _savemat(task)
+    return [fname for fname, _ in tasks]
+
+
+def _savemat(task):
+    from scipy.io import savemat
+    fname, mdict = task
+    savemat(fname, mdict)
+
+
+def _object_array(items):
+    """1d object array of items (which may be equal length sequences)."""
+    arr = empty((len(items),), dtype='object')
+    for i, item in enumerate(items):
+        arr[i] = item
+    return arr
+
+
 def _lists_to_scipy(onsets_list):
     """
     Inputs:
@@ -134,48 +445,25 @@ def _lists_to_scipy(onsets_list):
         that can be written using scipy.io.savemat
     """
 
-    conditions_n = len(onsets_list)
-    names = empty((conditions_n,),     dtype='object')
-    durations = empty((conditions_n,), dtype='object')
-    onsets = empty((conditions_n,),    dtype='object')
-
-    pmoddt = [('name', 'O'), ('poly', 'O'), ('param', 'O')]
-    pmods = empty((conditions_n),      dtype=pmoddt)
-    has_pmods = False
-
-    for i, ons in enumerate(onsets_list):
-        names[i] = ons['name']
-        durations[i] = ons['durations']
-        onsets[i] = ons['onsets']
-        if 'pmod' not in ons.keys():
-            pmods[i]['name'], pmods[i]['poly'], pmods[i]['param'] = [], [], []
-        else:
-            # 'pmod': [{'name':'rt','poly':1,'param':[1,2,3]}]
-            # Multiple pmods per condition are allowed, so pmod
-            # is a list of dicts.
-            has_pmods = True
-            cond_pmod_list = ons['pmod']
-            current_condition_n_pmods = len(cond_pmod_list)
-            pmod_names = empty((current_condition_n_pmods,), dtype='object')
-            pmod_param = empty((current_condition_n_pmods,), dtype='object')
-            pmod_poly = empty((current_condition_n_pmods,), dtype='object')
-
-            for pmod_i, val in enumerate(cond_pmod_list):
-                pmod_names[pmod_i] = val['name']
-                pmod_param[pmod_i] = val['param']
-                pmod_poly[pmod_i] = float(val['poly'])
-
-            pmods[i]['name'] = pmod_names
-            pmods[i]['poly'] = pmod_poly
-            pmods[i]['param'] = pmod_param
-
     scipy_onsets = dict(
-        names=names,
-        durations=durations,
-        onsets=onsets
+        names=_object_array([ons['name'] for ons in onsets_list]),
+        durations=_object_array([ons['durations'] for ons in onsets_list]),
+        onsets=_object_array([ons['onsets'] for ons in onsets_list]),
     )
 
-    if has_pmods:
+    if any('pmod' in ons for ons in onsets_list):
+        # 'pmod': [{'name':'rt','poly':1,'param':[1,2,3]}]
+        # Multiple pmods per condition are allowed, so pmod
+        # is a list of dicts. Conditions without pmods get empty fields.
+        pmoddt = [('name', 'O'), ('poly', 'O'), ('param', 'O')]
+        pmods = empty((len(onsets_list),), dtype=pmoddt)
+        cond_pmods = [ons.get('pmod', []) for ons in onsets_list]
+        for field, convert in [('name', None), ('poly', float),
+                               ('param', None)]:
+            pmods[field] = _object_array([
+                _object_array([convert(p[field]) if convert else p[field]
+                               for p in pmod_list]) if pmod_list else []
+                for pmod_list in cond_pmods])
         scipy_onsets['pmod'] = pmods
 
     return scipy_onsets
@@ -183,11 +471,11 @@ def _lists_to_scipy(onsets_list):
 
 def parse_args():
     parser = ArgumentParser()
-    parser.add_argument('onsets_files', type=FileType('r'),
+    parser.add_argument('onsets_files',
                         help='List of FSL EV onsets to convert', nargs='+')
     parser.add_argument('--out',   '-o', default='onsets_',
                         help='Output filename.')
-    parser.add_argument('--verbose',      '-v', action="count",
+    parser.add_argument('--verbose',      '-v', action="count", default=0,
                         help="increase output verbosity")
     parser.add_argument('--pmod-name', default='pmod',
                         help='Name to use when writing FSL Amplitude as SPM '
@@ -198,6 +486,20 @@ def parse_args():
     parser.add_argument('--onset-col', default='')
     parser.add_argument('--pmods-col', default=[], nargs="*")
     parser.add_argument('--run-col')
+    parser.add_argument('--format', '-f', choices=['csv', 'parquet', 'feather'],
+                        help='Design file format (default: guessed from '
+                             'the output extension, else csv)')
+    parser.add_argument('--partition-col',
+                        help='Write a parquet dataset partitioned by this '
+                             'column (e.g. subject)')
+    parser.add_argument('--spm-dir',
+                        help='Also write SPM multiple conditions .mat files '
+                             '(one per subject and run) into this directory')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of processes used to parse onsets files '
+                             'and write SPM conditions files')
+    parser.add_argument('--chunksize', type=int, default=10000,
+                        help='Number of trials to read and write at a time')
     parser.add_argument('--drop-cols', help='Drop pre-named columns in'
                                             'longform',
                         default=True)
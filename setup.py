@@ -63,13 +63,16 @@ if __name__ == "__main__":
           version=VERSION,
           url=URL,
           download_url=DOWNLOAD_URL,
+          python_requires='>=3.7',
           install_requires=INSTALL_REQUIRES,
           packages=find_packages(exclude=['doc']),  # ['fitz', 'fitz.tools'],
           scripts=['scripts/fitz', 'scripts/log2design.py'],
           classifiers=[
               'Development Status :: 2 - Pre-Alpha',
               'Intended Audience :: Science/Research',
-              'Programming Language :: Python :: 2.7',
+              'Programming Language :: Python :: 3',
+              'Programming Language :: Python :: 3 :: Only',
+              'Programming Language :: Python :: 3.7',
               'License :: OSI Approved :: BSD License',
               'Operating System :: POSIX',
               'Operating System :: Unix',